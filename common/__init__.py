@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""driver_amount_allocator和invoice_generator共用的读写、缓存等工具"""
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Excel读取后端的耗时和一致性基准：同一个文件分别用pd.read_excel和excel_reader的各个引擎读取，
+对比耗时，并检查读出来的DataFrame和pd.read_excel完全一致(值、类型、列名、索引都要一样)。
+没装的引擎跳过；有不一致时退出码为1。
+示例文件只有一两百行，耗时都在几十毫秒，倍数没有参考意义；比较速度要用大文件(如synthetic_bills.py生成的10万行派车单明细)。
+
+用法: python bench_excel_reader.py 文件1.xlsx 文件2.xlsx ... [--header 0] [--usecols 状态,单据号] [--str-columns 单据号]
+不传文件时读示例派车单明细：按read_drive_bill的列和类型读一遍，再读一遍全部列。
+"""
+
+from __future__ import unicode_literals
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(dir))
+
+from common.excel_reader import ENGINES, HAS_CALAMINE, read_excel
+
+DRIVE_BILL_FILE = os.path.join(os.path.dirname(dir), "driver_amount_allocator", "派车单明细.xlsx")
+
+
+def default_cases():
+    '''不传文件时的(文件, 读取参数)list'''
+    sys.path.append(os.path.join(os.path.dirname(dir), "driver_amount_allocator"))
+    from driver_amount_allocator import DRIVE_BILL_COLUMNS, DRIVE_BILL_DTYPE
+
+    return [(DRIVE_BILL_FILE, {"usecols": DRIVE_BILL_COLUMNS, "dtype": DRIVE_BILL_DTYPE}), (DRIVE_BILL_FILE, {})]
+
+
+def compare(file_path, read_options, engines):
+    '''返回(各引擎耗时dict, 不一致的说明list, pd.read_excel读出的形状)'''
+    seconds, problems = {}, []
+    # 先读一次表头，import openpyxl等一次性的开销不算进第一个计时的读法
+    pd.read_excel(file_path, nrows=0)
+    start = time.perf_counter()
+    expected = pd.read_excel(file_path, **read_options)
+    seconds["pandas"] = time.perf_counter() - start
+    for engine in engines:
+        start = time.perf_counter()
+        data_frame = read_excel(file_path, engine=engine, **read_options)
+        seconds[engine] = time.perf_counter() - start
+        try:
+            assert_frame_equal(expected, data_frame, check_exact=True)
+        except AssertionError as e:
+            problems.append("%s %s：%s" % (os.path.basename(file_path), engine, e))
+    return seconds, problems, expected.shape
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Excel读取后端的耗时和一致性基准")
+    parser.add_argument("files", nargs="*", help="要读取的xlsx文件，不传时读示例派车单明细")
+    parser.add_argument("--header", type=int, default=0, help="表头所在行(从0开始)")
+    parser.add_argument("--usecols", default="", help="只读取的列名，逗号分隔")
+    parser.add_argument("--str-columns", default="", help="按文字读取的列名，逗号分隔")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    engines = [engine for engine in ENGINES if engine != "pandas" and (engine != "calamine" or HAS_CALAMINE)]
+    if args.files:
+        read_options = {"header": args.header}
+        if args.usecols:
+            read_options["usecols"] = args.usecols.split(",")
+        if args.str_columns:
+            read_options["dtype"] = dict((column, str) for column in args.str_columns.split(","))
+        cases = [(file_path, read_options) for file_path in args.files]
+    else:
+        cases = default_cases()
+
+    problems = []
+    print("%-30s%14s%8s" % ("", "耗时(秒)", "倍数") + "".join("%14s%8s" % (engine, "") for engine in engines))
+    for file_path, read_options in cases:
+        seconds, case_problems, shape = compare(file_path, read_options, engines)
+        name = "%s(%s列)" % (os.path.basename(file_path), shape[1])
+        print("%-30s%14.3f%8s" % (name, seconds["pandas"], "") + "".join(
+            "%14.3f%8.1f" % (seconds[engine], seconds["pandas"] / seconds[engine]) for engine in engines))
+        problems += case_problems
+
+    if problems:
+        print("\n和pd.read_excel不一致：\n%s" % "\n".join(problems))
+        return 1
+    print("\n全部一致")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
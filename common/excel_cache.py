@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Excel解析结果缓存
+
+openpyxl解析xlsx占了大部分耗时，改一个规则格子后重跑还要把没变的派车单明细再解析一遍。
+这里把read_excel的结果按列式文件缓存到本地：
+    1. key = 文件内容的sha256 + 读取参数(header/usecols/dtype/nrows等)，文件内容或读取参数变了都会重新解析
+    2. 装了pyarrow时存parquet；没装pyarrow，或者列名/列内容parquet存不了(比如列名里有数字、一列里混着数字和文字)时存pickle
+    3. 缓存目录总大小超过上限时，按最近使用时间从旧到新删除
+    4. use_cache=False时直接解析，不读也不写缓存
+解析用excel_reader.read_excel(按装了的库选最快的读法，结果和pd.read_excel完全一样)，所以缓存key里不区分读法
+"""
+
+from __future__ import unicode_literals
+import hashlib
+import json
+import os
+import pandas as pd
+
+from common.excel_reader import read_excel
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+CACHE_FORMATS = ("parquet", "pkl")
+CACHE_DIR_NAME = ".excel_cache"
+DEFAULT_MAX_CACHE_BYTES = 512 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(file_path):
+    """文件内容的sha256，按块读取避免大文件一次性读进内存"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _options_digest(read_options):
+    """读取参数转成稳定的字符串再取hash；dtype里的str/float等类型对象用repr表示"""
+    text = json.dumps(read_options, sort_keys=True, ensure_ascii=False, default=repr)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_key(file_path, read_options):
+    return "%s_%s" % (file_digest(file_path), _options_digest(read_options))
+
+
+def _load(path):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+
+def _write(data_frame, path, cache_format):
+    # 先写临时文件再替换，避免中途退出留下半个缓存文件
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    try:
+        if cache_format == "parquet":
+            data_frame.to_parquet(tmp_path)
+        else:
+            data_frame.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _save(data_frame, cache_dir, key):
+    """优先存parquet，parquet存不了或者还原不了原样的列名时退回pickle"""
+    if HAS_PYARROW and all(isinstance(col, str) for col in data_frame.columns):
+        try:
+            _write(data_frame, os.path.join(cache_dir, key + ".parquet"), "parquet")
+            return
+        except Exception:
+            pass
+    _write(data_frame, os.path.join(cache_dir, key + ".pkl"), "pkl")
+
+
+def evict(cache_dir, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """缓存目录超过max_cache_bytes时，按最近使用时间从旧到新删除缓存文件"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(tuple("." + cache_format for cache_format in CACHE_FORMATS)):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_cache_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def read_excel_cached(file_path, use_cache=True, cache_dir=None, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES,
+                      **read_options):
+    """和pd.read_excel(file_path, **read_options)返回相同的DataFrame，重复读取没变过的文件时直接读缓存
+    cache_dir默认在输入文件同目录下的.excel_cache
+    """
+    if not use_cache:
+        return read_excel(file_path, **read_options)
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), CACHE_DIR_NAME)
+    key = cache_key(file_path, read_options)
+
+    for path in (os.path.join(cache_dir, "%s.%s" % (key, cache_format)) for cache_format in CACHE_FORMATS):
+        if not os.path.exists(path):
+            continue
+        try:
+            data_frame = _load(path)
+        except Exception as e:
+            # 缓存文件损坏时当作没有缓存，重新解析
+            print("缓存文件读取失败，重新解析Excel：%s" % e)
+        else:
+            # 刷新修改时间，作为最近使用时间参与淘汰
+            os.utime(path, None)
+            return data_frame
+
+    data_frame = read_excel(file_path, **read_options)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _save(data_frame, cache_dir, key)
+        evict(cache_dir, max_cache_bytes)
+    except Exception as e:
+        # 缓存写不进去不影响本次计算
+        print("缓存文件写入失败，本次不缓存：%s" % e)
+    return data_frame
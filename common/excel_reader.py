@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Excel读取后端
+
+pd.read_excel读xlsx时openpyxl给每个单元格建对象，pandas再逐个单元格转换类型，其中还有一小半是用不到的列。
+这里按装了哪些库选读法，返回的DataFrame和pd.read_excel一致：
+    1. calamine：装了python-calamine(pip install python-calamine，见安装必读/requirements.bat)时
+       用pd.read_excel(engine="calamine")，Rust实现的解析，比pd.read_excel快几倍，大文件要提速就装它
+    2. openpyxl：没装calamine时的读法。openpyxl只读模式iter_rows(values_only=True)逐行取值，不建单元格对象；
+       usecols为列名list或判断函数时，读到表头后每行只取这些列，其他列只在这几列都为空时判断整行是否为空(决定末尾的空行要不要保留)；
+       取出的值按列一次性转换：空值、整数值的float、dtype=str的文字化自己处理，每列调用一次pd.array/pd.Categorical
+    3. pandas：直接调用pd.read_excel(xls文件、多个sheet、其他读取参数都走这里)
+openpyxl读法的耗时大部分在openpyxl解析sheet的xml上(iter_rows本身就占九成左右)，只比pd.read_excel快1.3倍左右，
+不是"快几倍"的读法；category_columns里的列直接解码成categorical，空值保持为空，填充空值用fillna_text。
+注意：values_only取不到单元格类型，openpyxl引擎把内容正好是错误值(#N/A、#DIV/0!等)的文字也当成错误值转成nan。
+"""
+
+from __future__ import unicode_literals
+import datetime
+import os
+import re
+import zipfile
+from collections import defaultdict
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+try:
+    import python_calamine  # noqa: F401
+    HAS_CALAMINE = True
+except ImportError:
+    HAS_CALAMINE = False
+
+ENGINES = ("calamine", "openpyxl", "pandas")
+XLSX_EXTENSIONS = (".xlsx", ".xlsm")
+# openpyxl解析时支持的读取参数，其他参数直接用pd.read_excel
+XLSX_READ_OPTIONS = ("sheet_name", "header", "usecols", "dtype", "nrows")
+# pandas读Excel时默认当成空值的文字
+NA_VALUES = frozenset(["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                       "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"])
+# 全列都是这些文字(或布尔值)、没有空值时pandas转成bool列
+BOOL_VALUES = {"True": True, "TRUE": True, "true": True, "False": False, "FALSE": False, "false": False}
+
+
+def available_engine():
+    return "calamine" if HAS_CALAMINE else "openpyxl"
+
+
+def na_values():
+    '''当成空值的文字：pandas默认的空值文字和Excel的错误值'''
+    from openpyxl.cell.cell import ERROR_CODES
+
+    return NA_VALUES | frozenset(ERROR_CODES)
+
+
+def _row_width(row):
+    '''去掉末尾的空单元格后的列数'''
+    width = len(row)
+    while width and (row[width - 1] is None or row[width - 1] == ""):
+        width -= 1
+    return width
+
+
+def is_blank(row):
+    '''一行(或取出的几列)是否全为空单元格'''
+    return row.count(None) + row.count("") == len(row)
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+def column_names(header_row, width):
+    '''表头行前width列的列名，和pandas一样：空的列名为"Unnamed: 列下标"，整数值的float转成int，重名的列名依次加上.1、.2...'''
+    names = []
+    for index in range(width):
+        value = header_row[index] if index < len(header_row) else None
+        if value is None or value == "":
+            value = "Unnamed: %s" % index
+        elif value.__class__ is float and value.is_integer():
+            value = int(value)
+        names.append(value)
+    counts = defaultdict(int)
+    for index, name in enumerate(names):
+        count = counts[name]
+        while count > 0:
+            counts[name] = count + 1
+            name = "%s.%s" % (name, count)
+            count = counts[name]
+        names[index] = name
+        counts[name] = count + 1
+    return names
+
+
+class ColumnFilter(object):
+    '''usecols用的判断函数：表头里的列名在names里就读，names里有表头没有的列时不报错(同pandas的callable usecols)
+    repr固定，作为解析缓存key的一部分时每次运行都相同
+    '''
+
+    def __init__(self, names):
+        self.names = tuple(names)
+
+    def __call__(self, name):
+        return name in self.names
+
+    def __repr__(self):
+        return "ColumnFilter(%r)" % (list(self.names),)
+
+
+def usecols_by_name(usecols):
+    '''usecols为列名list或判断函数，读到表头才知道要取哪些列'''
+    if callable(usecols):
+        return True
+    return isinstance(usecols, (list, tuple)) and len(usecols) > 0 and all(isinstance(name, str) for name in usecols)
+
+
+def select_columns(names, usecols, sheet_name):
+    '''usecols(列名list、判断函数或列下标list，None为全部列)对应的列下标，按表头顺序；
+    和pandas一样，列名list里有表头里没有的列时报错
+    '''
+    if usecols is None:
+        return list(range(len(names)))
+    if callable(usecols):
+        return [index for index, name in enumerate(names) if usecols(name)]
+    if usecols_by_name(usecols):
+        missing = [name for name in usecols if name not in names]
+        if missing:
+            raise ValueError("Usecols do not match columns, columns expected but not found: %s (sheet: %s)"
+                             % (missing, sheet_name))
+        wanted = set(usecols)
+        return [index for index, name in enumerate(names) if name in wanted]
+    if any(not 0 <= column < len(names) for column in usecols):
+        raise ValueError("Defining usecols with out-of-bounds indices is not allowed. %s are out of bounds. (sheet: %s)"
+                         % ([column for column in usecols if not 0 <= column < len(names)], sheet_name))
+    return sorted(set(usecols))
+
+
+def row_getter(columns):
+    '''返回函数：从openpyxl的一行里按列下标取值，返回tuple；一行比最大的列下标短时缺的列为None'''
+    width = max(columns) + 1 if columns else 0
+    getter = itemgetter(*columns) if len(columns) > 1 else (lambda row: (row[columns[0]],)) if columns else None
+
+    def get(row):
+        if len(row) < width:
+            row = tuple(row) + (None,) * (width - len(row))
+        return getter(row) if getter is not None else ()
+    return get
+
+
+def _clean_values(values, na_values):
+    '''一列的单元格值，和pandas读xlsx时一致：空单元格和空值文字转None，整数值的float转int'''
+    return [None if value is None or (value.__class__ is str and value in na_values)
+            else int(value) if value.__class__ is float and value.is_integer() else value for value in values]
+
+
+def _text_values(values):
+    return [value if value is None or value.__class__ is str else str(value) for value in values]
+
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = [np.nan if value is None else value for value in values]
+    return array
+
+
+def _infer_array(values):
+    '''没有指定dtype的列，按pandas的规则推断类型：能转数字的(包括数字文字)转数字，全是布尔值转bool，
+    全是日期时间转datetime64，全是文字为pandas的字符串类型，其他为object'''
+    present = [value for value in values if value is not None]
+    if not values:
+        return np.array([], dtype=object)
+    if not present:
+        return np.full(len(values), np.nan)
+    try:
+        return pd.to_numeric(pd.Series(values, dtype=object)).to_numpy()
+    except (ValueError, TypeError):
+        pass
+    kinds = set(value.__class__ for value in present)
+    if len(present) == len(values) and kinds <= {bool, str} and all(value in BOOL_VALUES for value in present
+                                                                    if value.__class__ is str):
+        return np.array([BOOL_VALUES.get(value, value) for value in values], dtype=bool)
+    if kinds == {datetime.datetime}:
+        return pd.array(pd.to_datetime(pd.Series(values, dtype=object)))
+    if kinds == {str}:
+        return pd.array(values, dtype="str")
+    return _object_array(values)
+
+
+def column_array(values, dtype=None, category=False, na_values=NA_VALUES):
+    '''一列的单元格值转成pandas的数组，dtype为str时按文字读，category=True时转成categorical'''
+    values = _clean_values(values, na_values)
+    if dtype in (str, "str"):
+        values = _text_values(values)
+        if category:
+            # 整列都是空值时类别的类型也是文字
+            return pd.Categorical(values, categories=pd.Index([], dtype="str")) if values.count(None) == len(values) \
+                else pd.Categorical(values)
+        return pd.array(values, dtype="str")
+    array = _infer_array(values)
+    if dtype is not None:
+        array = pd.Series(array).astype(dtype).array
+    if category:
+        return pd.Categorical(array)
+    return array
+
+
+def build_frame(names, rows, dtype=None, category_columns=(), na_values=NA_VALUES):
+    '''按行取出的值(每行为tuple，和names一一对应)按列转换，拼成DataFrame'''
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    data = {}
+    for name, values in zip(names, columns):
+        column_dtype = dtype.get(name) if isinstance(dtype, dict) else dtype
+        if not rows:
+            data[name] = pd.Series([], dtype="str" if column_dtype in (str, "str") else column_dtype or object)
+            if name in category_columns:
+                data[name] = data[name].astype("category")
+            continue
+        try:
+            data[name] = column_array(list(values), column_dtype, name in category_columns, na_values)
+        except (ValueError, TypeError) as e:
+            # 和pandas一样报错信息带上列名
+            raise ValueError("Unable to convert column %s to type %s: %s" % (name, column_dtype, e))
+    return pd.DataFrame(data, columns=names) if names else pd.DataFrame()
+
+
+def _open_sheet(file_path, sheet_name):
+    '''和pandas一样用openpyxl只读模式打开，返回(workbook, worksheet)；sheet不存在时报错信息也和pandas一样'''
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    if isinstance(sheet_name, int) and not 0 <= sheet_name < len(workbook.worksheets):
+        workbook.close()
+        raise ValueError("Worksheet index %s is invalid, %s worksheets found" % (sheet_name, len(workbook.worksheets)))
+    if not isinstance(sheet_name, int) and sheet_name not in workbook.sheetnames:
+        workbook.close()
+        raise ValueError("Worksheet named '%s' not found" % sheet_name)
+    return workbook, workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+
+
+def iter_sheet_rows(file_path, sheet_name=0):
+    '''逐行读取xlsx的一个sheet，返回openpyxl iter_rows(values_only=True)的每行值tuple(空单元格为None)；
+    和openpyxl一样从第1行开始，中间缺的行返回空tuple，读完或提前结束时关闭工作簿
+    '''
+    workbook, sheet = _open_sheet(file_path, sheet_name)
+    try:
+        # 和pandas一样不信任文件里记录的sheet大小
+        sheet.reset_dimensions()
+        for row in sheet.iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def _xlsx_usecols(usecols):
+    '''"A:C,E"这种列字母和pandas一样转成列下标list'''
+    if not isinstance(usecols, str):
+        return usecols
+    columns = []
+    for area in usecols.split(","):
+        letters = [letter.strip().upper() for letter in area.split(":")]
+        if not all(re.match(r"^[A-Z]+$", letter) for letter in letters):
+            raise ValueError("Invalid column name: %s" % area)
+        columns.extend(range(_column_index(letters[0]), _column_index(letters[-1]) + 1))
+    return columns
+
+
+def _can_read_xlsx(file_path, read_options):
+    usecols = read_options.get("usecols")
+    return os.path.splitext(str(file_path))[1].lower() in XLSX_EXTENSIONS and zipfile.is_zipfile(file_path) \
+        and set(read_options) <= set(XLSX_READ_OPTIONS) \
+        and isinstance(read_options.get("sheet_name", 0), (int, str)) \
+        and isinstance(read_options.get("header", 0), int) and read_options.get("header", 0) >= 0 \
+        and (usecols is None or isinstance(usecols, str) or usecols_by_name(usecols)
+             or (isinstance(usecols, (list, tuple)) and all(isinstance(column, int) for column in usecols)))
+
+
+def read_xlsx(file_path, sheet_name=0, header=0, usecols=None, dtype=None, nrows=None, category_columns=()):
+    '''用openpyxl只读模式读xlsx，按列转换成DataFrame，和pd.read_excel的处理一致：
+    表头之前的行跳过，去掉末尾的空行(中间的空行保留为空值行)，表头之前的行、数据行比表头宽时多出的列也和pandas一样读出来
+    usecols为列名list或判断函数时读到表头后每行只取这些列
+    '''
+    usecols = _xlsx_usecols(usecols)
+    na = na_values()
+    by_name = usecols_by_name(usecols)
+    rows_iter = iter_sheet_rows(file_path, sheet_name=sheet_name)
+    header_row, pre_width, rows, last_data_row = None, 0, [], -1
+    try:
+        for index, row in enumerate(rows_iter):
+            if index == header:
+                header_row = row
+                break
+            pre_width = max(pre_width, _row_width(row))
+        if header_row is None:
+            return pd.DataFrame()
+        if by_name:
+            # 只取usecols里的列，这几列都为空时再看整行是不是空行
+            names = column_names(header_row, _row_width(header_row))
+            columns = select_columns(names, usecols, sheet_name)
+            get = row_getter(columns)
+        for row in rows_iter:
+            if nrows is not None and len(rows) >= nrows:
+                break
+            if by_name:
+                values = get(row)
+                if not is_blank(values) or not is_blank(row):
+                    last_data_row = len(rows)
+                rows.append(values)
+            else:
+                if not is_blank(row):
+                    last_data_row = len(rows)
+                rows.append(row)
+    finally:
+        rows_iter.close()
+    rows = rows[:last_data_row + 1]
+
+    if not by_name:
+        width = max([pre_width, _row_width(header_row)] + [_row_width(row) for row in rows])
+        if not width:
+            return pd.DataFrame()
+        names = column_names(header_row, width)
+        columns = select_columns(names, usecols, sheet_name)
+        get = row_getter(columns)
+        rows = [get(row) for row in rows]
+    return build_frame([names[column] for column in columns], rows, dtype=dtype, category_columns=category_columns,
+                       na_values=na)
+
+
+def to_category(data_frame, category_columns):
+    '''category_columns里的列逐列转成categorical，转完一列就释放原来的文字列'''
+    for col in category_columns:
+        if col in data_frame.columns:
+            data_frame[col] = data_frame[col].astype("category")
+    return data_frame
+
+
+def fillna_text(data_frame, value=""):
+    '''data_frame.fillna(value)；categorical列填充类别以外的值会报错，有空值的categorical列先把value加进类别'''
+    for col, column in data_frame.items():
+        if isinstance(column.dtype, pd.CategoricalDtype) and value not in column.cat.categories \
+                and column.isna().any():
+            data_frame[col] = column.cat.add_categories([value])
+    return data_frame.fillna(value)
+
+
+def read_excel(file_path, engine=None, category_columns=(), **read_options):
+    '''和pd.read_excel(file_path, **read_options)返回相同的DataFrame，category_columns里的列转成categorical
+    engine为ENGINES之一，默认用available_engine()；openpyxl引擎不支持的文件和读取参数用pd.read_excel
+    '''
+    engine = engine or available_engine()
+    if engine == "calamine":
+        data_frame = pd.read_excel(file_path, engine="calamine", **read_options)
+    elif engine == "openpyxl" and _can_read_xlsx(file_path, read_options):
+        # 直接解码成categorical，to_category不用再转
+        data_frame = read_xlsx(file_path, category_columns=category_columns, **read_options)
+    else:
+        data_frame = pd.read_excel(file_path, **read_options)
+    return to_category(data_frame, category_columns)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+流式读取超大Excel明细
+
+pd.read_excel会先把整张sheet读进内存再过滤，全年的派车单/对账明细峰值能到几个G。
+这里逐行读取，每攒够chunk_size行解析成一个DataFrame，交给调用方过滤和裁剪列，只保留符合条件的行；
+保留下来的块马上把重复值多的文字列转成categorical，最后用union_categoricals合并类别再拼接，
+全程不会有完整的文字列，内存占用只和过滤后的数据量有关。
+
+逐行读取用excel_reader.iter_sheet_rows，每行只取usecols里的列，
+列名、空值、类型推断、dtype的处理都用excel_reader按列转换的逻辑(build_frame)，和read_excel读出来的一致，
+同一个文件流式读取后再过滤，和read_excel读完整张表再过滤的结果一致。
+注意：没有在dtype里指定类型的列按分块各自推断类型，需要稳定类型的列要写进dtype；表头右侧没有列名的列不读取。
+"""
+
+from __future__ import unicode_literals
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from common.excel_reader import (build_frame, column_names, is_blank, iter_sheet_rows, na_values, read_excel,
+                                 row_getter, select_columns, to_category)
+
+DEFAULT_CHUNK_SIZE = 50000
+
+
+def iter_excel_chunks(file_path, sheet_name=0, header=0, usecols=None, dtype=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """逐块读取Excel，每块最多chunk_size行，返回DataFrame的生成器
+    header为表头所在行(从0开始)，usecols只支持列名list或判断函数，其他参数含义同pd.read_excel
+    """
+    rows = iter_sheet_rows(file_path, sheet_name=sheet_name)
+    try:
+        for chunk in _iter_chunks(rows, sheet_name, header, usecols, dtype, chunk_size):
+            yield chunk
+    finally:
+        # 提前结束时也关闭工作簿
+        rows.close()
+
+
+def _iter_chunks(rows, sheet_name, header, usecols, dtype, chunk_size):
+    header_row = None
+    for row_number, row in enumerate(rows):
+        if row_number == header:
+            header_row = row
+            break
+    if header_row is None:
+        return
+    names = column_names(header_row, len(header_row))
+    while names and header_row[len(names) - 1] in (None, ""):
+        names.pop()
+    width = len(names)
+    columns = select_columns(names, usecols, sheet_name)
+    names = [names[column] for column in columns]
+    get = row_getter(columns)
+    na = na_values()
+
+    buffer = []
+    blank_rows = []
+    for row in rows:
+        values = get(row)
+        # 中间的空行保留(和read_excel一致)，末尾的空行丢掉；表头右侧的列不算
+        if is_blank(values) and is_blank(row[:width]):
+            blank_rows.append(values)
+            continue
+        buffer += blank_rows
+        blank_rows = []
+        buffer.append(values)
+        if len(buffer) >= chunk_size:
+            yield build_frame(names, buffer, dtype=dtype, na_values=na)
+            buffer = []
+
+    if buffer:
+        yield build_frame(names, buffer, dtype=dtype, na_values=na)
+
+
+def read_excel_filtered(file_path, chunk_filter=None, category_columns=(), sheet_name=0, header=0, usecols=None,
+                        dtype=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """流式读取Excel，每块读出来后先调用chunk_filter(chunk)过滤/清洗，只保留返回的行
+    category_columns里的列每块过滤完就转成categorical；返回的DataFrame重新从0开始编号
+    """
+    kept = []
+    empty = None
+    for chunk in iter_excel_chunks(file_path, sheet_name=sheet_name, header=header, usecols=usecols, dtype=dtype,
+                                   chunk_size=chunk_size):
+        if chunk_filter is not None:
+            chunk = chunk_filter(chunk)
+        if len(chunk):
+            kept.append(to_category(chunk, category_columns))
+        elif empty is None:
+            empty = chunk
+
+    if kept:
+        return concat_chunks(kept, category_columns)
+    if empty is not None:
+        data_frame = empty.reset_index(drop=True)
+    else:
+        # 只有表头没有数据
+        data_frame = read_excel(file_path, sheet_name=sheet_name, header=header, usecols=usecols, dtype=dtype,
+                                nrows=0)
+    return to_category(data_frame, category_columns)
+
+
+def _union_categoricals(columns):
+    '''合并各块的categorical，类别和整列astype("category")一样排序(排不了序时按出现顺序)'''
+    if len(set(column.cat.categories.dtype for column in columns)) > 1:
+        # 各块推断出的类别类型不同(比如有的块全是数字)，类别统一按object合并，只转换类别不转换每行的值
+        columns = [column.cat.rename_categories(column.cat.categories.astype(object)) for column in columns]
+    try:
+        return union_categoricals(columns, sort_categories=True)
+    except TypeError:
+        return union_categoricals(columns)
+
+
+def concat_chunks(chunks, category_columns=()):
+    '''按行拼接各块，返回的DataFrame从0开始编号
+    pd.concat遇到类别不同的categorical会还原成文字，category_columns里的列用union_categoricals合并
+    '''
+    category_columns = [col for col in category_columns if col in chunks[0].columns]
+    if len(chunks) == 1 or not category_columns:
+        return pd.concat(chunks, ignore_index=True)
+    data_frame = pd.concat([chunk.drop(columns=category_columns) for chunk in chunks], ignore_index=True)
+    for col in category_columns:
+        data_frame[col] = _union_categoricals([chunk[col] for chunk in chunks])
+    return data_frame[chunks[0].columns]
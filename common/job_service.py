@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+常驻服务模式
+
+双击运行时每个文件都要重新启动python、import pandas、读规则表，算完还要等1分钟才关窗口；连续算几个文件时大部分时间花在这些上面。
+常驻服务启动一次后一直运行，直到Ctrl+C：
+    1. 固定数量的子进程(进程池)常驻，启动时就完成import和初始化(如编译规则表)，之后每个文件只花实际计算的时间
+    2. 两种提交方式：
+       a. 把文件放进监视目录，文件大小不再变化(复制完成)后自动提交，计算时移到 监视目录/计算中，
+          算完移到 监视目录/已处理 或 监视目录/失败，结果写到输出目录
+       b. 本机HTTP接口(只监听127.0.0.1)：
+          POST /jobs        提交任务，body为json {"data_file": "文件路径", "options": {...}}，
+                            或者直接上传xlsx文件内容(POST /jobs?name=文件名.xlsx)
+          GET  /jobs/<任务号> 查询任务状态(queued/done/failed，排队中和计算中的都是queued)、结果文件、耗时、错误信息
+          GET  /jobs        所有任务；GET /health 服务状态
+    3. 同时计算的任务数不超过进程数；还没算完(queued)的任务达到max_pending时不再接收(HTTP返回503，监视目录的文件下次扫描再提交)
+    4. 只保留最近max_history个已结束(done/failed)的任务记录，更早的查询时返回404
+    5. 子进程异常退出(内存不够被杀掉等)时进程池不能再用：还没算完的任务都记为失败，换一个新的进程池继续接收任务
+"""
+
+from __future__ import unicode_literals
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Manager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+
+WATCH_PATTERN = "*.xlsx"
+PROCESSING_DIR = "计算中"
+DONE_DIR = "已处理"
+FAILED_DIR = "失败"
+UPLOAD_DIR = "上传"
+# 等所有子进程完成初始化的最长时间(秒)
+WARM_UP_TIMEOUT = 300
+
+
+def _run_job(job_func, data_file, result_file, options):
+    '''在子进程里执行任务，返回(结果文件list, 计算耗时)'''
+    start = time.perf_counter()
+    result_files = job_func(data_file, result_file, options)
+    return result_files, round(time.perf_counter() - start, 3)
+
+
+def _warm_up(barrier):
+    '''启动时每个子进程跑一个：在barrier上等到workers个预热任务都开始执行再返回进程号。
+    一个子进程同一时间只能跑一个任务，所以能返回说明workers个子进程都已经启动并完成了初始化
+    '''
+    barrier.wait()
+    return os.getpid()
+
+
+def _move_into(file_path, target_dir, prefix=""):
+    '''把文件移到target_dir下，重名时文件名前面加上prefix；返回新路径'''
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    target = os.path.join(target_dir, os.path.basename(file_path))
+    if os.path.exists(target):
+        target = os.path.join(target_dir, "%s_%s" % (prefix or time.strftime("%Y%m%d_%H_%M_%S"),
+                                                     os.path.basename(file_path)))
+    shutil.move(file_path, target)
+    return target
+
+
+class JobService(object):
+    """常驻的任务服务
+    job_func(data_file, result_file, options)为模块级函数(要能传给子进程)，返回写出的结果文件list；
+    result_name(data_file)返回结果文件名(放在output_dir下)；initializer/initargs为子进程启动时的初始化；
+    max_history为保留的已结束任务记录数
+    """
+
+    def __init__(self, name, job_func, result_name, output_dir, workers=2, initializer=None, initargs=(),
+                 watch_dir=None, port=None, poll_seconds=2.0, max_pending=None, max_history=1000,
+                 default_options=None):
+        self.name = name
+        self.job_func = job_func
+        self.result_name = result_name
+        self.output_dir = output_dir
+        self.workers = workers
+        self.watch_dir = watch_dir
+        self.port = port
+        self.poll_seconds = poll_seconds
+        self.max_pending = max_pending or workers * 4
+        self.max_history = max_history
+        self.default_options = default_options or {}
+        self.jobs = OrderedDict()
+        # 换进程池时在持有锁的情况下再次加锁
+        self._lock = threading.RLock()
+        self._seq = 0
+        self._stopped = threading.Event()
+        self._server = None
+        self._threads = []
+        self._initializer = initializer
+        self._initargs = initargs
+        self.executor = self._new_executor()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=self._initializer, initargs=self._initargs)
+
+    def _replace_executor(self, broken):
+        '''子进程异常退出后换一个新的进程池；broken已经被换掉时不重复换'''
+        with self._lock:
+            if self.executor is not broken:
+                return
+            print("计算进程异常退出，重新启动进程池")
+            self.executor = self._new_executor()
+        broken.shutdown(wait=False)
+
+    def pending_count(self):
+        '''还没算完的任务数(排队中+计算中，状态都是queued)'''
+        with self._lock:
+            return sum(1 for job in self.jobs.values() if job["status"] == "queued")
+
+    def submit(self, data_file, options=None, source="http", on_finish=None):
+        '''提交一个任务，返回任务记录dict；排队的任务太多时返回None'''
+        with self._lock:
+            if self.pending_count() >= self.max_pending:
+                return None
+            self._seq += 1
+            job_id = "%s_%04d" % (time.strftime("%Y%m%d%H%M%S"), self._seq)
+            job_options = dict(self.default_options)
+            job_options.update(options or {})
+            result_file = os.path.join(self.output_dir, self.result_name(data_file))
+            job = {"job_id": job_id, "data_file": data_file, "source": source, "options": job_options,
+                   "status": "queued", "submitted_at": time.strftime("%Y-%m-%d %H:%M:%S"), "result_files": [],
+                   "compute_seconds": None, "total_seconds": None, "error": None}
+            self.jobs[job_id] = job
+            job["_start"] = time.perf_counter()
+            try:
+                executor = self.executor
+                future = executor.submit(_run_job, self.job_func, data_file, result_file, job_options)
+            except BrokenProcessPool:
+                self._replace_executor(executor)
+                executor = self.executor
+                future = executor.submit(_run_job, self.job_func, data_file, result_file, job_options)
+        future.add_done_callback(lambda done: self._finish(job, done, on_finish, executor))
+        print("收到任务%s【%s】" % (job_id, data_file))
+        return job
+
+    def _finish(self, job, future, on_finish, executor):
+        broken = False
+        with self._lock:
+            try:
+                job["result_files"], job["compute_seconds"] = future.result()
+                job["status"] = "done"
+            except BrokenProcessPool as e:
+                # 进程池里还没算完的任务都会走到这里，都记为失败
+                broken = True
+                job["status"] = "failed"
+                job["error"] = "计算进程异常退出(可能是内存不够)，请重新提交：%s" % e
+            except Exception as e:
+                job["status"] = "failed"
+                job["error"] = "%s: %s" % (type(e).__name__, e)
+            job["total_seconds"] = round(time.perf_counter() - job.pop("_start"), 3)
+            job["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            self._prune_history()
+        if broken:
+            self._replace_executor(executor)
+        if job["status"] == "done":
+            print("任务%s完成，计算%ss，结果见文件【%s】" % (job["job_id"], job["compute_seconds"],
+                                                  "】【".join(job["result_files"])))
+        else:
+            print("任务%s失败【%s】：%s" % (job["job_id"], job["data_file"], job["error"]))
+        if on_finish is not None:
+            try:
+                on_finish(job)
+            except Exception:
+                traceback.print_exc()
+
+    def _prune_history(self):
+        '''已结束的任务超过max_history个时，按提交顺序删掉最早的'''
+        finished = [job_id for job_id, job in self.jobs.items() if job["status"] != "queued"]
+        for job_id in finished[:max(len(finished) - self.max_history, 0)]:
+            del self.jobs[job_id]
+
+    def job_info(self, job_id=None):
+        '''任务记录list；指定的任务号不存在(或者已经从历史里删掉)时返回空list'''
+        with self._lock:
+            if job_id is not None:
+                jobs = [self.jobs[job_id]] if job_id in self.jobs else []
+            else:
+                jobs = list(self.jobs.values())
+            return [dict((key, value) for key, value in job.items() if not key.startswith("_")) for job in jobs]
+
+    # ---------- 监视目录 ----------
+
+    def _finish_watched(self, job):
+        target = DONE_DIR if job["status"] == "done" else FAILED_DIR
+        if os.path.exists(job["data_file"]):
+            _move_into(job["data_file"], os.path.join(self.watch_dir, target), prefix=job["job_id"])
+
+    def scan_watch_dir(self, sizes):
+        '''扫描一次监视目录；sizes记录上次扫描时的文件大小，两次扫描大小一样才认为文件已经复制完成'''
+        for file_path in sorted(glob.glob(os.path.join(self.watch_dir, WATCH_PATTERN))):
+            name = os.path.basename(file_path)
+            if name.startswith("~$"):
+                continue
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                continue
+            if sizes.get(file_path) != size:
+                sizes[file_path] = size
+                continue
+            if self.pending_count() >= self.max_pending:
+                break
+            sizes.pop(file_path)
+            processing_file = _move_into(file_path, os.path.join(self.watch_dir, PROCESSING_DIR))
+            self.submit(processing_file, source="watch", on_finish=self._finish_watched)
+
+    def _watch_loop(self):
+        sizes = {}
+        while not self._stopped.is_set():
+            try:
+                self.scan_watch_dir(sizes)
+            except Exception:
+                traceback.print_exc()
+            self._stopped.wait(self.poll_seconds)
+
+    # ---------- HTTP ----------
+
+    def _save_upload(self, name, body):
+        upload_dir = os.path.join(self.output_dir, UPLOAD_DIR)
+        if not os.path.exists(upload_dir):
+            os.makedirs(upload_dir)
+        file_path = os.path.join(upload_dir, os.path.basename(name))
+        if os.path.exists(file_path):
+            file_path = os.path.join(upload_dir, "%s_%s" % (time.strftime("%Y%m%d_%H_%M_%S"), os.path.basename(name)))
+        with open(file_path, "wb") as f:
+            f.write(body)
+        return file_path
+
+    def _make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlparse(self.path).path.rstrip("/")
+                if path == "/health":
+                    self._reply(200, {"name": service.name, "workers": service.workers,
+                                      "pending": service.pending_count(), "max_pending": service.max_pending})
+                elif path == "/jobs":
+                    self._reply(200, service.job_info())
+                elif path.startswith("/jobs/") and service.job_info(path[len("/jobs/"):]):
+                    self._reply(200, service.job_info(path[len("/jobs/"):])[0])
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path.rstrip("/") != "/jobs":
+                    return self._reply(404, {"error": "not found"})
+                try:
+                    body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                    if self.headers.get("Content-Type", "").startswith("application/json"):
+                        request = json.loads(body.decode("utf-8"))
+                        if not isinstance(request, dict):
+                            raise ValueError("body要是json对象")
+                        data_file, options = request["data_file"], request.get("options") or {}
+                        if not isinstance(data_file, str):
+                            raise ValueError("data_file要是文件路径文字")
+                        if not isinstance(options, dict):
+                            raise ValueError("options要是json对象")
+                        if not os.path.isfile(data_file):
+                            return self._reply(400, {"error": "文件不存在：%s" % data_file})
+                    else:
+                        name = parse_qs(url.query).get("name", ["upload.xlsx"])[0]
+                        data_file, options = service._save_upload(name, body), {}
+                except (ValueError, KeyError) as e:
+                    return self._reply(400, {"error": "请求格式不对：%s" % e})
+                job = service.submit(data_file, options=options, source="http")
+                if job is None:
+                    return self._reply(503, {"error": "排队的任务太多，请稍后再提交"})
+                self._reply(202, service.job_info(job["job_id"])[0])
+
+            def log_message(self, format, *args):
+                # 不打印每个HTTP请求
+                pass
+
+        return Handler
+
+    # ---------- 启动/停止 ----------
+
+    def start(self):
+        '''启动子进程、监视目录和HTTP服务(都在后台线程里)，返回后服务已经可以接收任务'''
+        for path in [self.output_dir, self.watch_dir]:
+            if path and not os.path.exists(path):
+                os.makedirs(path)
+        self._warm_up_workers()
+        if self.watch_dir:
+            self._threads.append(threading.Thread(target=self._watch_loop, name="watch", daemon=True))
+        if self.port is not None:
+            self._server = ThreadingHTTPServer(("127.0.0.1", self.port), self._make_handler())
+            self.port = self._server.server_address[1]
+            self._threads.append(threading.Thread(target=self._server.serve_forever, name="http", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        print("【%s】常驻服务已启动，%s个计算进程，结果输出到【%s】" % (self.name, self.workers, self.output_dir))
+        if self.watch_dir:
+            print("监视目录：【%s】，把文件放进去即可自动计算" % self.watch_dir)
+        if self._server is not None:
+            print("HTTP接口：http://127.0.0.1:%s/jobs" % self.port)
+
+    def _warm_up_workers(self, timeout=WARM_UP_TIMEOUT):
+        '''提交workers个预热任务，等到看到workers个不同的子进程号，即所有子进程都启动并完成了初始化；
+        超时的话不再等，没初始化完的子进程在算第一个任务前初始化
+        '''
+        pids = set()
+        with Manager() as manager:
+            barrier = manager.Barrier(self.workers, timeout=timeout)
+            for future in [self.executor.submit(_warm_up, barrier) for _ in range(self.workers)]:
+                try:
+                    pids.add(future.result())
+                except Exception as e:
+                    print("计算进程预热失败：%s: %s" % (type(e).__name__, e))
+        if len(pids) < self.workers:
+            print("只有%s/%s个计算进程完成了初始化" % (len(pids), self.workers))
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self.executor.shutdown(wait=True)
+
+    def run_forever(self):
+        '''启动服务并一直运行，Ctrl+C停止(等正在计算的任务完成)'''
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("正在停止服务，等待计算中的任务完成...")
+        finally:
+            self.stop()
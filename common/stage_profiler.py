@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+分阶段耗时/内存统计
+
+用法：
+    profiler = StageProfiler("driver_amount_allocator")
+    with profiler.stage("读取派车单") as stage:
+        data = ...
+        stage["rows"] = len(data)
+    profiler.write_report("统计结果_xxx_运行报告")   # 生成 .json 和 .csv 两份报告
+
+每个阶段记录：耗时(秒)、行数、阶段结束时的内存占用(RSS)、进程到目前为止的内存峰值(RSS)；
+trace_memory=True时额外用tracemalloc记录本阶段内python/numpy分配内存的峰值(开销较大，只在排查内存问题时打开)；
+cprofile_file不为空时整个运行过程用cProfile采样，结束时写出.prof文件并打印累计耗时最高的函数。
+"""
+
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import csv
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    # windows没有resource模块
+    resource = None
+
+REPORT_FIELDS = ["stage", "rows", "wall_seconds", "rss_mb", "peak_rss_mb", "alloc_peak_mb"]
+
+
+def current_rss_mb():
+    """当前进程的常驻内存(MB)，取不到时返回None"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024.0 / 1024
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024.0 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    """进程启动以来常驻内存的峰值(MB)，取不到时返回None"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux单位是KB，mac单位是字节
+        return peak / 1024.0 / 1024 if sys.platform == "darwin" else peak / 1024.0
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, "peak_wset", memory_info.rss) / 1024.0 / 1024
+    return None
+
+
+class StageProfiler(object):
+
+    def __init__(self, name, trace_memory=False, cprofile_file=None):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.cprofile_file = cprofile_file
+        self.stages = []
+        self.started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        self._start = time.perf_counter()
+        self._cprofile = None
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile_file:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """记录一个阶段，with块里可以通过stage["rows"]补充行数"""
+        record = {"stage": name, "rows": rows}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = round(time.perf_counter() - start, 4)
+            rss, peak = current_rss_mb(), peak_rss_mb()
+            record["rss_mb"] = _round(rss)
+            # 峰值由内核按页统计，可能比刚取到的当前值略小
+            record["peak_rss_mb"] = _round(max(rss, peak) if rss is not None and peak is not None else peak)
+            record["alloc_peak_mb"] = _round(tracemalloc.get_traced_memory()[1] / 1024.0 / 1024) \
+                if self.trace_memory else None
+            self.stages.append(record)
+
+    def stop(self):
+        """结束cProfile采样，写出.prof文件并打印累计耗时最高的30个函数"""
+        if self._cprofile is None:
+            return
+        import pstats
+        self._cprofile.disable()
+        self._cprofile.dump_stats(self.cprofile_file)
+        pstats.Stats(self._cprofile).sort_stats("cumulative").print_stats(30)
+        self._cprofile = None
+
+    def report(self):
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "total_seconds": round(time.perf_counter() - self._start, 4),
+            "peak_rss_mb": _round(peak_rss_mb()),
+            "stages": self.stages,
+        }
+
+    def print_summary(self):
+        print("%-20s%12s%12s%12s%12s" % ("阶段", "行数", "耗时(秒)", "内存(MB)", "峰值(MB)"))
+        for record in self.stages:
+            print("%-20s%12s%12s%12s%12s" % (record["stage"], _blank(record["rows"]), record["wall_seconds"],
+                                              _blank(record["rss_mb"]), _blank(record["peak_rss_mb"])))
+
+    def write_report(self, path_prefix):
+        """写出 path_prefix.json(含汇总信息) 和 path_prefix.csv(每个阶段一行)，返回两个文件路径"""
+        self.stop()
+        json_file, csv_file = path_prefix + ".json", path_prefix + ".csv"
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        # utf-8-sig让Excel直接打开csv时中文不乱码
+        with open(csv_file, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.stages)
+        return json_file, csv_file
+
+
+def _round(value):
+    return None if value is None else round(value, 1)
+
+
+def _blank(value):
+    return "" if value is None else value
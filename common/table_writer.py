@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+大批量结果写出
+
+pd.ExcelWriter + DataFrame.to_excel会把整个工作簿的单元格都留在内存里，关闭时才一次性写文件；
+几千张发票的开票清单、上百万行的补贴明细写出又慢又占内存。这里：
+    1. xlsx直接用xlsxwriter逐个单元格写，不经过DataFrame.to_excel；大表(补贴明细等)用constant_memory模式，
+       按行从上到下写，每写完一行就落到临时文件，内存占用和行数无关(这个模式下写过的行不能再改)；
+       每个sheet只有几十行、需要合并单元格的发票工作簿不用constant_memory
+    2. 单元格的值和to_excel写出的一致：空值不写，表头、索引不带格式
+    3. 下游系统只要数据时可以输出csv(utf-8-sig，Excel直接打开不乱码)或parquet(需要pyarrow)
+    4. xlsx单个sheet最多EXCEL_MAX_ROWS行(含表头)，超过时写之前就报错，不会只写出前面的行；
+       xlsxwriter写单元格失败只返回负数，不抛异常，这里检查返回值，失败就报错
+"""
+
+from __future__ import unicode_literals
+import math
+import os
+import xlsxwriter
+
+OUTPUT_FORMATS = ("xlsx", "csv", "parquet")
+# Excel单个sheet最多1048576行(含表头)
+EXCEL_MAX_ROWS = 1048576
+
+
+def output_path(result_file, output_format="xlsx", suffix=None):
+    '''统计结果_xxx.xlsx -> 统计结果_xxx[_suffix].<output_format>'''
+    stem = os.path.splitext(result_file)[0]
+    if suffix:
+        stem = "%s_%s" % (stem, suffix)
+    return "%s.%s" % (stem, output_format)
+
+
+def open_workbook(file_path, constant_memory=True):
+    # 数据里"=0"这类文字(如规则的送书重量)按文字写，不当成公式
+    return xlsxwriter.Workbook(file_path, {"constant_memory": constant_memory, "strings_to_formulas": False})
+
+
+def write_row(worksheet, row, values, start_col=0, cell_format=None):
+    '''写一行，空值(None/nan)跳过，numpy标量转成python类型
+    xlsxwriter写失败(超出行列上限、constant_memory下回写已写过的行、文字超过32767个字符被截断)时抛ValueError
+    '''
+    for col, value in enumerate(values, start_col):
+        if hasattr(value, "item"):
+            value = value.item()
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            continue
+        error = worksheet.write(row, col, value, cell_format)
+        if error:
+            raise ValueError("sheet【%s】第%s行第%s列写入失败(xlsxwriter返回%s)：%r"
+                             % (worksheet.get_name(), row + 1, col + 1, error, value))
+
+
+def frame_columns(frame):
+    '''DataFrame每列转成python list(空值转None)，逐行写出时不用再逐个单元格判断类型'''
+    return [column.astype(object).where(column.notna(), None).tolist() for _, column in frame.items()]
+
+
+def check_sheet_rows(sheet_name, row_count):
+    '''row_count行数据加一行表头超过Excel上限时抛ValueError'''
+    if row_count + 1 > EXCEL_MAX_ROWS:
+        raise ValueError("sheet【%s】有%s行数据，加上表头超过了Excel单个sheet的上限%s行，"
+                         "请改用csv或parquet输出(--format csv / --format parquet)" % (sheet_name, row_count, EXCEL_MAX_ROWS))
+
+
+def write_frame(workbook, sheet_name, frame, index=False):
+    '''按to_excel的布局(第一行表头，index=True时第一列为索引)把DataFrame逐行写进新sheet'''
+    check_sheet_rows(sheet_name, len(frame))
+    worksheet = workbook.add_worksheet(sheet_name)
+    header = [str(name) for name in frame.columns]
+    columns = frame_columns(frame)
+    if index:
+        header.insert(0, frame.index.name)
+        columns.insert(0, frame_columns(frame.index.to_frame())[0])
+    write_row(worksheet, 0, header)
+    for row, values in enumerate(zip(*columns), 1):
+        write_row(worksheet, row, values)
+    return worksheet
+
+
+def write_table_file(file_path, frame, output_format, index=False):
+    '''单张表写成csv或parquet'''
+    if output_format == "csv":
+        frame.to_csv(file_path, index=index, encoding="utf-8-sig")
+    elif output_format == "parquet":
+        # 混合了数字和文字的列parquet存不下，统一按文字存
+        frame = frame.copy()
+        for name, column in frame.items():
+            if column.dtype == object:
+                frame[name] = column.astype("str")
+        frame.to_parquet(file_path, index=index)
+    else:
+        raise ValueError("不支持的输出格式：%s，可选：%s" % (output_format, "/".join(OUTPUT_FORMATS)))
+
+
+def write_frames(result_file, sheets, output_format="xlsx"):
+    '''sheets为[(sheet名, DataFrame, 是否写索引)]
+    xlsx时写成一个工作簿；csv/parquet时每个sheet一个文件：统计结果_xxx_<sheet名>.csv
+    返回写出的文件路径list
+    '''
+    if output_format == "xlsx":
+        # 先检查行数再建工作簿，超限时不留下写了一半的文件
+        for sheet_name, frame, _ in sheets:
+            check_sheet_rows(sheet_name, len(frame))
+        file_path = output_path(result_file, "xlsx")
+        workbook = open_workbook(file_path)
+        for sheet_name, frame, index in sheets:
+            write_frame(workbook, sheet_name, frame, index=index)
+        workbook.close()
+        return [file_path]
+
+    files = []
+    for sheet_name, frame, index in sheets:
+        file_path = output_path(result_file, output_format, suffix=sheet_name)
+        write_table_file(file_path, frame, output_format, index=index)
+        files.append(file_path)
+    return files
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+data_filter_deduplicate性能对比：原来按组调用python函数的写法 vs 现在的向量化写法
+用法: python bench_dedup.py [明细行数，默认1000000]
+"""
+
+from __future__ import unicode_literals
+import pandas as pd
+import numpy as np
+import time
+import sys
+
+from driver_amount_allocator import data_filter_deduplicate
+
+
+def legacy_data_filter_deduplicate(data_frame):
+    '''原来的实现，客户名称按组调用python函数，只用来对比结果和耗时'''
+
+    def __select_name(group):
+        if '葫芦娃' in group.values:
+            return '葫芦娃'
+        else:
+            return group.max()
+
+    data_frame = data_frame[data_frame['状态'] == "已审核"]
+    result_tmp = data_frame.groupby('单据号').agg({
+        '状态': 'max',
+        '车牌号': 'max',
+        '客户名称': __select_name,
+        '驾驶员': 'max',
+        '驾驶员2': 'max',
+        '回头车拉货': 'max',
+        '送书重量': 'sum',
+        '跟车员1': 'max',
+        '跟车员2': 'max',
+        '跟车员3': 'max',
+        '跟车员4': 'max',
+        '跟车员5': 'max',
+        '跟车员6': 'max'
+    })
+    return pd.DataFrame(result_tmp).reset_index()
+
+
+def make_bills(row_count, seed=0):
+    '''生成和派车单明细读进来之后(fillna之后)同样结构的数据，平均每张单据3条明细'''
+    rng = np.random.default_rng(seed)
+    bill_count = max(1, row_count // 3)
+    bill = rng.integers(0, bill_count, row_count)
+    people = np.array(["张三", "李四", "王五", "赵六", "钱七", "孙八", "", "", ""], dtype=object)
+    plates = np.array(["琼A 332D3（大）", "琼A 2UU99（大）", "琼A 31B32（小）", "琼A 75G68（小）"], dtype=object)
+    clients = np.array(["海南普利制药股份有限公司", "葫芦娃", "海南葫芦娃药业集团股份有限公司", "本厂", "海南出版社有限公司"], dtype=object)
+
+    def per_bill(choices, low=0):
+        return choices[rng.integers(low, len(choices), bill_count)][bill]
+
+    return pd.DataFrame({
+        "状态": np.where(rng.random(row_count) < 0.01, "未审核", "已审核").astype(object),
+        "单据号": np.char.add("PCD", bill.astype(str)).astype(object),
+        "车牌号": per_bill(plates),
+        "客户名称": clients[rng.integers(0, len(clients), row_count)],
+        "驾驶员": per_bill(people[:6]),
+        "驾驶员2": per_bill(np.array(["0", "", "15109895700"], dtype=object)),
+        "回头车拉货": per_bill(np.array(["", "", "大车", "小车"], dtype=object)),
+        "送书重量": np.round(rng.random(row_count) * 2, 3),
+        "跟车员1": per_bill(people),
+        "跟车员2": per_bill(people),
+        "跟车员3": per_bill(people),
+        "跟车员4": per_bill(people, low=4),
+        "跟车员5": per_bill(people, low=4),
+        "跟车员6": per_bill(people, low=4),
+    })
+
+
+if __name__ == "__main__":
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    bills = make_bills(row_count)
+    # 未审核明细只打印一次，避免刷屏影响计时
+    bills = bills[bills["状态"] == "已审核"].reset_index(drop=True)
+
+    start = time.perf_counter()
+    expected = legacy_data_filter_deduplicate(bills)
+    legacy_cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = data_filter_deduplicate(bills)
+    fast_cost = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(result.astype(object), expected[result.columns].astype(object))
+    print("明细 %s 行，去重后 %s 张单据" % (len(bills), len(result)))
+    print("原实现: %.2fs  向量化: %.2fs  加速 %.1f 倍" % (legacy_cost, fast_cost, legacy_cost / fast_cost))
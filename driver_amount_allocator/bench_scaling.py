@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+补贴计算的分规模性能基准：用模拟数据(synthetic_bills.py)分别在1万/10万/100万/500万行明细上
+对 读取派车单、去重、规则匹配、补贴分摊、写出结果 逐阶段计时
+
+每个规模都做两种结果校验：
+    1. 抽样和原来逐单据、逐条规则循环的实现(legacy_check_*函数 + 逐个角色分摊)对比：去重结果、命中的规则、补贴明细都要一致
+    2. 和基准文件对比：去重结果、命中的规则、补贴明细的摘要必须一致；
+       某个阶段耗时超过基准的(1+threshold)倍且多出min_seconds秒以上，算性能退化
+有结果不一致或性能退化时退出码为1。第一次运行(或改了实现、确认没问题后)用--save-baseline保存基准。
+
+模拟的派车单明细xlsx按规模缓存在work_dir里；超过Excel行数上限(1048576)的规模不生成xlsx，跳过读取阶段，
+直接把模拟数据按读Excel的口径转换后计算；补贴明细超过Excel行数上限时写出parquet。
+
+用法: python bench_scaling.py [--sizes 10000,100000,1000000,5000000] [--save-baseline] [--threshold 0.5]
+"""
+
+from __future__ import unicode_literals
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+
+import driver_amount_allocator as allocator
+from bench_dedup import legacy_data_filter_deduplicate
+from bill_store import bill_row_hash
+from common.stage_profiler import StageProfiler
+from common.table_writer import EXCEL_MAX_ROWS
+from synthetic_bills import (make_drive_bills, make_rules, write_drive_bill_file, write_rule_file, excel_text,
+                             DRIVE_BILL_FILE_COLUMNS)
+
+DEFAULT_SIZES = [10000, 100000, 1000000, 5000000]
+STAGES = ["读取派车单", "去重", "规则匹配", "补贴分摊", "写出结果"]
+ALLOCATION_COLUMNS = ["单据号", "角色", "姓名", "补贴金额"]
+
+
+def frame_digest(frame, columns):
+    return hashlib.sha1(bill_row_hash(frame, columns).tobytes()).hexdigest()[:16]
+
+
+def array_digest(values):
+    return hashlib.sha1(np.ascontiguousarray(values, dtype=np.int64).tobytes()).hexdigest()[:16]
+
+
+def as_read_from_excel(frame):
+    '''模拟数据不经过Excel时，按read_drive_bill的口径转换：只取需要的列，文字列按dtype=str转成文字，再清洗'''
+    data = pd.DataFrame(dict((column, excel_text(frame[column].to_numpy()) if dtype is str else frame[column].astype(dtype))
+                             for column, dtype in allocator.DRIVE_BILL_DTYPE.items()))
+    return allocator._clean_drive_bill(data[allocator.DRIVE_BILL_COLUMNS])
+
+
+# 原来逐条规则判断的写法，只作为legacy_allocate对比结果的参照实现；计算时的规则匹配见rule_index.RuleIndex
+def legacy_check_client_name(rule, name):
+    rule = str(rule).strip()
+    if rule == "":
+        if "葫芦娃" not in str(name):
+            return True
+    elif str(rule) in str(name):
+        return True
+    else:
+        return False
+
+
+def legacy_check_back_car(rule, car):
+    rule = str(rule).strip()
+    if rule == "":
+        if str(car) == "":
+            return True
+    elif str(rule) in str(car):
+        return True
+    else:
+        return False
+
+
+def legacy_check_weight(rule, weight):
+    rule = str(rule).strip()
+
+    if rule == "=0" and float(weight) <= 0:
+        return True
+    elif rule == "<2" and 0 < float(weight) < 2:
+        return True
+    elif rule == ">=2" and float(weight) >= 2:
+        return True
+    else:
+        return False
+
+
+def legacy_check_driver2(rule, driver):
+    '''driver传过来可能是float类型(0.0), 需要做兼容'''
+    try:
+        driver = int(driver)
+    except:
+        pass
+
+    rule = str(rule).strip()
+    if rule == "":
+        if str(driver) == "" or str(driver) == "0":
+            return True
+    elif rule == "有":
+        if str(driver) != "" and str(driver) != "0":
+            return True
+    else:
+        return False
+
+
+def legacy_allocate(bill, rule_list):
+    '''原来的实现：逐条规则检查，第一条命中的规则生效，再按角色逐个分摊；返回(命中的规则下标, 补贴明细list)'''
+    for pos, rule in enumerate(rule_list):
+        if rule["车牌号"] in bill["车牌号"] \
+                and legacy_check_client_name(rule["客户名称"], bill["客户名称"]) \
+                and legacy_check_back_car(rule["回头车拉货"], bill["回头车拉货"]) \
+                and legacy_check_weight(rule["送书重量"], bill["送书重量"]) \
+                and legacy_check_driver2(rule["驾驶员2"], bill["驾驶员2"]):
+            break
+    else:
+        return -1, []
+
+    driver_amount = rule["车牌补贴"] + rule["葫芦娃补贴"] + rule["回头车补贴"] \
+        + float(rule["重量(单价/吨)"]) * float(bill["送书重量"])
+    driver2_amount = float(rule["驾驶员2补贴"])
+    if not bill["单据号"] or not bill["驾驶员"] or not driver_amount:
+        return pos, []
+
+    assistants = [(role, bill[role]) for role in allocator.ALLOCATE_ROLES[:5] if bill[role]]
+    each = np.floor(driver_amount * 100 / (len(assistants) + 1)) / 100
+    result = [(bill["单据号"], role, name, each) for role, name in assistants]
+    result.append((bill["单据号"], "驾驶员", bill["驾驶员"], driver_amount - each * len(assistants)))
+    if bill["驾驶员2"] and driver2_amount > 0:
+        if bill["跟车员6"]:
+            half = np.floor(driver2_amount * 100 / 2) / 100
+            result.append((bill["单据号"], "跟车员6", bill["跟车员6"], half))
+            result.append((bill["单据号"], "驾驶员2", bill["驾驶员2"], driver2_amount - half))
+        else:
+            result.append((bill["单据号"], "驾驶员2", bill["驾驶员2"], driver2_amount))
+    return pos, result
+
+
+def check_sample(drive_bill_raw, drive_bill, rule_index, rule_pos, final_result, sample_size, seed=0):
+    '''抽样和原来的实现对比，返回不一致的说明list'''
+    errors = []
+    rng = np.random.default_rng(seed)
+    picked = np.sort(rng.choice(len(drive_bill), min(sample_size, len(drive_bill)), replace=False))
+    sample = drive_bill.iloc[picked].astype(object).reset_index(drop=True)
+    bill_nos = set(sample["单据号"])
+
+    raw = drive_bill_raw[drive_bill_raw["单据号"].isin(bill_nos) & (drive_bill_raw["状态"] == "已审核")]
+    expected = legacy_data_filter_deduplicate(raw.astype(object)).set_index("单据号")
+    actual = sample.set_index("单据号")
+    for column in allocator.DEDUPLICATE_COLUMNS[1:]:
+        left, right = actual[column], expected.loc[actual.index, column]
+        same = (left.astype(float) - right.astype(float)).abs() < 1e-9 if column == "送书重量" else left == right
+        if not same.all():
+            errors.append("去重结果不一致：%s列，%s张单据" % (column, (~same).sum()))
+
+    expected_rows = []
+    for pos, bill in zip(picked, sample.to_dict(orient="records")):
+        legacy_pos, rows = legacy_allocate(bill, rule_index.rule_list)
+        if legacy_pos != rule_pos[pos]:
+            errors.append("命中规则不一致：单据号%s，原实现%s，现在%s" % (bill["单据号"], legacy_pos, rule_pos[pos]))
+        expected_rows += rows
+    expected_result = pd.DataFrame(expected_rows, columns=ALLOCATION_COLUMNS)
+    actual_result = final_result[final_result["单据号"].isin(bill_nos)].reset_index(drop=True)
+    if len(expected_result) != len(actual_result) \
+            or not (expected_result[ALLOCATION_COLUMNS[:3]].astype(str).to_numpy()
+                    == actual_result[ALLOCATION_COLUMNS[:3]].astype(str).to_numpy()).all() \
+            or not np.allclose(expected_result["补贴金额"].astype(float), actual_result["补贴金额"].astype(float),
+                               atol=1e-6):
+        errors.append("补贴明细不一致：原实现%s行，现在%s行" % (len(expected_result), len(actual_result)))
+    return errors[:20]
+
+
+def run_size(size, rule_index, work_dir, sample_size, seed=0):
+    '''跑一个规模，返回(阶段耗时dict, 结果摘要dict, 抽样校验不一致的说明list, profiler)'''
+    profiler = StageProfiler("scaling_%s" % size)
+    data_file = os.path.join(work_dir, "派车单明细_%s_%s.xlsx" % (size, seed))
+    # 计算过程中的异常提示(未审核单据列表等)不打印，避免刷屏影响计时
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if size < EXCEL_MAX_ROWS:
+            if not os.path.exists(data_file):
+                write_drive_bill_file(data_file, make_drive_bills(size, seed=seed))
+            with profiler.stage("读取派车单") as stage:
+                drive_bill_raw = allocator.read_drive_bill(data_file, use_cache=False)
+                stage["rows"] = len(drive_bill_raw)
+        else:
+            columns = [column for column in DRIVE_BILL_FILE_COLUMNS if column in allocator.DRIVE_BILL_COLUMNS]
+            drive_bill_raw = as_read_from_excel(make_drive_bills(size, seed=seed, columns=columns))
+
+        with profiler.stage("去重") as stage:
+            drive_bill = allocator.data_filter_deduplicate(drive_bill_raw)
+            stage["rows"] = len(drive_bill)
+        with profiler.stage("规则匹配") as stage:
+            rule_pos = rule_index.match(drive_bill)
+            stage["rows"] = int((rule_pos >= 0).sum())
+        with profiler.stage("补贴分摊") as stage:
+            final_result = allocator.allocate(drive_bill, rule_index, rule_pos)
+            stage["rows"] = len(final_result)
+        output_format = "xlsx" if len(final_result) < EXCEL_MAX_ROWS else "parquet"
+        result_file = os.path.join(work_dir, "统计结果_%s.xlsx" % size)
+        allocator.write_result(final_result, result_file, profiler=profiler, output_format=output_format)
+
+    digests = {"去重": frame_digest(drive_bill, allocator.DEDUPLICATE_COLUMNS),
+               "规则匹配": array_digest(rule_pos),
+               "补贴分摊": frame_digest(final_result, ALLOCATION_COLUMNS)}
+    errors = check_sample(drive_bill_raw, drive_bill, rule_index, rule_pos, final_result, sample_size, seed=seed)
+    seconds = dict((record["stage"], record["wall_seconds"]) for record in profiler.stages)
+    return seconds, digests, errors, profiler
+
+
+def compare_baseline(size, seconds, digests, baseline, threshold, min_seconds):
+    '''和基准对比，返回(对比结果的打印行list, 问题说明list)'''
+    lines, problems = [], []
+    for stage, digest in digests.items():
+        if digest != baseline["digests"].get(stage):
+            problems.append("%s行：%s结果和基准不一致" % (size, stage))
+    for stage in STAGES:
+        if stage not in seconds or stage not in baseline["seconds"]:
+            continue
+        base, now = baseline["seconds"][stage], seconds[stage]
+        regressed = now > base * (1 + threshold) and now - base > min_seconds
+        lines.append("%-16s%12.3f%12.3f%+11.0f%% %s" % (stage, base, now, (now / base - 1) * 100 if base else 0,
+                                                         "退化" if regressed else ""))
+        if regressed:
+            problems.append("%s行：%s耗时%.3fs，基准%.3fs" % (size, stage, now, base))
+    return lines, problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="补贴计算分规模性能基准(模拟数据)")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="明细行数，逗号分隔，默认%s" % ",".join(str(size) for size in DEFAULT_SIZES))
+    parser.add_argument("--rules", type=int, default=72, help="规则条数，默认72(和真实规则表一样)")
+    parser.add_argument("--seed", type=int, default=0, help="模拟数据的随机种子")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "driver_amount_allocator_bench"),
+                        help="模拟数据、计算结果和基准文件的目录")
+    parser.add_argument("--baseline", default=None, help="基准文件，默认work_dir/baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基准(覆盖同规模的旧基准)")
+    parser.add_argument("--threshold", type=float, default=0.5, help="耗时超过基准的(1+threshold)倍算退化，默认0.5")
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="耗时比基准多出不到这么多秒时不算退化，默认0.5")
+    parser.add_argument("--sample", type=int, default=2000, help="和原实现对比的抽样单据数，默认2000")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.work_dir):
+        os.makedirs(args.work_dir)
+    baseline_file = args.baseline or os.path.join(args.work_dir, "baseline.json")
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    rule_file = write_rule_file(os.path.join(args.work_dir, "规则场景_%s.xlsx" % args.rules), make_rules(args.rules))
+    rule_index = allocator.load_rules(rule_file, use_cache=False)
+    baseline_key = "rules=%s,seed=%s" % (args.rules, args.seed)
+    problems = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        print("\n===== %s行明细，%s条规则 =====" % (size, len(rule_index)))
+        seconds, digests, errors, profiler = run_size(size, rule_index, args.work_dir, args.sample, seed=args.seed)
+        profiler.print_summary()
+        problems += ["%s行：%s" % (size, error) for error in errors]
+        print("抽样对比原实现：%s" % ("一致" if not errors else "；".join(errors)))
+
+        size_baseline = baseline.get(baseline_key, {}).get(str(size))
+        if args.save_baseline:
+            baseline.setdefault(baseline_key, {})[str(size)] = {"seconds": seconds, "digests": digests}
+        elif size_baseline:
+            lines, size_problems = compare_baseline(size, seconds, digests, size_baseline, args.threshold,
+                                                    args.min_seconds)
+            print("%-16s%12s%12s%12s" % ("阶段", "基准(秒)", "本次(秒)", "变化"))
+            print("\n".join(lines))
+            problems += size_problems
+        else:
+            print("没有%s行的基准，用--save-baseline保存" % size)
+
+    if args.save_baseline:
+        with open(baseline_file, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print("\n基准已保存到【%s】" % baseline_file)
+    if problems:
+        print("\n发现问题：\n%s" % "\n".join(problems))
+        return 1
+    print("\n全部通过")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+按单据号增量计算的本地结果库(sqlite)
+
+每张单据的分摊结果只取决于两样东西：去重合并后的单据内容、命中的那条规则的内容。
+所以按 单据号 + 单据内容hash + 命中规则的内容hash 保存分摊结果，重跑时这三样都没变的单据直接取库里的结果：
+    1. 新增的单据、内容有变化的单据重新匹配、重新分摊
+    2. 规则表没变时，内容没变的单据连匹配都跳过，直接用库里记录的规则下标
+    3. 规则表有变化时，内容没变的单据重新查一次规则索引(按签名查表，代价很小)；
+       只有命中的规则内容变了(改了金额/条件，或者因为增删规则改命中了另一条规则)的单据才重新分摊
+"""
+
+from __future__ import unicode_literals
+import sqlite3
+import pandas as pd
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS bills (
+    单据号 TEXT PRIMARY KEY,
+    row_hash INTEGER NOT NULL,
+    rule_pos INTEGER NOT NULL,
+    rule_version TEXT NOT NULL
+);
+-- 主键(单据号, seq)的索引以单据号开头，按单据号查分摊结果不用另建索引
+CREATE TABLE IF NOT EXISTS allocations (
+    单据号 TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    角色 TEXT NOT NULL,
+    姓名 TEXT NOT NULL,
+    补贴金额 REAL NOT NULL,
+    PRIMARY KEY (单据号, seq)
+);
+-- 本次要查询的单据号，只在当前连接里可见
+CREATE TEMP TABLE IF NOT EXISTS current_bills (
+    单据号 TEXT PRIMARY KEY
+);
+"""
+
+
+def bill_row_hash(drive_bill, columns):
+    """去重后每张单据内容的hash，列值统一转成字符串后计算，和列是不是categorical无关"""
+    frame = pd.DataFrame({col: drive_bill[col].astype(str).to_numpy(dtype=object) for col in columns})
+    # sqlite只能存有符号64位整数
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy().view(np.int64)
+
+
+class AllocationStore(object):
+    """分摊结果库，store_file为sqlite文件路径，不存在时自动创建"""
+
+    def __init__(self, store_file):
+        # 批量模式下多个进程会同时写同一个结果库，写锁被占用时等待而不是直接报错
+        self.conn = sqlite3.connect(store_file, timeout=600)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_current_bills(self, bill_nos):
+        """把要查询的单据号写进临时表，查询时和它join，只按主键取这些单据，不随库里的历史单据变多而变慢
+        查询里用CROSS JOIN固定临时表在外层：临时表没有统计信息，sqlite会为了GROUP BY/ORDER BY的顺序去扫整张历史表
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM current_bills")
+            self.conn.executemany("INSERT OR IGNORE INTO current_bills (单据号) VALUES (?)",
+                                  ((bill_no,) for bill_no in pd.Series(bill_nos, dtype=object).astype(str).tolist()))
+
+    def load_bills(self, bill_nos):
+        """指定单据在库里的记录：单据号、内容hash、规则下标、规则内容hash、分摊结果条数；库里没有的单据不返回"""
+        self._set_current_bills(bill_nos)
+        return pd.read_sql_query(
+            "SELECT b.单据号, b.row_hash, b.rule_pos, b.rule_version, COUNT(a.seq) AS allocation_count "
+            "FROM current_bills c CROSS JOIN bills b ON b.单据号 = c.单据号 LEFT JOIN allocations a ON a.单据号 = b.单据号 "
+            "GROUP BY b.单据号", self.conn)
+
+    def load_allocations(self, bill_nos):
+        """取指定单据的分摊结果，按单据号、单据内顺序返回"""
+        self._set_current_bills(bill_nos)
+        return pd.read_sql_query(
+            "SELECT a.单据号, a.seq, a.角色, a.姓名, a.补贴金额 "
+            "FROM current_bills c CROSS JOIN allocations a ON a.单据号 = c.单据号 ORDER BY a.单据号, a.seq", self.conn)
+
+    def save(self, bills, reallocated_bill_nos, allocations, rule_sheet_version):
+        """保存本次计算的结果
+        bills: 需要更新记录的单据，包含单据号/row_hash/rule_pos/rule_version
+        reallocated_bill_nos: 重新分摊过的单据号，这些单据库里原有的分摊结果整体替换成allocations
+        """
+        bill_nos = [(bill_no,) for bill_no in pd.Series(reallocated_bill_nos, dtype=object).astype(str).tolist()]
+        seq = allocations.groupby("单据号", sort=False).cumcount()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO bills (单据号, row_hash, rule_pos, rule_version) VALUES (?, ?, ?, ?)",
+                zip(bills["单据号"].astype(str).tolist(), bills["row_hash"].tolist(), bills["rule_pos"].tolist(),
+                    bills["rule_version"].tolist()))
+            self.conn.executemany("DELETE FROM allocations WHERE 单据号 = ?", bill_nos)
+            self.conn.executemany(
+                "INSERT INTO allocations (单据号, seq, 角色, 姓名, 补贴金额) VALUES (?, ?, ?, ?, ?)",
+                zip(allocations["单据号"].astype(str).tolist(), seq.tolist(), allocations["角色"].tolist(),
+                    allocations["姓名"].astype(str).tolist(), allocations["补贴金额"].astype(float).tolist()))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rule_sheet_version', ?)",
+                              (rule_sheet_version,))
@@ -2,145 +2,117 @@
 from __future__ import unicode_literals
 import pandas as pd
 import numpy as np
-import math
 import time
 import os
 import sys
-import traceback
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(dir)
+sys.path.append(os.path.dirname(dir))
 
+from rule_index import RuleIndex
+from bill_store import AllocationStore, bill_row_hash
+from match_diagnostics import diagnose_unmatched
+from subsidy_cube import bill_periods, check_pyarrow, update_cube
+from common.excel_cache import read_excel_cached
+from common.excel_reader import ColumnFilter, fillna_text
+from common.excel_stream import read_excel_filtered
+from common.job_service import JobService
+from common.stage_profiler import StageProfiler
+from common.table_writer import OUTPUT_FORMATS, write_frames
 
-def check_client_name(rule, name):
-    rule = str(rule).strip()
-    if rule == "":
-        if "葫芦娃" not in str(name):
-            return True
-    elif str(rule) in str(name):
-        return True
-    else:
-        return False
-
-
-def check_back_car(rule, car):
-    rule = str(rule).strip()
-    if rule == "":
-        if str(car) == "":
-            return True
-    elif str(rule) in str(car):
-        return True
-    else:
-        return False
 
+# 补贴明细里各角色的输出顺序：跟车员1-5、驾驶员、跟车员6、驾驶员2
+ALLOCATE_ROLES = ["跟车员1", "跟车员2", "跟车员3", "跟车员4", "跟车员5", "驾驶员", "跟车员6", "驾驶员2"]
+# 驾驶员拿剩余金额时保留的小数位，只用来消掉浮点误差；重量*单价最多到厘以下几位，不会被截断
+AMOUNT_DECIMALS = 6
 
-def check_weight(rule, weight):
-    rule = str(rule).strip()
 
-    if rule == "=0" and float(weight) <= 0:
-        return True
-    elif rule == "<2" and 0 < float(weight) < 2:
-        return True
-    elif rule == ">=2" and float(weight) >= 2:
-        return True
-    else:
-        return False
+def _truthy(values):
+    '''逐个按python的真假判断，空字符串/None为False，和原来的if assis1:口径一致'''
+    return np.asarray(values, dtype=object).astype(bool)
 
 
-def check_driver2(rule, driver):
-    '''driver传过来可能是float类型(0.0), 需要做兼容'''
-    try:
-        driver = int(driver)
-    except:
-        pass
-
-    rule = str(rule).strip()
-    if rule == "":
-        if str(driver) == "" or str(driver) == "0":
-            return True
-    elif rule == "有":
-        if str(driver) != "" and str(driver) != "0":
-            return True
-    else:
-        return False
+def allocation_matrix(named, valid, driver_amount, driver2_amount):
+    '''分摊的数值计算，不打印异常信息：named为单据x角色(ALLOCATE_ROLES)的姓名是否非空，valid为参与分摊的单据
+    返回(present, amounts)，present[i, j]为第i张单据的第j个角色是否分到补贴，amounts[i, j]为分到的金额
+    '''
+    present = named.copy()
+    has_driver2 = present[:, 7] & (driver2_amount > 0)
+    present[:, 5] = True
+    present[:, 6] &= has_driver2
+    present[:, 7] = has_driver2
+    present &= valid[:, None]
+
+    # 按分计算：跟车员每人floor(总额*100/人数)分，驾驶员拿剩下的
+    head_count = present[:, :5].sum(axis=1) + 1
+    driver_cents = driver_amount * 100
+    each_cents = np.floor(driver_cents / head_count)
+    driver2_cents = driver2_amount * 100
+    half_cents = np.floor(driver2_cents / 2)
+
+    amounts = np.empty(named.shape, dtype=float)
+    amounts[:, :5] = (each_cents / 100)[:, None]
+    amounts[:, 5] = np.round((driver_cents - each_cents * (head_count - 1)) / 100, AMOUNT_DECIMALS)
+    amounts[:, 6] = half_cents / 100
+    amounts[:, 7] = np.where(present[:, 6], np.round((driver2_cents - half_cents) / 100, AMOUNT_DECIMALS), driver2_amount)
+    return present, amounts
+
+
+def amount_allocate_batch(drive_bill, driver_amount, driver2_amount):
+    '''整批分摊补贴，直接生成补贴明细表
+    drive_bill为去重后的单据，driver_amount/driver2_amount为和drive_bill逐行对应的补贴总额
+
+    1. 驾驶员+跟车员1-5平摊driver_amount，除不尽的向下取整保留两位小数(按分计算)；总金额减掉跟车员已分摊的金额分给驾驶员，避免总补贴和按人加总对不上
+    2. 驾驶员2非空且driver2_amount>0时，有跟车员6则两人平摊(跟车员6向下取整到分)，否则全部给驾驶员2
+    3. 单据号/驾驶员为空、补贴金额=0的单据打印异常信息后跳过
+    '''
+    bill_no = drive_bill["单据号"].to_numpy(dtype=object)
+    driver_amount = np.asarray(driver_amount, dtype=float)
+    driver2_amount = np.asarray(driver2_amount, dtype=float)
+
+    # 参数非空校验，异常单据按原顺序打印
+    empty_bill = ~_truthy(bill_no) | ~_truthy(drive_bill["驾驶员"])
+    zero_amount = ~empty_bill & (driver_amount == 0)
+    for pos in np.flatnonzero(empty_bill | zero_amount):
+        if empty_bill[pos]:
+            print("Excel内容异常：单据号/驾驶员不能为空！")
+        else:
+            print("Excel内容异常：请检查单据号【%s】的场景是否存在，当前场景计算出的补贴金额=0！" % bill_no[pos])
+    valid = ~(empty_bill | zero_amount)
+
+    names = drive_bill[ALLOCATE_ROLES].to_numpy(dtype=object)
+    present, amounts = allocation_matrix(_truthy(names), valid, driver_amount, driver2_amount)
+
+    # 行优先展开，保持单据顺序以及单据内的角色顺序
+    rows, cols = np.nonzero(present)
+    return pd.DataFrame({
+        "单据号": bill_no[rows],
+        "角色": np.array(ALLOCATE_ROLES, dtype=object)[cols],
+        "姓名": names[rows, cols],
+        "补贴金额": amounts[rows, cols],
+    })
 
 
-def amount_allocate(bill_no, driver_amount, driver2_amount, driver, driver2=None, assis1=None, assis2=None,
-                    assis3=None, assis4=None, assis5=None, assis6=None):
-    # 参数类型/非空校验
-    if not bill_no or not driver:
-        raise ValueError("Excel内容异常：单据号/驾驶员不能为空！")
+# 去重后取max的列，值大量重复(车牌号、客户名称、人名等)，转成有序的categorical后group by只比较整数code
+DEDUPLICATE_MAX_COLUMNS = ["状态", "车牌号", "客户名称", "驾驶员", "驾驶员2", "回头车拉货",
+                           "跟车员1", "跟车员2", "跟车员3", "跟车员4", "跟车员5", "跟车员6"]
+DEDUPLICATE_COLUMNS = ["单据号", "状态", "车牌号", "客户名称", "驾驶员", "驾驶员2", "回头车拉货", "送书重量",
+                       "跟车员1", "跟车员2", "跟车员3", "跟车员4", "跟车员5", "跟车员6"]
 
-    if not driver_amount:
-        raise ValueError("Excel内容异常：请检查单据号【%s】的场景是否存在，当前场景计算出的补贴金额=0！" % bill_no)
 
-    try:
-        driver_amount = float(driver_amount)
-        driver2_amount = float(driver2_amount)
-    except:
-        raise TypeError("Error input(bill_no %s): driver_amount or driver2_amount should be decimal!" % bill_no)
-
-    driver_allocate_roles = {}
-    if driver:
-        driver_allocate_roles["驾驶员"] = driver
-    if assis1:
-        driver_allocate_roles["跟车员1"] = assis1
-    if assis2:
-        driver_allocate_roles["跟车员2"] = assis2
-    if assis3:
-        driver_allocate_roles["跟车员3"] = assis3
-    if assis4:
-        driver_allocate_roles["跟车员4"] = assis4
-    if assis5:
-        driver_allocate_roles["跟车员5"] = assis5
-
-    allocate_result = []
-    # 计算平摊的金额，除不尽的向下取整保留两位小数；最后用总金额减掉已分摊金额分给driver，避免总补贴和按人加总对不上
-    driver_amount_each = math.floor(driver_amount * 100 / len(driver_allocate_roles)) / 100
-    # 先处理跟车员1-5的补贴
-    driver_allocated_amount = 0
-    for k, v in driver_allocate_roles.items():
-        if k != "驾驶员":
-            tmp = {
-                "单据号": bill_no,
-                "角色": k,
-                "姓名": v,
-                "补贴金额": driver_amount_each,
-            }
-            allocate_result.append(tmp)
-            driver_allocated_amount += driver_amount_each
-    # 最后拿总补贴-分给跟车员的补贴，分给驾驶员
-    allocate_result.append({
-        "单据号": bill_no,
-        "角色": "驾驶员",
-        "姓名": driver,
-        "补贴金额": driver_amount - driver_allocated_amount
-    })
+def print_unaudited(data_frame):
+    if len(data_frame):
+        tmp_res = data_frame[["单据号", "状态"]]
+        print("Excel内容异常：如下单据号非【已审核】，补贴金额统计为0！\n%s" % tmp_res.to_string(index=False))  # 打印时去掉最左侧的默认索引0123
 
-    # 当驾驶员2非空且补贴金额>0时，计算驾驶员2的平摊金额
-    if driver2 and driver2_amount > 0:
-        if assis6:
-            allocate_result.append({
-                "单据号": bill_no,
-                "角色": "跟车员6",
-                "姓名": assis6,
-                "补贴金额": math.floor(driver2_amount * 100 / 2) / 100
-            })
-            allocate_result.append({
-                "单据号": bill_no,
-                "角色": "驾驶员2",
-                "姓名": driver2,
-                "补贴金额": driver2_amount - math.floor(driver2_amount * 100 / 2) / 100
-            })
-        else:
-            allocate_result.append({
-                "单据号": bill_no,
-                "角色": "驾驶员2",
-                "姓名": driver2,
-                "补贴金额": driver2_amount
-            })
 
-    return allocate_result
+def _to_ordered_category(series):
+    '''类别按字符串大小排序，保证categorical的max和原字符串的max结果一致'''
+    return pd.Categorical(series, categories=sorted(series.unique()), ordered=True)
 
 
 def data_filter_deduplicate(data_frame):
@@ -149,120 +121,448 @@ def data_filter_deduplicate(data_frame):
     b. 重量需要按多条明细的总和计算
     c. 其他列默认一张单据号只会有一个记录，默认group by后取max
     d. 过滤掉状态为未审核的记录，并打印出来
+    全部用group by内置的聚合实现，不逐组调用python函数；列缺失等异常直接抛出，不再返回未去重的数据
     '''
+    # 过滤掉状态为未审核的记录，并打印出来
+    unaudited = data_frame['状态'] != "已审核"
+    print_unaudited(data_frame[unaudited])
+    data_frame = data_frame[~unaudited]
 
-    def __select_name(group):
-        if '葫芦娃' in group.values:
-            return '葫芦娃'
-        else:
-            return group.max()
+    frame = pd.DataFrame({col: _to_ordered_category(data_frame[col]) for col in DEDUPLICATE_MAX_COLUMNS})
+    frame["单据号"] = data_frame["单据号"].to_numpy()
+    frame["是葫芦娃"] = (data_frame["客户名称"] == "葫芦娃").to_numpy()
+    frame["送书重量"] = data_frame["送书重量"].to_numpy()
 
-    try:
-        # 过滤掉状态为未审核的记录，并打印出来
-        filter = data_frame['状态'] != "已审核"
-        if len(data_frame[filter]):
-            tmp_res = data_frame[filter][["单据号", "状态"]]
-            print("Excel内容异常：如下单据号非【已审核】，补贴金额统计为0！\n%s" % tmp_res.to_string(index=False))  # 打印时去掉最左侧的默认索引0123
-        data_frame = data_frame[data_frame['状态'] == "已审核"]
-
-        # 按单据号group by, 重量取sum, 其他字段取max
-        result_tmp = data_frame.groupby('单据号').agg({
-            '状态': 'max',
-            '车牌号': 'max',
-            '客户名称': __select_name,
-            '驾驶员': 'max',
-            '驾驶员2': 'max',
-            '回头车拉货': 'max',
-            '送书重量': 'sum',
-            '跟车员1': 'max',
-            '跟车员2': 'max',
-            '跟车员3': 'max',
-            '跟车员4': 'max',
-            '跟车员5': 'max',
-            '跟车员6': 'max'
-        })
-        data_frame = pd.DataFrame(result_tmp).reset_index()
-
-    except:
-        print("Something error: ", traceback.format_exc())
-    finally:
-        return data_frame
+    # 按单据号group by, 重量取sum, 其他字段取max; 客户名称只要有一条是葫芦娃就按葫芦娃统计
+    grouped = frame.groupby("单据号")
+    result = grouped[DEDUPLICATE_MAX_COLUMNS].max()
+    result["送书重量"] = grouped["送书重量"].sum()
+    result["客户名称"] = result["客户名称"].astype(object).where(~grouped["是葫芦娃"].any(), "葫芦娃")
 
+    return result.reset_index()[DEDUPLICATE_COLUMNS]
 
-def main(rule_file, data_file, result_file):
-    # 默认读第一个sheet, header=3代表从第4行开始读, 只读A-J列，4-76行; 为空时指定字段用""填充，其他字段为空用0填充；最后转成key:value list
-    rule_list = pd.read_excel(rule_file, header=3, usecols="A:J", nrows=72,
-                              dtype={"车牌号": str, "客户名称": str, "驾驶员2": str, "送书重量": str, "回头车拉货": str}
-                              ).fillna({"车牌号": "", "客户名称": "", "驾驶员2": "", "送书重量": "", "回头车拉货": ""}) \
+
+def load_rules(rule_file, use_cache=True):
+    '''读规则表并编译成索引
+    默认读第一个sheet, header=3代表从第4行开始读, 只读A-J列, 行数以表格实际内容为准(整行匹配条件为空的行忽略);
+    为空时指定字段用""填充，其他字段为空用0填充；最后转成key:value list
+    '''
+    rule_list = read_excel_cached(rule_file, use_cache=use_cache, header=3, usecols="A:J",
+                                  dtype={"车牌号": str, "客户名称": str, "驾驶员2": str, "送书重量": str, "回头车拉货": str}
+                                  ).dropna(how="all", subset=["车牌号", "客户名称", "驾驶员2", "回头车拉货", "送书重量"]) \
+        .fillna({"车牌号": "", "客户名称": "", "驾驶员2": "", "送书重量": "", "回头车拉货": ""}) \
         .fillna(0) \
         .to_dict(orient="records")
 
-    drive_bill_raw = pd.read_excel(data_file,
-                                   usecols=["状态", "单据号", "车牌号", "客户名称", "驾驶员", "驾驶员2", "送书重量", "回头车拉货",
-                                            "跟车员1", "跟车员2", "跟车员3", "跟车员4", "跟车员5", "跟车员6"],
-                                   dtype={"状态": str, "单据号": str, "车牌号": str, "客户名称": str, "驾驶员": str, "驾驶员2": str, "送书重量": float, "回头车拉货": str,
-                                          "跟车员1": str, "跟车员2": str, "跟车员3": str, "跟车员4": str, "跟车员5": str, "跟车员6": str}
-                                   ).dropna(subset=["车牌号"]).fillna({"送书重量": 0}).fillna("")
-
-    drive_bill = data_filter_deduplicate(data_frame=drive_bill_raw).to_dict(orient="records")
-
-    final_result_list = []
-    for data in drive_bill:
-        fail_num = 0
-        for rule in rule_list:
-            # print(fail_num, check_client_name(rule["客户名称"], data["客户名称"]),check_back_car(rule["回头车拉货"], data["回头车拉货"]),check_weight(rule["送书重量"], data["送书重量"]),check_driver2(rule["驾驶员2"], data["驾驶员2"]))
-            if rule["车牌号"] in data["车牌号"] \
-                    and check_client_name(rule["客户名称"], data["客户名称"]) \
-                    and check_back_car(rule["回头车拉货"], data["回头车拉货"]) \
-                    and check_weight(rule["送书重量"], data["送书重量"]) \
-                    and check_driver2(rule["驾驶员2"], data["驾驶员2"]):
-
-                total_driver_amount = rule["车牌补贴"] + rule["葫芦娃补贴"] + rule["回头车补贴"] + float(rule["重量(单价/吨)"]) * float(
-                    data["送书重量"])
-                total_driver2_amount = rule["驾驶员2补贴"]
-
-                try:
-                    single_record_result = amount_allocate(bill_no=data["单据号"],
-                                                           driver_amount=total_driver_amount,
-                                                           driver2_amount=total_driver2_amount,
-                                                           driver=data["驾驶员"],
-                                                           driver2=data["驾驶员2"],
-                                                           assis1=data["跟车员1"],
-                                                           assis2=data["跟车员2"],
-                                                           assis3=data["跟车员3"],
-                                                           assis4=data["跟车员4"],
-                                                           assis5=data["跟车员5"],
-                                                           assis6=data["跟车员6"]
-                                                           )
-                except Exception as e:
-                    print(e)
-                else:
-                    final_result_list += single_record_result
-                finally:
-                    break
-            else:
-                fail_num += 1
-            if fail_num >= 72:
-                # if 6<=fail_num <= 7:
-                print("-----fail, scenario does not exist----", fail_num)
-                print(data)
-                print("-----fail----")
-
-    final_result = pd.DataFrame(final_result_list)
-    grouped = final_result.groupby("姓名").agg({"补贴金额": "sum"})
-
-    with pd.ExcelWriter(result_file) as writer:
-        final_result.to_excel(writer, sheet_name='补贴明细', index=False)
-        grouped.to_excel(writer, sheet_name='金额合计')
+    return RuleIndex(rule_list)
 
 
-if __name__ == "__main__":
+DRIVE_BILL_COLUMNS = ["状态", "单据号", "车牌号", "客户名称", "驾驶员", "驾驶员2", "送书重量", "回头车拉货",
+                      "跟车员1", "跟车员2", "跟车员3", "跟车员4", "跟车员5", "跟车员6"]
+DRIVE_BILL_DTYPE = {"状态": str, "单据号": str, "车牌号": str, "客户名称": str, "驾驶员": str, "驾驶员2": str, "送书重量": float, "回头车拉货": str,
+                    "跟车员1": str, "跟车员2": str, "跟车员3": str, "跟车员4": str, "跟车员5": str, "跟车员6": str}
+# 补贴汇总立方体按制单日期分期间，只在更新立方体时读取，文件里没有这一列时期间为空
+PERIOD_COLUMN = "制单日期"
+
+
+def _clean_drive_bill(data_frame):
+    # 车牌号为空的明细丢掉，重量为空按0算，其他字段为空用""填充(categorical列也可以)
+    missing = [col for col in DRIVE_BILL_COLUMNS if col not in data_frame.columns]
+    if missing:
+        raise ValueError("派车单明细缺少列：%s" % "、".join(missing))
+    return fillna_text(data_frame.dropna(subset=["车牌号"]).fillna({"送书重量": 0}))
+
+
+def _split_unaudited(data_frame):
+    '''拆成(已审核的明细, 非已审核明细的单据号和状态)'''
+    unaudited = data_frame["状态"] != "已审核"
+    return data_frame[~unaudited], data_frame.loc[unaudited, ["单据号", "状态"]]
+
+
+def drive_bill_columns(with_period=False):
+    '''要读取的列(usecols)和dtype；with_period=True时usecols为判断函数，表头里有制单日期就一起读，没有时不报错，
+    不用为了看表头先把文件打开一遍；必读的列是否齐全由_clean_drive_bill检查
+    '''
+    if not with_period:
+        return DRIVE_BILL_COLUMNS, DRIVE_BILL_DTYPE
+    return ColumnFilter(DRIVE_BILL_COLUMNS + [PERIOD_COLUMN]), dict(DRIVE_BILL_DTYPE, **{PERIOD_COLUMN: str})
+
+
+def read_drive_bill(data_file, use_cache=True, streaming=False, with_period=False):
+    '''读派车单明细
+    streaming=False时未审核的明细也保留(data_filter_deduplicate里过滤并打印)；
+    streaming=True时同read_audited_drive_bill，只返回已审核的明细
+    两种读法重复值多的文字列(DEDUPLICATE_MAX_COLUMNS)都转成categorical
+    with_period=True时文件里有制单日期就一起读出来(更新补贴汇总立方体用)
+    '''
+    if streaming:
+        return read_audited_drive_bill(data_file, streaming=True, with_period=with_period)[0]
+    usecols, dtype = drive_bill_columns(with_period=with_period)
+    return _clean_drive_bill(read_excel_cached(data_file, use_cache=use_cache, usecols=usecols, dtype=dtype,
+                                               category_columns=DEDUPLICATE_MAX_COLUMNS))
+
+
+def read_audited_drive_bill(data_file, use_cache=True, streaming=False, with_period=False):
+    '''读派车单明细并过滤掉未审核的明细，返回(已审核的明细, 非已审核明细的单据号和状态)，非已审核的单据读完后统一打印
+    两种读法返回的结果相同：streaming=False时读完再过滤；streaming=True时分块流式读取，每块读出来就清洗、过滤，
+    内存占用只和过滤后的数据量有关，流式读取不使用解析缓存
+    '''
+    if not streaming:
+        drive_bill_raw, unaudited = _split_unaudited(read_drive_bill(data_file, use_cache=use_cache,
+                                                                     with_period=with_period))
+        print_unaudited(unaudited)
+        return drive_bill_raw, unaudited
+
+    usecols, dtype = drive_bill_columns(with_period=with_period)
+    unaudited_list = []
+
+    def audited_only(chunk):
+        chunk, unaudited = _split_unaudited(_clean_drive_bill(chunk))
+        unaudited_list.append(unaudited)
+        return chunk
+
+    drive_bill_raw = read_excel_filtered(data_file, chunk_filter=audited_only,
+                                         category_columns=DEDUPLICATE_MAX_COLUMNS,
+                                         usecols=usecols, dtype=dtype)
+    unaudited = pd.concat(unaudited_list) if unaudited_list else pd.DataFrame(columns=["单据号", "状态"])
+    print_unaudited(unaudited)
+    return drive_bill_raw, unaudited
+
+
+def allocate(drive_bill, rule_index, rule_pos):
+    '''按命中的规则整批计算补贴总额并分摊，没命中规则(rule_pos=-1)的单据不参与分摊；返回补贴明细'''
+    matched_bill = drive_bill[rule_pos >= 0].reset_index(drop=True)
+    matched_rule = pd.DataFrame(rule_index.rule_list).iloc[rule_pos[rule_pos >= 0]]
+    total_driver_amount = matched_rule["车牌补贴"].to_numpy(dtype=float) + matched_rule["葫芦娃补贴"].to_numpy(dtype=float) \
+        + matched_rule["回头车补贴"].to_numpy(dtype=float) \
+        + matched_rule["重量(单价/吨)"].to_numpy(dtype=float) * matched_bill["送书重量"].to_numpy(dtype=float)
+    total_driver2_amount = matched_rule["驾驶员2补贴"].to_numpy(dtype=float)
+
+    return amount_allocate_batch(matched_bill, total_driver_amount, total_driver2_amount)
+
+
+def allocate_incremental(drive_bill, rule_index, store_file):
+    '''增量计算：单据内容和命中规则的内容都没变的单据直接取结果库里的分摊结果，其余单据重新匹配、分摊后写回结果库
+    返回(补贴明细, rule_pos)，补贴明细的顺序和全量计算一致
+    '''
+    store = AllocationStore(store_file)
+    try:
+        row_hash = bill_row_hash(drive_bill, DEDUPLICATE_COLUMNS)
+        stored = store.load_bills(drive_bill["单据号"]).astype({"row_hash": "Int64", "rule_pos": "Int64"}) \
+            .set_index("单据号").reindex(drive_bill["单据号"])
+        same_row = stored["row_hash"].eq(row_hash).fillna(False).to_numpy(dtype=bool)
+
+        if store.get_meta("rule_sheet_version") == rule_index.version:
+            # 规则表没变，内容没变的单据沿用上次的匹配结果，只匹配新增/有变化的单据
+            rule_pos = stored["rule_pos"].fillna(-1).to_numpy(dtype=np.int64)
+            rule_pos[~same_row] = rule_index.match(drive_bill[~same_row])
+        else:
+            rule_pos = rule_index.match(drive_bill)
+
+        rule_versions = np.array(rule_index.rule_versions + [""], dtype=object)
+        bill_rule_version = rule_versions[rule_pos]
+        fresh = same_row \
+            & (stored["rule_version"].to_numpy(dtype=object) == bill_rule_version) \
+            & ((rule_pos < 0) | (stored["allocation_count"].fillna(0).to_numpy() > 0))
+
+        stale_bill = drive_bill[~fresh].reset_index(drop=True)
+        new_result = allocate(stale_bill, rule_index, rule_pos[~fresh])
+        cached_result = store.load_allocations(drive_bill["单据号"][fresh])
+        # 规则有增删时，沿用结果的单据命中的规则下标也可能变了，一并更新
+        changed = ~fresh | (stored["rule_pos"].fillna(-2).to_numpy(dtype=np.int64) != rule_pos)
+        store.save(pd.DataFrame({"单据号": drive_bill["单据号"][changed], "row_hash": row_hash[changed],
+                                 "rule_pos": rule_pos[changed], "rule_version": bill_rule_version[changed]}),
+                   stale_bill["单据号"], new_result, rule_index.version)
+    finally:
+        store.close()
+
+    print("增量计算：共%s张单据，沿用上次结果%s张，重新计算%s张" % (len(drive_bill), fresh.sum(), len(stale_bill)))
+
+    # 按单据顺序、单据内角色顺序合并沿用的结果和重新计算的结果
+    new_result = new_result.assign(seq=new_result.groupby("单据号", sort=False).cumcount())
+    bill_order = pd.Series(np.arange(len(drive_bill)), index=drive_bill["单据号"].to_numpy())
+    final_result = pd.concat([cached_result, new_result], ignore_index=True)
+    final_result = final_result.iloc[np.lexsort((final_result["seq"].to_numpy(),
+                                                 bill_order.reindex(final_result["单据号"]).to_numpy()))]
+    return final_result.drop(columns="seq").reset_index(drop=True), rule_pos
+
+
+def process_file(rule_index, data_file, use_cache=True, streaming=False, store_file=None, profiler=None,
+                 cube_dir=None):
+    '''用编译好的规则索引计算一个派车单明细文件，返回(补贴明细, 没命中规则的单据诊断表)
+    profiler不为空时记录每个阶段的耗时、内存和行数；cube_dir不为空时把分摊结果合并进补贴汇总立方体(见subsidy_cube.py)
+    '''
+    profiler = profiler or StageProfiler("driver_amount_allocator")
+    if cube_dir:
+        check_pyarrow()
+    with profiler.stage("读取派车单") as stage:
+        # 只保留已审核的明细，两种读法去重、分摊以及立方体替换的单据都相同
+        drive_bill_raw, unaudited = read_audited_drive_bill(data_file, use_cache=use_cache, streaming=streaming,
+                                                            with_period=bool(cube_dir))
+        stage["rows"] = len(drive_bill_raw)
+
+    with profiler.stage("去重") as stage:
+        drive_bill = data_filter_deduplicate(data_frame=drive_bill_raw)
+        stage["rows"] = len(drive_bill)
+    if store_file:
+        with profiler.stage("增量匹配和分摊") as stage:
+            final_result, rule_pos = allocate_incremental(drive_bill, rule_index, store_file)
+            stage["rows"] = len(final_result)
+    else:
+        with profiler.stage("规则匹配") as stage:
+            # 整批匹配，rule_pos[i]为第i张单据命中的第一条规则下标，-1代表没有命中任何规则
+            rule_pos = rule_index.match(drive_bill)
+            stage["rows"] = int((rule_pos >= 0).sum())
+        with profiler.stage("补贴分摊") as stage:
+            final_result = allocate(drive_bill, rule_index, rule_pos)
+            stage["rows"] = len(final_result)
+    with profiler.stage("未匹配诊断") as stage:
+        unmatched = diagnose_unmatched(drive_bill, rule_index.rule_list, rule_pos)
+        stage["rows"] = len(unmatched)
+    if len(unmatched):
+        print("Excel内容异常：%s张单据没有匹配到规则场景，补贴金额统计为0！未通过的条件见计算结果的【未匹配单据】"
+              % len(unmatched))
+    if cube_dir:
+        with profiler.stage("更新汇总立方体", rows=len(final_result)):
+            bill_count, replaced_count, removed_count = update_cube(
+                cube_dir, drive_bill, final_result, rule_pos, rule_index.rule_list, bill_periods(drive_bill_raw),
+                unaudited["单据号"])
+        print("补贴汇总立方体【%s】：本次%s张单据，其中%s张之前汇总过，已替换为本次的结果" % (cube_dir, bill_count, replaced_count))
+        if removed_count:
+            print("补贴汇总立方体【%s】：%s张之前汇总过的单据本次为非已审核，已从立方体里去掉" % (cube_dir, removed_count))
+    return final_result, unmatched
+
+
+def write_result(final_result, result_file, profiler=None, output_format="xlsx", unmatched=None):
+    '''补贴明细逐行直接写出(不经过pd.ExcelWriter)；output_format为csv/parquet时补贴明细、金额合计各写一个文件
+    unmatched(没命中规则的单据诊断表)不为空时多写一张【未匹配单据】
+    返回写出的文件路径list
+    '''
+    profiler = profiler or StageProfiler("driver_amount_allocator")
+    with profiler.stage("写出结果", rows=len(final_result)):
+        grouped = final_result.groupby("姓名").agg({"补贴金额": "sum"})
+        sheets = [('补贴明细', final_result, False), ('金额合计', grouped, True)]
+        if unmatched is not None and len(unmatched):
+            sheets.append(('未匹配单据', unmatched, False))
+        return write_frames(result_file, sheets, output_format=output_format)
+
+
+def report_prefix(result_file):
+    '''运行报告和计算结果放在一起：统计结果_xxx.xlsx -> 统计结果_xxx_运行报告.json/.csv'''
+    return os.path.splitext(result_file)[0] + "_运行报告"
+
+
+def main(rule_file, data_file, result_file, use_cache=True, streaming=False, store_file=None, profiler=None,
+         output_format="xlsx", cube_dir=None):
+    '''store_file为增量计算的结果库路径，为None时全量计算；profiler不为空时记录每个阶段的耗时、内存和行数
+    cube_dir不为空时同时更新补贴汇总立方体；返回写出的结果文件路径list
+    '''
+    profiler = profiler or StageProfiler("driver_amount_allocator")
+    with profiler.stage("读取规则") as stage:
+        rule_index = load_rules(rule_file, use_cache=use_cache)
+        stage["rows"] = len(rule_index)
+    final_result, unmatched = process_file(rule_index, data_file, use_cache=use_cache, streaming=streaming,
+                                           store_file=store_file, profiler=profiler, cube_dir=cube_dir)
+    return write_result(final_result, result_file, profiler=profiler, output_format=output_format,
+                        unmatched=unmatched)
+
+
+# 批量模式下每个子进程持有一份编译好的规则索引，只在进程启动时传一次
+_worker_rule_index = None
+
+
+def _init_worker(rule_index):
+    global _worker_rule_index
+    _worker_rule_index = rule_index
+
+
+def _process_batch_file(data_file, result_file, use_cache, streaming, store_file, report, trace_memory,
+                        output_format, cube_dir):
+    print("开始计算【%s】" % data_file)
+    profiler = StageProfiler(os.path.basename(data_file), trace_memory=trace_memory)
+    final_result, unmatched = process_file(_worker_rule_index, data_file, use_cache=use_cache, streaming=streaming,
+                                           store_file=store_file, profiler=profiler, cube_dir=cube_dir)
+    result_files = write_result(final_result, result_file, profiler=profiler, output_format=output_format,
+                                unmatched=unmatched)
+    if report:
+        profiler.write_report(report_prefix(result_file))
+    return final_result, result_files
+
+
+def list_data_files(paths):
+    '''参数可以是文件也可以是目录；目录下取所有xlsx，跳过Excel临时文件(~$开头)和计算结果(统计结果_开头)'''
+    data_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for file_path in sorted(glob.glob(os.path.join(path, "*.xlsx"))):
+                name = os.path.basename(file_path)
+                if not name.startswith("~$") and not name.startswith("统计结果_"):
+                    data_files.append(file_path)
+        else:
+            data_files.append(path)
+    return data_files
+
+
+def run_batch(rule_file, data_files, output_dir, workers=None, use_cache=True, streaming=False, store_file=None,
+              report=False, trace_memory=False, output_format="xlsx", cube_dir=None):
+    '''批量计算多个派车单明细文件：规则表只读取、编译一次，文件分给多个进程并行计算
+    每个文件输出一份 统计结果_<文件名>_<时间>.xlsx，全部文件再汇总输出一份 统计结果_汇总_<时间>.xlsx
+    report=True时每个文件旁边再输出一份分阶段的运行报告；output_format为每个文件计算结果的格式，汇总文件固定为xlsx
+    cube_dir不为空时每个文件的分摊结果都合并进补贴汇总立方体
+    返回汇总文件路径
+    '''
     now = time.strftime('%Y%m%d_%H_%M_%S', time.localtime(int(time.time())))
+    if cube_dir:
+        check_pyarrow()
+    rule_index = load_rules(rule_file, use_cache=use_cache)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    futures = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rule_index,)) as executor:
+        for data_file in data_files:
+            stem = os.path.splitext(os.path.basename(data_file))[0]
+            result_file = os.path.join(output_dir, "统计结果_%s_%s.xlsx" % (stem, now))
+            futures.append((stem, result_file, executor.submit(_process_batch_file, data_file, result_file, use_cache,
+                                                               streaming, store_file, report, trace_memory,
+                                                               output_format, cube_dir)))
+
+        result_list = []
+        for stem, result_file, future in futures:
+            try:
+                final_result, result_files = future.result()
+            except Exception as e:
+                print("计算失败【%s】：%s" % (stem, e))
+                continue
+            print("计算完成，结果见文件【%s】" % "】【".join(result_files))
+            result_list.append(final_result.assign(来源文件=stem))
+
+    # 汇总：按姓名合计，以及按姓名x来源文件合计
+    summary_file = os.path.join(output_dir, "统计结果_汇总_%s.xlsx" % now)
+    all_result = pd.concat(result_list, ignore_index=True) if result_list \
+        else pd.DataFrame(columns=["单据号", "角色", "姓名", "补贴金额", "来源文件"])
+    with pd.ExcelWriter(summary_file) as writer:
+        all_result.groupby("姓名").agg({"补贴金额": "sum"}).to_excel(writer, sheet_name='金额合计')
+        all_result.pivot_table(index="姓名", columns="来源文件", values="补贴金额", aggfunc="sum", fill_value=0) \
+            .to_excel(writer, sheet_name='分文件合计')
+    return summary_file
+
+
+# 常驻服务模式下子进程一直持有编译好的规则索引；规则表改了(修改时间或大小变了)时，下一个任务开始前重新读取、编译
+_worker_rule_file = None
+_worker_rule_stamp = None
+_worker_use_cache = True
+
+
+def _rule_stamp(rule_file):
+    stat = os.stat(rule_file)
+    return stat.st_mtime, stat.st_size
+
+
+def _service_rule_index():
+    global _worker_rule_stamp
+    stamp = _rule_stamp(_worker_rule_file)
+    if stamp != _worker_rule_stamp:
+        _init_worker(load_rules(_worker_rule_file, use_cache=_worker_use_cache))
+        _worker_rule_stamp = stamp
+    return _worker_rule_index
+
+
+def _init_service_worker(rule_file, use_cache):
+    global _worker_rule_file, _worker_use_cache
+    _worker_rule_file, _worker_use_cache = rule_file, use_cache
+    _service_rule_index()
+
+
+def _service_job(data_file, result_file, options):
+    '''常驻服务的一个任务，options可以有streaming/output_format/report，没有的用启动服务时的参数'''
+    profiler = StageProfiler(os.path.basename(data_file))
+    final_result, unmatched = process_file(_service_rule_index(), data_file, use_cache=_worker_use_cache,
+                                           streaming=options.get("streaming", False), profiler=profiler)
+    result_files = write_result(final_result, result_file, profiler=profiler,
+                                output_format=options.get("output_format", "xlsx"), unmatched=unmatched)
+    if options.get("report"):
+        result_files += profiler.write_report(report_prefix(result_file))
+    return result_files
+
+
+def service_result_name(data_file):
+    stem = os.path.splitext(os.path.basename(data_file))[0]
+    return "统计结果_%s_%s.xlsx" % (stem, time.strftime('%Y%m%d_%H_%M_%S', time.localtime(int(time.time()))))
+
+
+def serve(rule_file, output_dir, watch_dir=None, port=None, workers=None, use_cache=True, streaming=False,
+          report=False, output_format="xlsx"):
+    '''常驻服务模式(见common/job_service.py)：workers个子进程启动时读取、编译规则表，之后一直等待新的派车单明细
+    监视目录watch_dir里放进的文件、或者提交到本机HTTP接口port的文件，计算结果写到output_dir，Ctrl+C停止
+    增量计算的结果库不支持多个进程同时写，服务模式下不做增量计算
+    '''
+    service = JobService("派车单补贴计算", _service_job, service_result_name, output_dir,
+                         workers=workers or os.cpu_count() or 1, initializer=_init_service_worker,
+                         initargs=(rule_file, use_cache), watch_dir=watch_dir, port=port,
+                         default_options={"streaming": streaming, "report": report, "output_format": output_format})
+    service.run_forever()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="按规则场景计算派车单补贴；不带文件参数时计算同目录下的派车单明细.xlsx")
+    parser.add_argument("data_files", nargs="*", help="派车单明细文件或目录，可以传多个；传了即进入批量模式")
+    parser.add_argument("--rule-file", default=dir + r'/规则场景_可改绿色格子内容.xlsx', help="规则场景文件")
+    parser.add_argument("--output-dir", default=dir, help="计算结果输出目录")
+    parser.add_argument("--workers", type=int, default=None, help="批量模式/服务模式的并行进程数，默认等于CPU核数")
+    parser.add_argument("--no-cache", action="store_true", help="不使用Excel解析缓存")
+    parser.add_argument("--stream", action="store_true", help="流式读取派车单明细")
+    parser.add_argument("--incremental", action="store_true", help="增量计算，只重新计算新增/有变化的单据")
+    parser.add_argument("--report", action="store_true", help="输出分阶段的运行报告(耗时/内存/行数，json和csv各一份)")
+    parser.add_argument("--trace-memory", action="store_true", help="运行报告里额外记录每个阶段python分配内存的峰值，会变慢")
+    parser.add_argument("--cprofile", action="store_true", help="用cProfile采样整个计算过程，输出.prof文件(只支持单文件模式)")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default="xlsx",
+                        help="计算结果格式，csv/parquet时补贴明细和金额合计各输出一个文件，方便下游系统导入")
+    parser.add_argument("--no-wait", action="store_true", help="计算完成后直接退出，不等待1分钟(用于定时任务)")
+    parser.add_argument("--cube", action="store_true",
+                        help="把分摊结果合并进输出目录下的补贴汇总立方体(按姓名/角色/车牌号/规则/期间预先汇总，见subsidy_cube.py)")
+    parser.add_argument("--serve", action="store_true",
+                        help="常驻服务模式：规则表只编译一次，一直等待监视目录或HTTP接口提交的文件，Ctrl+C停止")
+    parser.add_argument("--watch-dir", default=dir + r'/待计算', help="服务模式的监视目录，设为空时不监视目录")
+    parser.add_argument("--port", type=int, default=8765, help="服务模式的本机HTTP接口端口，设为0时不开HTTP接口")
+    return parser.parse_args(argv)
 
-    rule_file = dir + r'/规则场景_可改绿色格子内容.xlsx'
-    data_file = dir + r'/派车单明细.xlsx'
-    result_file = dir + r'/统计结果_%s.xlsx' % now
 
-    main(rule_file, data_file, result_file)
-    print("\n计算完成，结果见文件【%s】\n弹窗1分钟后自动关闭，也可手动关闭~" % result_file)
-    time.sleep(60)
+if __name__ == "__main__":
+    args = parse_args()
+    now = time.strftime('%Y%m%d_%H_%M_%S', time.localtime(int(time.time())))
+    store_file = dir + r'/.allocation_store.sqlite' if args.incremental else None
+    cube_dir = os.path.join(args.output_dir, "补贴汇总立方体") if args.cube else None
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    if args.serve:
+        serve(args.rule_file, args.output_dir, watch_dir=args.watch_dir or None, port=args.port or None,
+              workers=args.workers, use_cache=not args.no_cache, streaming=args.stream, report=args.report,
+              output_format=args.output_format)
+        sys.exit(0)
+    if args.data_files:
+        result_file = run_batch(args.rule_file, list_data_files(args.data_files), args.output_dir, workers=args.workers,
+                                use_cache=not args.no_cache, streaming=args.stream, store_file=store_file,
+                                report=args.report, trace_memory=args.trace_memory, output_format=args.output_format,
+                                cube_dir=cube_dir)
+        result_files = [result_file]
+    else:
+        data_file = dir + r'/派车单明细.xlsx'
+        result_file = os.path.join(args.output_dir, '统计结果_%s.xlsx' % now)
+        profiler = StageProfiler("driver_amount_allocator", trace_memory=args.trace_memory,
+                                 cprofile_file=report_prefix(result_file) + ".prof" if args.cprofile else None)
+        result_files = main(args.rule_file, data_file, result_file, use_cache=not args.no_cache, streaming=args.stream,
+                            store_file=store_file, profiler=profiler, output_format=args.output_format,
+                            cube_dir=cube_dir)
+        if args.report or args.cprofile:
+            profiler.stop()
+            profiler.print_summary()
+        if args.report:
+            print("运行报告见文件【%s】" % "】【".join(profiler.write_report(report_prefix(result_file))))
+
+    if args.no_wait:
+        print("\n计算完成，结果见文件【%s】" % "】【".join(result_files))
+    else:
+        print("\n计算完成，结果见文件【%s】\n弹窗1分钟后自动关闭，也可手动关闭~" % "】【".join(result_files))
+        time.sleep(60)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+没有命中任何规则场景的单据诊断
+
+原来每张没命中规则的单据在计算过程中逐张打印整条记录，单据多的月份控制台刷屏，既拖慢计算也没法看。
+这里在匹配完成后整批诊断，结果作为一张表和补贴明细一起输出：
+    1. 规则的5个匹配条件(车牌号/客户名称/回头车拉货/送书重量/驾驶员2)分别对所有单据x所有规则算一遍是否满足，
+       口径和RuleIndex一致；每个条件只按不同的规则内容各算一次，单据按5个条件的取值去重后再算
+    2. 没通过的条件最少的规则即最接近的规则(个数相同时取规则表里靠前的)，列出这条规则没通过的条件和规则内容，
+       方便判断是单据填错了还是规则表漏了场景
+"""
+
+from __future__ import unicode_literals
+import pandas as pd
+import numpy as np
+
+from rule_index import WEIGHT_BUCKETS, weight_bucket, weight_bucket_codes, driver2_flag, has_driver2
+
+# 匹配条件，顺序和规则表一致
+PREDICATES = ["车牌号", "客户名称", "回头车拉货", "送书重量", "驾驶员2"]
+# 每批诊断的单据数(去重后)，单据x规则的条件矩阵按批计算，内存占用有上限
+DIAGNOSE_BATCH = 10000
+UNMATCHED_COLUMNS = ["单据号"] + PREDICATES + ["最接近规则", "同样接近的规则数", "未通过条件"] \
+    + ["规则" + predicate for predicate in PREDICATES]
+
+
+def _contains(values, pattern):
+    return pd.Series(values, dtype=object).str.contains(pattern, regex=False).to_numpy(dtype=bool)
+
+
+def _plate_pass(plates, rule_value):
+    rule_value = str(rule_value)
+    return np.ones(len(plates), dtype=bool) if rule_value == "" else _contains(plates, rule_value)
+
+
+def _client_pass(clients, rule_value):
+    rule_value = str(rule_value).strip()
+    if rule_value == "":
+        return ~_contains(clients, "葫芦娃")
+    return _contains(clients, rule_value)
+
+
+def _back_car_pass(back_cars, rule_value):
+    rule_value = str(rule_value).strip()
+    if rule_value == "":
+        return np.array([value == "" for value in back_cars], dtype=bool)
+    return _contains(back_cars, rule_value)
+
+
+def _weight_pass(bucket_codes, rule_value):
+    bucket = weight_bucket(rule_value)
+    if bucket is None:
+        return np.zeros(len(bucket_codes), dtype=bool)
+    return bucket_codes == WEIGHT_BUCKETS.index(bucket)
+
+
+def _driver2_pass(driver2_flags, rule_value):
+    flag = driver2_flag(rule_value)
+    if flag is None:
+        return np.zeros(len(driver2_flags), dtype=bool)
+    return driver2_flags == flag
+
+
+PREDICATE_FUNCS = [_plate_pass, _client_pass, _back_car_pass, _weight_pass, _driver2_pass]
+
+
+def predicate_matrix(bill_values, rule_values, pass_func):
+    """单据x规则的条件矩阵，[i, j]为第i张单据是否满足第j条规则的这个条件；同样的规则内容只算一次"""
+    codes, uniques = pd.factorize(pd.Series(rule_values, dtype=object).astype(str))
+    columns = np.column_stack([pass_func(bill_values, value) for value in uniques])
+    return columns[:, codes]
+
+
+def _bill_keys(drive_bill):
+    """单据5个条件的取值：车牌号/客户名称/回头车拉货转成字符串，重量转成档位下标，驾驶员2转成有/无"""
+    driver2_codes, driver2_uniques = pd.factorize(drive_bill["驾驶员2"].astype(object))
+    driver2_values = np.array([has_driver2(value) for value in driver2_uniques], dtype=bool)
+    return pd.DataFrame({
+        "车牌号": drive_bill["车牌号"].astype(str).to_numpy(dtype=object),
+        "客户名称": drive_bill["客户名称"].astype(str).to_numpy(dtype=object),
+        "回头车拉货": drive_bill["回头车拉货"].astype(str).to_numpy(dtype=object),
+        "送书重量": weight_bucket_codes(drive_bill["送书重量"].astype(float).to_numpy()),
+        "驾驶员2": driver2_values[driver2_codes] if len(driver2_values) else np.zeros(len(drive_bill), dtype=bool),
+    })
+
+
+def nearest_rules(keys, rule_list):
+    """keys为去重后的单据条件取值，返回(最接近的规则下标, 同样接近的规则数, 最接近规则每个条件是否通过的矩阵)"""
+    rule_frame = pd.DataFrame(rule_list, columns=PREDICATES)
+    nearest = np.empty(len(keys), dtype=np.int64)
+    ties = np.empty(len(keys), dtype=np.int64)
+    passed = np.empty((len(keys), len(PREDICATES)), dtype=bool)
+    for start in range(0, len(keys), DIAGNOSE_BATCH):
+        batch = slice(start, start + DIAGNOSE_BATCH)
+        matrices = [predicate_matrix(keys[predicate].to_numpy()[batch], rule_frame[predicate], pass_func)
+                    for predicate, pass_func in zip(PREDICATES, PREDICATE_FUNCS)]
+        fail_count = sum((~matrix).astype(np.int8) for matrix in matrices)
+        nearest[batch] = fail_count.argmin(axis=1)
+        ties[batch] = (fail_count == fail_count.min(axis=1)[:, None]).sum(axis=1)
+        batch_rows = np.arange(len(fail_count))
+        passed[batch] = np.column_stack([matrix[batch_rows, nearest[batch]] for matrix in matrices])
+    return nearest, ties, passed
+
+
+def diagnose_unmatched(drive_bill, rule_list, rule_pos):
+    """没命中规则(rule_pos=-1)的单据诊断表，按单据顺序，每张单据一行：
+    单据号、5个条件的单据取值、最接近规则(规则表里第几条规则)、同样接近的规则数、未通过条件、最接近规则的5个条件内容
+    """
+    unmatched = drive_bill[np.asarray(rule_pos) < 0].reset_index(drop=True)
+    if not len(unmatched):
+        return pd.DataFrame(columns=UNMATCHED_COLUMNS)
+
+    result = pd.DataFrame({column: unmatched[column].astype(object).to_numpy()
+                           for column in ["单据号"] + PREDICATES})
+    if not rule_list:
+        return result.assign(未通过条件="规则表为空").reindex(columns=UNMATCHED_COLUMNS)
+
+    # 5个条件取值相同的单据诊断结果一样，去重后只算一次
+    keys = _bill_keys(unmatched)
+    codes, _ = pd.factorize(pd.MultiIndex.from_frame(keys))
+    first = pd.Series(np.arange(len(keys))).groupby(codes).first().to_numpy()
+    nearest, ties, passed = nearest_rules(keys.iloc[first].reset_index(drop=True), rule_list)
+
+    failed_names = ["、".join(predicate for predicate, ok in zip(PREDICATES, row) if not ok) for row in passed]
+    rule_frame = pd.DataFrame(rule_list, columns=PREDICATES).iloc[nearest[codes]]
+    result["最接近规则"] = nearest[codes] + 1
+    result["同样接近的规则数"] = ties[codes]
+    result["未通过条件"] = np.array(failed_names, dtype=object)[codes]
+    for predicate in PREDICATES:
+        result["规则" + predicate] = rule_frame[predicate].to_numpy(dtype=object)
+    return result[UNMATCHED_COLUMNS]
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+规则场景预编译索引
+
+规则表只在启动时编译一次，匹配时每张单据的耗时和规则条数基本无关：
+    1. 离散维度直接做key：重量档位(=0 / <2 / >=2)、驾驶员2有/无
+    2. 车牌号、客户名称、回头车拉货是"规则内容包含在单据内容中"的子串匹配，规则内容统一放进子串自动机(Aho-Corasick)，
+       一次扫描就能拿到单据命中的所有规则内容
+    3. key = (重量档位, 驾驶员2, 车牌号, 客户名称, 回头车拉货)，同一个key只保留规则表里最靠前的一条，即"第一条命中的规则生效"
+    4. 单据先按上面几个维度归并成签名，同一个签名只查一次表
+"""
+
+from __future__ import unicode_literals
+from collections import deque
+from itertools import product
+import hashlib
+import json
+import pandas as pd
+import numpy as np
+
+WEIGHT_BUCKETS = ("=0", "<2", ">=2")
+
+
+class SubstringAutomaton(object):
+    """Aho-Corasick自动机：一次扫描文本，返回文本中出现过的所有模式串"""
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for pattern_id, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append(pattern_id)
+
+        # 按BFS顺序补齐失败指针，输出集合沿失败指针向下合并
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0) if state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def search(self, text):
+        """返回text中出现过的模式串集合"""
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for pattern_id in self._output[state]:
+                found.add(self.patterns[pattern_id])
+        return found
+
+
+def weight_bucket(rule):
+    """规则的重量档位，不在=0 / <2 / >=2之内的规则永远不会命中，返回None"""
+    rule = str(rule).strip()
+    return rule if rule in WEIGHT_BUCKETS else None
+
+
+def weight_bucket_codes(weights):
+    """单据重量对应的档位下标(WEIGHT_BUCKETS里的位置)，不在任何档位(如nan)时为len(WEIGHT_BUCKETS)"""
+    weights = np.asarray(weights, dtype=float)
+    return np.select([weights <= 0, (weights > 0) & (weights < 2), weights >= 2], [0, 1, 2], default=len(WEIGHT_BUCKETS))
+
+
+def driver2_flag(rule):
+    """规则的驾驶员2维度：空=没有驾驶员2，"有"=有驾驶员2，其他内容永远不会命中，返回None"""
+    rule = str(rule).strip()
+    if rule == "":
+        return False
+    elif rule == "有":
+        return True
+    return None
+
+
+def has_driver2(driver):
+    """单据是否有驾驶员2，口径和原来的check_driver2(bench_scaling.legacy_check_driver2)一致：driver可能是float类型(0.0)，能转int的先转int，空或0代表没有"""
+    try:
+        driver = int(driver)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return str(driver) != "" and str(driver) != "0"
+
+
+def rule_version(rule):
+    """单条规则内容的hash，规则内容不变hash就不变，和规则在表里的位置无关"""
+    text = json.dumps(rule, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class RuleIndex(object):
+    """规则表编译后的索引，rule_list为main里读出来的规则list，下标即规则优先级
+    rule_versions[i]为第i条规则全部内容(匹配条件+补贴金额)的hash，version为整张规则表的hash
+    """
+
+    def __init__(self, rule_list):
+        self.rule_list = rule_list
+        self.rule_versions = [rule_version(rule) for rule in rule_list]
+        self.version = hashlib.sha1("|".join(self.rule_versions).encode("utf-8")).hexdigest()[:16]
+        self._table = {}
+        plates, clients, back_cars = set(), set(), set()
+
+        for pos, rule in enumerate(rule_list):
+            bucket = weight_bucket(rule["送书重量"])
+            driver2 = driver2_flag(rule["驾驶员2"])
+            if bucket is None or driver2 is None:
+                continue
+            # 车牌号按原样做子串匹配，客户名称和回头车拉货去掉首尾空格，和原来的check_*函数(bench_scaling.legacy_check_*)保持一致
+            plate = str(rule["车牌号"])
+            client = str(rule["客户名称"]).strip()
+            back_car = str(rule["回头车拉货"]).strip()
+            self._table.setdefault((bucket, driver2, plate, client, back_car), pos)
+            plates.add(plate)
+            clients.add(client)
+            back_cars.add(back_car)
+
+        self._plate_automaton = SubstringAutomaton(sorted(p for p in plates if p))
+        self._client_automaton = SubstringAutomaton(sorted(c for c in clients if c))
+        self._back_car_automaton = SubstringAutomaton(sorted(b for b in back_cars if b))
+
+    def __len__(self):
+        return len(self.rule_list)
+
+    def plate_hits(self, plate):
+        # 空车牌号规则对所有车牌生效
+        return frozenset(self._plate_automaton.search(str(plate)) | {""})
+
+    def client_hits(self, name):
+        hits = self._client_automaton.search(str(name))
+        if "葫芦娃" not in str(name):
+            hits.add("")
+        return frozenset(hits)
+
+    def back_car_hits(self, car):
+        hits = self._back_car_automaton.search(str(car))
+        if str(car) == "":
+            hits.add("")
+        return frozenset(hits)
+
+    def lookup(self, bucket, driver2, plates, clients, back_cars):
+        """返回命中的第一条规则下标，没有命中返回-1"""
+        best = -1
+        for key in product((bucket,), (driver2,), plates, clients, back_cars):
+            pos = self._table.get(key)
+            if pos is not None and (best < 0 or pos < best):
+                best = pos
+        return best
+
+    def match(self, drive_bill):
+        """整批匹配，返回每张单据命中的第一条规则下标，-1代表没有命中任何规则"""
+        bill_count = len(drive_bill)
+        if not bill_count:
+            return np.full(0, -1, dtype=np.int64)
+
+        bucket_codes = weight_bucket_codes(drive_bill["送书重量"].astype(float).to_numpy())
+
+        # 每列先去重，只对去重后的取值算一次命中集合，命中集合相同的取值归并成同一个签名id
+        columns = [(bucket_codes, None),
+                   (drive_bill["驾驶员2"], has_driver2),
+                   (drive_bill["车牌号"], self.plate_hits),
+                   (drive_bill["客户名称"], self.client_hits),
+                   (drive_bill["回头车拉货"], self.back_car_hits)]
+        signature_codes = []
+        signature_values = []
+        for values, hits_func in columns:
+            if hits_func is None:
+                signature_codes.append(values)
+                signature_values.append(list(WEIGHT_BUCKETS) + [None])
+                continue
+            codes, uniques = pd.factorize(values)
+            interned = {}
+            unique_ids = np.array([interned.setdefault(hits_func(v), len(interned)) for v in uniques], dtype=np.int64)
+            signature_codes.append(unique_ids[codes])
+            signature_values.append(list(interned))
+
+        # 多列签名合并成一个整数后再去重，同一个签名只查一次表
+        combined = np.zeros(bill_count, dtype=np.int64)
+        for codes, values in zip(signature_codes, signature_values):
+            combined = combined * len(values) + codes
+        signature_ids, signatures = pd.factorize(combined)
+
+        first_bills = pd.Series(np.arange(bill_count)).groupby(signature_ids).first().to_numpy()
+        signature_rule = np.empty(len(signatures), dtype=np.int64)
+        for sig_id, bill in enumerate(first_bills):
+            bucket, driver2, plates, clients, back_cars = (values[codes[bill]]
+                                                           for codes, values in zip(signature_codes, signature_values))
+            signature_rule[sig_id] = -1 if bucket is None else self.lookup(bucket, driver2, plates, clients, back_cars)
+
+        return signature_rule[signature_ids]
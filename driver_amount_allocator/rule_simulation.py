@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+规则表方案模拟：财务提出新的补贴金额时，一次算出多个规则表方案对同一份派车单明细的影响
+
+原来每个方案单独跑一遍main，再手工对比几个统计结果。现在：
+    1. 派车单明细只读取、去重一次
+    2. 匹配只看匹配条件(车牌号/客户名称/驾驶员2/回头车拉货/送书重量)，匹配条件和规则顺序完全相同的方案共用一次匹配结果，
+       只改了补贴金额的方案不再重新匹配
+    3. 补贴总额按 单据 x 方案 的矩阵一次算出：每个方案的金额列(车牌补贴/葫芦娃补贴/回头车补贴/重量单价/驾驶员2补贴)
+       排成 方案 x 规则 的金额表，按每张单据命中的规则下标取值
+    4. 每个方案按原来的口径分摊到人(allocation_matrix)，按姓名合计
+输出一个xlsx：
+    方案合计：每个方案的补贴总额、和基准的差额、没命中规则的单据数、金额有变化的单据数和人数
+    按人金额、按人差额：姓名 x 方案
+    单据差额：任一方案分摊金额有变化的单据，单据号 x 方案
+第一个规则表(默认是当前的规则场景表)为基准。
+
+用法: python rule_simulation.py 方案1.xlsx 方案2.xlsx ...(也可以传目录) [--rule-file 基准规则表] [--data-file 派车单明细]
+"""
+
+from __future__ import unicode_literals
+from collections import OrderedDict
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(dir)
+sys.path.append(os.path.dirname(dir))
+
+from driver_amount_allocator import ALLOCATE_ROLES, AMOUNT_DECIMALS, _truthy, allocation_matrix, \
+    data_filter_deduplicate, list_data_files, load_rules, read_drive_bill
+from common.stage_profiler import StageProfiler
+from common.table_writer import write_frames
+
+MATCH_COLUMNS = ["车牌号", "客户名称", "驾驶员2", "回头车拉货", "送书重量"]
+# 顺序和allocate里的加法顺序一致：车牌补贴 + 葫芦娃补贴 + 回头车补贴 + 重量单价 * 重量，驾驶员2补贴单独分摊
+AMOUNT_COLUMNS = ["车牌补贴", "葫芦娃补贴", "回头车补贴", "重量(单价/吨)", "驾驶员2补贴"]
+
+
+def match_signature(rule_list):
+    '''规则表的匹配条件(按规则顺序)，签名相同的规则表对同一批单据的匹配结果一定相同'''
+    return tuple(tuple(str(rule[column]) for column in MATCH_COLUMNS) for rule in rule_list)
+
+
+def amount_table(rule_list):
+    '''规则 x 金额列(AMOUNT_COLUMNS)的金额表'''
+    return np.array([[rule[column] for column in AMOUNT_COLUMNS] for rule in rule_list],
+                    dtype=float).reshape(len(rule_list), len(AMOUNT_COLUMNS))
+
+
+def variant_amounts(drive_bill, rule_indexes):
+    '''单据 x 方案的补贴总额矩阵，匹配条件相同的方案只匹配一次
+    返回(驾驶员补贴总额, 驾驶员2补贴总额, 命中的规则下标, 每个方案用的是第几个方案的匹配结果)，前三个都是单据 x 方案
+    '''
+    bill_count, variant_count = len(drive_bill), len(rule_indexes)
+    weights = drive_bill["送书重量"].to_numpy(dtype=float)
+    driver_amount = np.zeros((bill_count, variant_count))
+    driver2_amount = np.zeros((bill_count, variant_count))
+    rule_pos = np.full((bill_count, variant_count), -1, dtype=np.int64)
+    match_source = np.zeros(variant_count, dtype=np.int64)
+
+    groups = OrderedDict()
+    for variant, rule_index in enumerate(rule_indexes):
+        groups.setdefault(match_signature(rule_index.rule_list), []).append(variant)
+    for variants in groups.values():
+        pos = rule_indexes[variants[0]].match(drive_bill)
+        matched = np.flatnonzero(pos >= 0)
+        # 方案 x 命中的单据 x 金额列
+        amounts = np.stack([amount_table(rule_indexes[variant].rule_list) for variant in variants])[:, pos[matched]]
+        plate, client, back_car, price, driver2 = (amounts[:, :, column] for column in range(len(AMOUNT_COLUMNS)))
+        cells = np.ix_(matched, variants)
+        driver_amount[cells] = (plate + client + back_car + price * weights[matched]).T
+        driver2_amount[cells] = driver2.T
+        rule_pos[:, variants] = pos[:, None]
+        match_source[variants] = variants[0]
+    return driver_amount, driver2_amount, rule_pos, match_source
+
+
+def allocate_variants(drive_bill, driver_amount, driver2_amount, rule_pos):
+    '''每个方案按原来的口径分摊(见amount_allocate_batch)，返回(姓名 x 方案的金额, 姓名, 单据 x 方案的分摊金额)
+    只分到过补贴的人出现在结果里，和统计结果的金额合计口径一致
+    '''
+    names = drive_bill[ALLOCATE_ROLES].to_numpy(dtype=object)
+    named = _truthy(names)
+    not_empty = _truthy(drive_bill["单据号"].to_numpy(dtype=object)) & _truthy(drive_bill["驾驶员"])
+    person_ids, persons = pd.factorize(names.ravel())
+
+    variant_count = driver_amount.shape[1]
+    person_totals = np.zeros((len(persons), variant_count))
+    bill_totals = np.zeros(driver_amount.shape)
+    received = np.zeros(len(persons), dtype=bool)
+    for variant in range(variant_count):
+        valid = not_empty & (rule_pos[:, variant] >= 0) & (driver_amount[:, variant] != 0)
+        present, amounts = allocation_matrix(named, valid, driver_amount[:, variant], driver2_amount[:, variant])
+        # 没分到补贴的位置金额置0，按人合计时不用再按present筛选
+        amounts = np.where(present, amounts, 0)
+        person_totals[:, variant] = np.bincount(person_ids, weights=amounts.ravel(), minlength=len(persons))
+        received |= np.bincount(person_ids, weights=present.ravel(), minlength=len(persons)) > 0
+        bill_totals[:, variant] = amounts.sum(axis=1)
+    return np.round(person_totals[received], AMOUNT_DECIMALS), persons[received], np.round(bill_totals, AMOUNT_DECIMALS)
+
+
+def variant_names(rule_files):
+    '''方案名取文件名，重名的加上序号'''
+    names = []
+    for rule_file in rule_files:
+        name = os.path.splitext(os.path.basename(rule_file))[0]
+        names.append(name if name not in names else "%s(%s)" % (name, len(names) + 1))
+    return names
+
+
+def simulate(data_file, rule_files, result_file, use_cache=True, streaming=False, profiler=None):
+    '''rule_files[0]为基准，其余为方案；返回写出的文件路径list'''
+    profiler = profiler or StageProfiler("rule_simulation")
+    names = variant_names(rule_files)
+    with profiler.stage("读取规则") as stage:
+        rule_indexes = [load_rules(rule_file, use_cache=use_cache) for rule_file in rule_files]
+        stage["rows"] = sum(len(rule_index) for rule_index in rule_indexes)
+    with profiler.stage("读取派车单") as stage:
+        drive_bill_raw = read_drive_bill(data_file, use_cache=use_cache, streaming=streaming)
+        stage["rows"] = len(drive_bill_raw)
+    with profiler.stage("去重") as stage:
+        drive_bill = data_filter_deduplicate(data_frame=drive_bill_raw)
+        stage["rows"] = len(drive_bill)
+    with profiler.stage("规则匹配") as stage:
+        driver_amount, driver2_amount, rule_pos, match_source = variant_amounts(drive_bill, rule_indexes)
+        stage["rows"] = len(set(match_source))
+    with profiler.stage("方案分摊") as stage:
+        person_totals, persons, bill_totals = allocate_variants(drive_bill, driver_amount, driver2_amount, rule_pos)
+        stage["rows"] = bill_totals.size
+
+    with profiler.stage("写出结果") as stage:
+        person_amount = pd.DataFrame(person_totals, index=pd.Index(persons, name="姓名"), columns=names).sort_index()
+        person_delta = person_amount.sub(person_amount[names[0]], axis=0).round(AMOUNT_DECIMALS)
+        bill_delta = np.round(bill_totals - bill_totals[:, :1], AMOUNT_DECIMALS)
+        changed_bill = (bill_delta != 0).any(axis=1)
+        bill_sheet = pd.DataFrame(bill_delta[changed_bill], columns=names)
+        bill_sheet.insert(0, "基准金额", bill_totals[changed_bill, 0])
+        bill_sheet.insert(0, "单据号", drive_bill["单据号"].to_numpy(dtype=object)[changed_bill])
+
+        total = person_amount.sum().round(AMOUNT_DECIMALS)
+        summary = pd.DataFrame({
+            "方案": names,
+            "规则表": rule_files,
+            "匹配": ["重新匹配" if source == variant else "沿用【%s】的匹配结果" % names[source]
+                   for variant, source in enumerate(match_source)],
+            "补贴总额": total.to_numpy(),
+            "差额": (total - total.iloc[0]).round(AMOUNT_DECIMALS).to_numpy(),
+            "差额比例": ((total - total.iloc[0]) / total.iloc[0]).round(4).to_numpy() if total.iloc[0] else np.nan,
+            "未匹配单据数": (rule_pos < 0).sum(axis=0),
+            "金额变化单据数": (bill_delta != 0).sum(axis=0),
+            "金额变化人数": (person_delta != 0).sum(axis=0).to_numpy(),
+        })
+        stage["rows"] = len(bill_sheet)
+        return write_frames(result_file, [("方案合计", summary, False), ("按人金额", person_amount, True),
+                                          ("按人差额", person_delta, True), ("单据差额", bill_sheet, False)])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="一次计算多个规则表方案的补贴，输出按人、按单据和基准的差额")
+    parser.add_argument("variants", nargs="+", help="方案规则表文件或目录，目录下取所有xlsx")
+    parser.add_argument("--rule-file", default=dir + r'/规则场景_可改绿色格子内容.xlsx', help="基准规则表")
+    parser.add_argument("--data-file", default=dir + r'/派车单明细.xlsx', help="派车单明细文件")
+    parser.add_argument("--output-dir", default=dir, help="模拟结果输出目录")
+    parser.add_argument("--no-cache", action="store_true", help="不使用Excel解析缓存")
+    parser.add_argument("--stream", action="store_true", help="流式读取派车单明细")
+    parser.add_argument("--report", action="store_true", help="打印分阶段的耗时、内存和行数")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    now = time.strftime('%Y%m%d_%H_%M_%S', time.localtime(int(time.time())))
+    base_file = os.path.abspath(args.rule_file)
+    rule_files = [base_file] + [os.path.abspath(rule_file) for rule_file in list_data_files(args.variants)
+                                if os.path.abspath(rule_file) != base_file]
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    profiler = StageProfiler("rule_simulation")
+    result_files = simulate(args.data_file, rule_files, os.path.join(args.output_dir, "方案模拟_%s.xlsx" % now),
+                            use_cache=not args.no_cache, streaming=args.stream, profiler=profiler)
+    if args.report:
+        profiler.stop()
+        profiler.print_summary()
+    print("\n%s个方案模拟完成，结果见文件【%s】" % (len(rule_files) - 1, "】【".join(result_files)))
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+补贴汇总立方体
+
+统计结果里只有按姓名的金额合计，按车牌、按角色、按月、葫芦娃/非葫芦娃这些口径都要重跑或者在Excel里透视几百万行补贴明细。
+分摊完成后把补贴明细预先汇总成 姓名 x 角色 x 车牌号 x 规则 x 期间 的格子，存在cube_dir下：
+    1. cells.parquet：每个格子一行，维度列是dictionary编码(categorical)，度量为补贴金额、条数；查询只读这个文件
+    2. bills.parquet：每张单据对各个格子的贡献，和cells结构相同，多一列单据号
+    3. 规则维度为命中规则的匹配条件(如"车牌号=大 客户名称=葫芦娃 驾驶员2=有 回头车拉货= 送书重量=<2")，
+       改了补贴金额也还是同一个规则；期间为单据制单日期所在的月份(如2022-03)
+增量更新：本次派车单明细里出现的单据以本次为准——先从格子里减掉这些单据上次的贡献，再加上本次的贡献(没命中规则的
+单据本次没有贡献，相当于从立方体里去掉)；只有非已审核明细的单据单独传进来，同样从立方体里去掉；没出现的单据保持不变。
+期间只按已审核的明细取，流式读取(读的时候就过滤掉未审核明细)和一次读完两种读法替换的单据相同。
+立方体存成parquet，需要pyarrow，没装时在读派车单之前就报错。
+所以新导出的派车单明细只包含新增单据时，立方体里累计的是全部历史单据；同一张单据重复导入不会重复统计。
+多个进程同时更新同一个立方体时用锁文件排队。
+
+查询：query(by=["期间", "角色"], 车牌号="琼A 332D3（大）", 规则=lambda rule: "葫芦娃" in rule)
+筛选条件只对每个维度的字典(去重后的取值)判断一次，再按编码筛选格子。
+命令行: python subsidy_cube.py <立方体目录> [--by 期间,角色] [--where 车牌号=琼A 332D3（大）] [--contains 规则=葫芦娃]
+"""
+
+from __future__ import unicode_literals
+import argparse
+import contextlib
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+DIMENSIONS = ["姓名", "角色", "车牌号", "规则", "期间"]
+MEASURES = ["补贴金额", "条数"]
+RULE_CONDITIONS = ["车牌号", "客户名称", "驾驶员2", "回头车拉货", "送书重量"]
+CELLS_FILE = "cells.parquet"
+BILLS_FILE = "bills.parquet"
+LOCK_FILE = ".lock"
+# 减掉旧贡献再加上新贡献后只用来消掉浮点误差，和分摊时驾驶员金额保留的小数位一致
+AMOUNT_DECIMALS = 6
+
+
+def check_pyarrow():
+    '''立方体只存parquet，没装pyarrow时直接报错，不等分摊算完才在写文件时失败'''
+    if not HAS_PYARROW:
+        raise ImportError("补贴汇总立方体存成parquet文件，需要先安装pyarrow：pip install pyarrow")
+
+
+def rule_label(rule):
+    return " ".join("%s=%s" % (column, str(rule[column]).strip()) for column in RULE_CONDITIONS)
+
+
+def bill_periods(drive_bill_raw):
+    '''每张单据的期间：制单日期(取单据内最大的)的年月，没有制单日期时为空
+    drive_bill_raw为已审核的明细(去重前)，结果的单据号和去重后的单据一一对应
+    '''
+    if "制单日期" not in drive_bill_raw.columns:
+        return pd.Series("", index=pd.Index(drive_bill_raw["单据号"].unique(), name="单据号"))
+    # 只对去重后的日期取年月，年月按大小编码后按单据取最大的编码，不对几百万个字符串做group by
+    date_codes, dates = pd.factorize(drive_bill_raw["制单日期"])
+    date_months = np.array([str(date)[:7] for date in dates] + [""], dtype=object)
+    months = np.array(sorted(set(date_months)), dtype=object)
+    month_codes = np.searchsorted(months, date_months)[date_codes]
+    bill_codes, bill_nos = pd.factorize(drive_bill_raw["单据号"])
+    bill_month = pd.Series(month_codes).groupby(bill_codes).max()
+    return pd.Series(months[bill_month.to_numpy()], index=pd.Index(np.asarray(bill_nos, dtype=object)[bill_month.index],
+                                                                  name="单据号"))
+
+
+def bill_contributions(drive_bill, final_result, rule_pos, rule_list, periods):
+    '''本次计算的补贴明细按 单据号 x 维度 汇总；drive_bill为去重后的单据，rule_pos和drive_bill逐行对应'''
+    bill_no = drive_bill["单据号"].to_numpy(dtype=object)
+    positions = pd.Index(bill_no).get_indexer(final_result["单据号"].to_numpy(dtype=object))
+    labels = np.array([rule_label(rule) for rule in rule_list] + [""], dtype=object)
+    detail = pd.DataFrame({
+        "单据号": final_result["单据号"].to_numpy(dtype=object),
+        "姓名": final_result["姓名"].to_numpy(dtype=object),
+        "角色": final_result["角色"].to_numpy(dtype=object),
+        "车牌号": drive_bill["车牌号"].to_numpy(dtype=object)[positions],
+        "规则": labels[rule_pos[positions]],
+        "期间": periods.reindex(bill_no).fillna("").to_numpy(dtype=object)[positions],
+        "补贴金额": final_result["补贴金额"].to_numpy(dtype=float),
+        "条数": np.ones(len(final_result), dtype=np.int64),
+    })
+    return _encode(_rollup(detail, ["单据号"] + DIMENSIONS))
+
+
+def _rollup(frame, keys):
+    '''按keys合计度量；categorical的维度只保留出现过的取值'''
+    if not len(frame):
+        return pd.DataFrame(columns=keys + MEASURES)
+    return frame.groupby(keys, observed=True, sort=False)[MEASURES].sum().reset_index()
+
+
+def _encode(frame):
+    '''维度列转成categorical(已经是categorical的只去掉没用到的取值)，写parquet时按dictionary编码存储'''
+    for column in frame.columns:
+        if column in MEASURES:
+            continue
+        if isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].cat.remove_unused_categories()
+        else:
+            frame[column] = frame[column].astype(object).astype("category")
+    frame["补贴金额"] = frame["补贴金额"].astype(float)
+    frame["条数"] = frame["条数"].astype(np.int64)
+    return frame
+
+
+def _concat(frames):
+    '''按列合并，维度列用union_categoricals合并字典，不用先解码成字符串'''
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    data = {}
+    for column in frames[0].columns:
+        if column in MEASURES:
+            data[column] = np.concatenate([frame[column].to_numpy() for frame in frames])
+        else:
+            data[column] = union_categoricals([frame[column] for frame in frames], ignore_order=True)
+    return pd.DataFrame(data)
+
+
+def _write_parquet(frame, path):
+    # 先写临时文件再替换，避免中途退出留下半个文件
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    try:
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@contextlib.contextmanager
+def cube_lock(cube_dir, timeout=600):
+    '''锁文件：批量模式下多个进程更新同一个立方体时排队，等待超过timeout秒报错'''
+    lock_path = os.path.join(cube_dir, LOCK_FILE)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() > deadline:
+                raise TimeoutError("汇总立方体一直被占用，确认没有程序在运行后删除锁文件【%s】" % lock_path)
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+class SubsidyCube(object):
+    """cube_dir下的补贴汇总立方体，目录或文件不存在时为空立方体"""
+
+    def __init__(self, cube_dir):
+        check_pyarrow()
+        self.cube_dir = cube_dir
+        self.cells = self._load(CELLS_FILE, DIMENSIONS)
+        self._bills = None
+
+    def _load(self, name, keys):
+        path = os.path.join(self.cube_dir, name)
+        if os.path.exists(path):
+            return pd.read_parquet(path)
+        return _encode(pd.DataFrame(dict([(key, pd.Series(dtype=object)) for key in keys]
+                                         + [("补贴金额", pd.Series(dtype=float)), ("条数", pd.Series(dtype=np.int64))])))
+
+    @property
+    def bills(self):
+        # 只有更新时才需要单据贡献，查询时不读
+        if self._bills is None:
+            self._bills = self._load(BILLS_FILE, ["单据号"] + DIMENSIONS)
+        return self._bills
+
+    def update(self, contributions, bill_nos, removed_bill_nos=()):
+        '''contributions为bill_contributions的结果，bill_nos为本次去重后的所有单据号，这些单据上次的贡献整体替换成本次的贡献；
+        removed_bill_nos为本次只有非已审核明细的单据号，上次的贡献直接去掉
+        返回(之前汇总过、本次替换的单据数, 之前汇总过、本次去掉的单据数)
+        '''
+        bill_column = self.bills["单据号"].astype(object)
+        replaced = bill_column.isin(set(bill_nos)).to_numpy()
+        removed = bill_column.isin(set(removed_bill_nos)).to_numpy() & ~replaced
+        old = self.bills[replaced | removed]
+        replaced_count = self.bills["单据号"][replaced].nunique()
+        removed_count = self.bills["单据号"][removed].nunique()
+
+        # 格子 + 本次贡献 - 被替换单据的旧贡献，合计后条数为0的格子去掉
+        negated = old[DIMENSIONS + MEASURES].copy()
+        negated[MEASURES] = -negated[MEASURES]
+        cells = _rollup(_concat([self.cells, negated, contributions[DIMENSIONS + MEASURES]]), DIMENSIONS)
+        cells["补贴金额"] = cells["补贴金额"].round(AMOUNT_DECIMALS)
+        self.cells = _encode(cells[cells["条数"] != 0].reset_index(drop=True))
+        self._bills = _encode(_concat([self.bills[~(replaced | removed)], contributions]))
+        return replaced_count, removed_count
+
+    def save(self):
+        if not os.path.exists(self.cube_dir):
+            os.makedirs(self.cube_dir)
+        _write_parquet(self.cells, os.path.join(self.cube_dir, CELLS_FILE))
+        if self._bills is not None:
+            _write_parquet(self._bills, os.path.join(self.cube_dir, BILLS_FILE))
+
+    def query(self, by=None, **filters):
+        '''按维度切片汇总，by为分组的维度list(为空时只算总计)；filters为 维度=取值/取值list/判断函数
+        例：query(by=["期间"], 角色="驾驶员", 规则=lambda rule: "葫芦娃" in rule)
+        '''
+        mask = np.ones(len(self.cells), dtype=bool)
+        for dimension, condition in filters.items():
+            column = self.cells[dimension].astype("category")
+            categories = column.cat.categories
+            if callable(condition):
+                allowed = np.array([bool(condition(value)) for value in categories], dtype=bool)
+            else:
+                values = set(condition) if isinstance(condition, (list, tuple, set)) else {condition}
+                allowed = categories.isin(values)
+            codes = column.cat.codes.to_numpy()
+            # 编码-1(空值)取到末尾补的False
+            mask &= np.append(allowed, False)[codes]
+        cells = self.cells[mask]
+        if not by:
+            return pd.DataFrame([cells[MEASURES].sum()]).astype({"条数": np.int64})
+        return cells.groupby(list(by), observed=True)[MEASURES].sum().reset_index()
+
+
+def update_cube(cube_dir, drive_bill, final_result, rule_pos, rule_list, periods, unaudited_bill_nos=()):
+    '''把本次的分摊结果合并进立方体；periods为bill_periods的结果，和去重后的drive_bill包含相同的单据
+    unaudited_bill_nos为非已审核明细的单据号，其中没有已审核明细的单据从立方体里去掉
+    返回(本次单据数, 其中之前汇总过的单据数, 之前汇总过、本次去掉的未审核单据数)
+    '''
+    contributions = bill_contributions(drive_bill, final_result, rule_pos, rule_list, periods)
+    if not os.path.exists(cube_dir):
+        os.makedirs(cube_dir)
+    with cube_lock(cube_dir):
+        cube = SubsidyCube(cube_dir)
+        replaced_count, removed_count = cube.update(contributions, periods.index,
+                                                    set(unaudited_bill_nos) - set(periods.index))
+        cube.save()
+    return len(periods), replaced_count, removed_count
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="查询补贴汇总立方体")
+    parser.add_argument("cube_dir", help="立方体目录")
+    parser.add_argument("--by", default="", help="分组的维度，逗号分隔，可选：%s" % ",".join(DIMENSIONS))
+    parser.add_argument("--where", action="append", default=[], help="维度=取值(多个取值用逗号分隔)，可以写多个")
+    parser.add_argument("--contains", action="append", default=[], help="维度=文字，取值包含这段文字，可以写多个")
+    parser.add_argument("--output", default=None, help="结果另存为xlsx/csv文件")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    filters = {}
+    for condition in args.where:
+        dimension, values = condition.split("=", 1)
+        filters[dimension] = values.split(",")
+    for condition in args.contains:
+        dimension, text = condition.split("=", 1)
+        filters[dimension] = lambda value, text=text: text in str(value)
+    result = SubsidyCube(args.cube_dir).query(by=[by for by in args.by.split(",") if by], **filters)
+    if args.output:
+        if args.output.endswith(".csv"):
+            result.to_csv(args.output, index=False, encoding="utf-8-sig")
+        else:
+            result.to_excel(args.output, index=False)
+        print("查询结果见文件【%s】" % args.output)
+    else:
+        print(result.to_string(index=False))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+派车单明细、规则场景表的模拟数据，在样例数据之外按任意数据量测试性能(见bench_scaling.py)
+
+派车单明细的分布参照真实导出的派车单明细：
+    1. 同一张单据的明细连续排列，平均每张单据3条明细；约2%的单据未审核
+    2. 约10%的单据部分明细的客户名称是葫芦娃、部分不是；客户名称里也有包含葫芦娃的公司名
+    3. 驾驶员2大部分是数字0(Excel里显示0.0)，一部分为空，少数填了手机号；跟车员越往后越多为空
+    4. 送书重量有空、0、<2、>=2(多条明细加总后跨档位)；少量车牌号为空或不带(大)/(小)，匹配不到规则
+规则场景表和真实规则表结构一致(前3行标题，第4行表头，A-K列)：
+车牌号(大/小) x 客户名称 x 驾驶员2 x 回头车拉货 x 送书重量 共72条通用规则；
+rule_count超过72条时，多出来的是具体车牌号的规则，排在通用规则前面(先命中的规则生效)。
+"""
+
+from __future__ import unicode_literals
+import numpy as np
+import pandas as pd
+import os
+import sys
+
+dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(dir))
+
+from common.table_writer import open_workbook, write_row
+
+RULE_COLUMNS = ["车牌号", "客户名称", "驾驶员2", "回头车拉货", "送书重量",
+                "车牌补贴", "葫芦娃补贴", "驾驶员2补贴", "回头车补贴", "重量(单价/吨)", "金额合计"]
+DRIVE_BILL_FILE_COLUMNS = ["状态", "制单日期", "单据号", "产品名称", "客户名称", "产品规格", "产品数量", "单位", "车牌号",
+                           "驾驶员", "驾驶员2", "跟车员1", "跟车员2", "跟车员3", "跟车员4", "跟车员5", "送书重量",
+                           "回头车拉货", "跟车员6", "订单编号", "工单编号"]
+CLIENTS = ["海南普利制药股份有限公司", "海南葫芦娃药业集团股份有限公司", "本厂", "海南出版社有限公司",
+           "广州白云山制药", "上海某某药业", "海口市人民医院"]
+SURNAMES = list("王李张刘陈杨黄赵吴周徐孙马朱胡郭何林罗洪")
+GIVEN_NAMES = list("伟芳娜敏静丽强磊军洋勇艳杰涛明超秀霞平刚")
+# 真实规则表里通用规则的组合顺序
+RULE_PLATES = ["大", "小"]
+RULE_CLIENTS = ["", "葫芦娃"]
+RULE_DRIVER2 = ["", "有"]
+RULE_BACK_CARS = ["", "大", "小"]
+RULE_WEIGHTS = ["=0", ">=2", "<2"]
+
+
+def plate_pool(plate_count):
+    '''车牌号：琼A 30000（大）、琼A 30001（小）...，最后一个不带大/小，匹配不到通用规则'''
+    plates = ["琼A %05d（%s）" % (30000 + i, RULE_PLATES[i % 2]) for i in range(max(1, plate_count - 1))]
+    return plates + ["琼B 11111"]
+
+
+def name_pool(name_count, rng):
+    surnames = np.array(SURNAMES, dtype=object)[rng.integers(0, len(SURNAMES), name_count)]
+    given = np.array(GIVEN_NAMES, dtype=object)[rng.integers(0, len(GIVEN_NAMES), (name_count, 2))]
+    return list(dict.fromkeys(surnames + given[:, 0] + given[:, 1]))
+
+
+def make_rules(rule_count=72, plate_count=20, seed=0):
+    '''规则场景list，字段同规则表(空格子为None)；72条以内只取通用规则'''
+    rng = np.random.default_rng(seed)
+    specific_count = max(0, rule_count - 72)
+    combo_count = len(RULE_CLIENTS) * len(RULE_DRIVER2) * len(RULE_BACK_CARS) * len(RULE_WEIGHTS)
+    specific_plates = plate_pool(plate_count)[:-1][:-(-specific_count // combo_count)] if specific_count else []
+
+    rules = []
+    for plate in specific_plates + RULE_PLATES:
+        for client in RULE_CLIENTS:
+            for driver2 in RULE_DRIVER2:
+                for back_car in RULE_BACK_CARS:
+                    for weight in RULE_WEIGHTS:
+                        plate_amount = {"=0": 15, "<2": 7, ">=2": None}[weight]
+                        if plate not in RULE_PLATES:
+                            plate_amount = plate_amount and plate_amount + int(rng.integers(1, 6))
+                        rule = {"车牌号": plate, "客户名称": client or None, "驾驶员2": driver2 or None,
+                                "回头车拉货": back_car or None, "送书重量": weight,
+                                "车牌补贴": plate_amount,
+                                "葫芦娃补贴": 5 if client else None,
+                                "驾驶员2补贴": int(rng.choice([10, 15, 20])) if driver2 else None,
+                                "回头车补贴": {"": None, "大": 15, "小": 7}[back_car],
+                                "重量(单价/吨)": 8 if weight != "=0" else None}
+                        rule["金额合计"] = sum(rule[column] or 0 for column in RULE_COLUMNS[5:10])
+                        rules.append(rule)
+    specific_rules = rules[:len(rules) - 72][:specific_count]
+    return (specific_rules + rules[len(rules) - 72:])[:max(rule_count, 1)]
+
+
+def write_rule_file(file_path, rules):
+    '''按真实规则表的布局写出：第1行标题，第4行表头，第5行开始是规则'''
+    workbook = open_workbook(file_path)
+    worksheet = workbook.add_worksheet("规则场景")
+    write_row(worksheet, 0, ["补贴计算模板\n注意: 只允许更改绿色格子部分，文字内容只能为数字和“不存在”"])
+    write_row(worksheet, 3, RULE_COLUMNS)
+    for row, rule in enumerate(rules, 4):
+        write_row(worksheet, row, [rule[column] for column in RULE_COLUMNS])
+    workbook.close()
+    return file_path
+
+
+def make_drive_bills(row_count, seed=0, plate_count=20, columns=None):
+    '''row_count条派车单明细，列同真实导出文件(columns不为空时只生成这些列)，空格子为nan
+    每列用各自的随机数序列，只生成部分列时这些列的内容和生成全部列时一致
+    '''
+    rng = np.random.default_rng(seed)
+    bill_count = max(1, row_count // 3)
+    # 同一张单据的明细连续排列
+    bill = np.sort(rng.integers(0, bill_count, row_count))
+    names = np.array(name_pool(60, rng), dtype=object)
+    plates = plate_pool(plate_count)
+
+    def column_values(column, rng):
+        def per_bill(values, empty_rate=0.0):
+            picked = np.array(values, dtype=object)[rng.integers(0, len(values), bill_count)]
+            picked[rng.random(bill_count) < empty_rate] = np.nan
+            return picked[bill]
+
+        def per_row(values):
+            return np.array(values, dtype=object)[rng.integers(0, len(values), row_count)]
+
+        def numbered(prefix, modulo):
+            return np.char.add(prefix, np.char.zfill((bill % modulo).astype(str), 8)).astype(object)
+
+        if column == "状态":
+            return np.where(rng.random(bill_count) < 0.02, "未审核", "已审核").astype(object)[bill]
+        elif column == "制单日期":
+            minutes = pd.to_timedelta(np.arange(bill_count) % (30 * 24 * 60), unit="m")
+            return (pd.Timestamp("2022-03-01") + minutes).strftime("%Y-%m-%d %H:%M:%S").to_numpy(dtype=object)[bill]
+        elif column == "单据号":
+            return np.char.add("PCD", np.char.zfill(np.arange(bill_count).astype(str), 10)).astype(object)[bill]
+        elif column == "产品名称":
+            return per_row(["空白纸盒", "说明书", "标签", "纸箱", "药品纸盒(10袋/盒)"])
+        elif column == "客户名称":
+            # 每张单据一个客户，10%的单据部分明细换成葫芦娃
+            clients = per_bill(CLIENTS)
+            clients[(rng.random(bill_count) < 0.1)[bill] & (rng.random(row_count) < 0.5)] = "葫芦娃"
+            return clients
+        elif column == "产品规格":
+            return per_row(["125*52*60mm", "90*75*35", "A4", "300*200*150"])
+        elif column == "产品数量":
+            return rng.integers(100, 30000, row_count)
+        elif column == "单位":
+            return per_row(["个", "张", "箱"])
+        elif column == "车牌号":
+            return per_bill(plates, empty_rate=0.01)
+        elif column == "驾驶员":
+            return per_bill(names[:12])
+        elif column == "驾驶员2":
+            # 70%为数字0，15%为空，15%为手机号
+            kind = rng.random(bill_count)
+            driver2 = np.where(kind < 0.7, 0.0, rng.integers(13000000000, 19999999999, bill_count)).astype(object)
+            driver2[(kind >= 0.7) & (kind < 0.85)] = np.nan
+            return driver2[bill]
+        elif column == "送书重量":
+            # 20%为空，10%为0，其余按指数分布，多条明细加总后有一部分>=2
+            weights = np.round(rng.exponential(0.6, row_count), 3)
+            kind = rng.random(row_count)
+            weights[kind < 0.1] = 0.0
+            weights[(kind >= 0.1) & (kind < 0.3)] = np.nan
+            return weights
+        elif column == "回头车拉货":
+            return per_bill(["大车", "小车", "大", "小"], empty_rate=0.6)
+        elif column == "订单编号":
+            return numbered("DD", 99991)
+        elif column == "工单编号":
+            return numbered("XM", 99989)
+        # 跟车员越往后越多为空
+        empty_rates = {"跟车员1": 0.2, "跟车员2": 0.4, "跟车员3": 0.7, "跟车员4": 0.9, "跟车员5": 0.95, "跟车员6": 0.9}
+        return per_bill(names[12:], empty_rate=empty_rates[column])
+
+    return pd.DataFrame(dict((column, column_values(column, np.random.default_rng([seed, position])))
+                             for position, column in enumerate(DRIVE_BILL_FILE_COLUMNS)
+                             if columns is None or column in columns))[columns or DRIVE_BILL_FILE_COLUMNS]
+
+
+def write_drive_bill_file(file_path, drive_bill):
+    '''逐行写出派车单明细xlsx(constant_memory)，空值不写'''
+    workbook = open_workbook(file_path)
+    worksheet = workbook.add_worksheet("Sheet1")
+    write_row(worksheet, 0, list(drive_bill.columns))
+    for row, values in enumerate(zip(*[drive_bill[column].tolist() for column in drive_bill.columns]), 1):
+        write_row(worksheet, row, values)
+    workbook.close()
+    return file_path
+
+
+def excel_text(values):
+    '''模拟read_excel按dtype=str读文字列：整数值的数字转成不带小数的文字(0.0 -> "0")，空值保持nan'''
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    texts = np.array([("%d" % value if isinstance(value, float) and value == int(value) else str(value))
+                      for value in uniques] + [np.nan], dtype=object)
+    return pd.Series(texts[codes], dtype="str")
+
+
+if __name__ == "__main__":
+    # 用法: python synthetic_bills.py <明细行数> <输出目录> [规则条数，默认72]
+    row_count, output_dir = int(sys.argv[1]), sys.argv[2]
+    rule_count = int(sys.argv[3]) if len(sys.argv) > 3 else 72
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    rule_file = write_rule_file(os.path.join(output_dir, "规则场景_%s条.xlsx" % rule_count), make_rules(rule_count))
+    data_file = write_drive_bill_file(os.path.join(output_dir, "派车单明细_%s行.xlsx" % row_count),
+                                      make_drive_bills(row_count))
+    print("生成完成：【%s】【%s】" % (rule_file, data_file))
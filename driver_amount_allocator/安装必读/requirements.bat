@@ -2,3 +2,5 @@ pip install pandas -i https://pypi.tuna.tsinghua.edu.cn/simple
 pip install xlrd==1.2.0 -i https://pypi.tuna.tsinghua.edu.cn/simple
 pip install openpyxl -i https://pypi.tuna.tsinghua.edu.cn/simple
 pip install xlsxwriter -i https://pypi.tuna.tsinghua.edu.cn/simple
+REM optional: python-calamine makes reading large xlsx files several times faster (common/excel_reader.py)
+pip install python-calamine -i https://pypi.tuna.tsinghua.edu.cn/simple
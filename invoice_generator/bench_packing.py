@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+发票分组的效果和耗时基准：用模拟的销售对账明细(synthetic_statements.py)，在不同数据量下跑一遍开票流程
+
+每个规模分阶段计时(读取对账明细/提取备注单号/合同分组/发票分组/组装发票明细/写出发票)，并统计分组效果：
+    1. 发票张数、下界(lower_bound)和差距
+    2. 平均填充率：每张发票的金额/金额上限(90000)、备注长度/备注长度上限(176)的平均值，单独超限的合同不计入
+    3. 违反约束的张数：含多个合同组却超过金额或备注上限的发票；合同编号、送货单号出现在多张发票里，或者漏开
+--optimize时同时跑贪心和优化分组。和基准对比时，违反约束、结果不可比(合同组数变了)直接算失败；
+发票张数比基准多出count_threshold以上、平均填充率比基准低fill_threshold以上、某个阶段耗时超过基准的(1+threshold)倍
+且多出min_seconds秒以上，算退化。有问题时退出码为1；第一次运行用--save-baseline保存基准。
+
+用法: python bench_packing.py [--sizes 2000,20000,200000] [--optimize] [--save-baseline]
+"""
+
+from __future__ import unicode_literals
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+
+import invoice_generator as generator
+from common.stage_profiler import StageProfiler
+from invoice_packer import MAX_COMMENT_LENGTH, MAX_INVOICE_AMOUNT, comment_length, lower_bound
+from synthetic_statements import make_statement, write_statement_file
+
+DEFAULT_SIZES = [2000, 20000, 200000]
+STAGES = ["读取对账明细", "提取备注单号", "合同分组", "发票分组", "组装发票明细", "写出发票"]
+QUALITY_FIELDS = ["发票张数", "下界", "金额填充率", "备注填充率", "单独超限", "违反约束"]
+
+
+def packing_quality(contract_groups, invoice_groups, token_costs, max_amount=MAX_INVOICE_AMOUNT,
+                    max_comment_length=MAX_COMMENT_LENGTH):
+    '''分组效果：发票张数、下界、平均填充率、单独超限的合同组数、违反约束的说明list'''
+    violations = []
+    amount_fill, comment_fill = [], []
+    alone_over = 0
+    contract_count, slip_invoice = {}, {}
+    for invoice_id, group in enumerate(invoice_groups):
+        total = sum(float(unit.amount) for unit in group)
+        length = comment_length(set(token for unit in group for token in unit.tokens), token_costs)
+        over_limit = total > max_amount or length > max_comment_length
+        if over_limit and len(group) > 1:
+            violations.append("发票%s含%s个合同组，金额%.2f，备注长度%s，超过上限" % (invoice_id, len(group), total, length))
+        elif over_limit:
+            alone_over += 1
+        else:
+            amount_fill.append(total / max_amount)
+            comment_fill.append(float(length) / max_comment_length)
+        for unit in group:
+            for contract_no in unit.contract_nos:
+                contract_count[contract_no] = contract_count.get(contract_no, 0) + 1
+            for deliver_no in unit.deliver_nos:
+                if slip_invoice.setdefault(deliver_no, invoice_id) != invoice_id:
+                    violations.append("送货单%s出现在发票%s和%s里" % (deliver_no, slip_invoice[deliver_no], invoice_id))
+    violations += ["合同%s出现在%s张发票里" % (contract_no, count)
+                   for contract_no, count in contract_count.items() if count > 1]
+    missing = set(contract_no for unit in contract_groups for contract_no in unit.contract_nos) - set(contract_count)
+    violations += ["合同%s没有开票" % contract_no for contract_no in sorted(missing)]
+    return {"发票张数": len(invoice_groups),
+            "下界": lower_bound(contract_groups, token_costs, max_amount, max_comment_length),
+            "金额填充率": round(sum(amount_fill) / len(amount_fill), 4) if amount_fill else 0,
+            "备注填充率": round(sum(comment_fill) / len(comment_fill), 4) if comment_fill else 0,
+            "单独超限": alone_over,
+            "违反约束": len(violations)}, violations[:20]
+
+
+def run_size(size, work_dir, optimize=False, time_budget=generator.DEFAULT_TIME_BUDGET, seed=0):
+    '''跑一个规模，返回(阶段耗时dict, 分组效果dict, 违反约束的说明list, 合同组数, profiler)'''
+    data_file = os.path.join(work_dir, "销售对账明细_%s_%s.xlsx" % (size, seed))
+    if not os.path.exists(data_file):
+        write_statement_file(data_file, make_statement(size, seed=seed))
+    profiler = StageProfiler("packing_%s%s" % (size, "_optimize" if optimize else ""))
+    result_file = os.path.join(work_dir, "开票明细清单_%s%s.xlsx" % (size, "_optimize" if optimize else ""))
+
+    # 分组过程逐张打印发票，不打印，避免刷屏影响计时
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        delivery_rows, contract_groups, token_table = generator.get_delivery_info(data_file, use_cache=False,
+                                                                                  profiler=profiler)
+        with profiler.stage("发票分组") as stage:
+            invoice_groups = generator.get_valid_group(contract_groups, token_table.costs, optimize=optimize,
+                                                       time_budget=time_budget)
+            stage["rows"] = len(invoice_groups)
+        with profiler.stage("组装发票明细") as stage:
+            slip_rows, slip_numbers = generator.index_delivery_slips(delivery_rows)
+            invoice_list = [generator.assemble_invoice([deliver_no for unit in group for deliver_no in unit.deliver_nos],
+                                                       slip_rows, slip_numbers, token_table)
+                            for group in invoice_groups]
+            invoice_list = [invoice for invoice in invoice_list if invoice]
+            stage["rows"] = sum(len(rows) for rows, _ in invoice_list)
+        with profiler.stage("写出发票", rows=len(invoice_list)):
+            generator.write_invoices(result_file, invoice_list)
+
+    quality, violations = packing_quality(contract_groups, invoice_groups, token_table.costs)
+    seconds = dict((record["stage"], record["wall_seconds"]) for record in profiler.stages)
+    return seconds, quality, violations, len(contract_groups), profiler
+
+
+def compare_baseline(name, seconds, quality, group_count, baseline, args):
+    '''和基准对比，返回(对比结果的打印行list, 问题说明list)'''
+    lines, problems = [], []
+    if baseline["合同组数"] != group_count:
+        return lines, ["%s：合同组数%s和基准%s不同，模拟数据或合同分组变了，结果不可比" % (name, group_count, baseline["合同组数"])]
+    base_quality = baseline["quality"]
+    if quality["发票张数"] > base_quality["发票张数"] * (1 + args.count_threshold):
+        problems.append("%s：发票张数%s，基准%s" % (name, quality["发票张数"], base_quality["发票张数"]))
+    for field in ["金额填充率", "备注填充率"]:
+        if quality[field] < base_quality[field] - args.fill_threshold:
+            problems.append("%s：%s%.4f，基准%.4f" % (name, field, quality[field], base_quality[field]))
+    for field in QUALITY_FIELDS:
+        lines.append("%-16s%12s%12s" % (field, base_quality[field], quality[field]))
+    for stage in STAGES:
+        if stage not in seconds or stage not in baseline["seconds"]:
+            continue
+        base, now = baseline["seconds"][stage], seconds[stage]
+        regressed = now > base * (1 + args.threshold) and now - base > args.min_seconds
+        lines.append("%-16s%12.3f%12.3f %s" % (stage, base, now, "退化" if regressed else ""))
+        if regressed:
+            problems.append("%s：%s耗时%.3fs，基准%.3fs" % (name, stage, now, base))
+    return lines, problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="发票分组效果和耗时基准(模拟数据)")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="对账明细行数，逗号分隔，默认%s" % ",".join(str(size) for size in DEFAULT_SIZES))
+    parser.add_argument("--seed", type=int, default=0, help="模拟数据的随机种子")
+    parser.add_argument("--optimize", action="store_true", help="同时跑优化分组")
+    parser.add_argument("--time-budget", type=float, default=generator.DEFAULT_TIME_BUDGET, help="优化分组的时间预算(秒)")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "invoice_generator_bench"),
+                        help="模拟数据、开票结果和基准文件的目录")
+    parser.add_argument("--baseline", default=None, help="基准文件，默认work_dir/baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基准(覆盖同规模的旧基准)")
+    parser.add_argument("--threshold", type=float, default=0.5, help="耗时超过基准的(1+threshold)倍算退化，默认0.5")
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="耗时比基准多出不到这么多秒时不算退化，默认0.5")
+    parser.add_argument("--count-threshold", type=float, default=0.0, help="发票张数比基准多出这个比例以上算退化，默认0")
+    parser.add_argument("--fill-threshold", type=float, default=0.01, help="平均填充率比基准低这么多以上算退化，默认0.01")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.work_dir):
+        os.makedirs(args.work_dir)
+    baseline_file = args.baseline or os.path.join(args.work_dir, "baseline.json")
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    problems = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        for optimize in ([False, True] if args.optimize else [False]):
+            name = "%s行%s" % (size, "(优化分组)" if optimize else "")
+            key = "seed=%s,%s" % (args.seed, "optimize" if optimize else "greedy")
+            print("\n===== %s =====" % name)
+            seconds, quality, violations, group_count, profiler = run_size(size, args.work_dir, optimize=optimize,
+                                                                           time_budget=args.time_budget,
+                                                                           seed=args.seed)
+            profiler.print_summary()
+            print("合同组%s个，%s" % (group_count, "，".join("%s%s" % (field, quality[field]) for field in QUALITY_FIELDS)))
+            if violations:
+                print("违反约束：\n%s" % "\n".join(violations))
+                problems += ["%s：%s" % (name, violation) for violation in violations]
+
+            size_baseline = baseline.get(key, {}).get(str(size))
+            if args.save_baseline:
+                baseline.setdefault(key, {})[str(size)] = {"seconds": seconds, "quality": quality,
+                                                           "合同组数": group_count}
+            elif size_baseline:
+                lines, size_problems = compare_baseline(name, seconds, quality, group_count, size_baseline, args)
+                print("%-16s%12s%12s" % ("", "基准", "本次"))
+                print("\n".join(lines))
+                problems += size_problems
+            else:
+                print("没有%s的基准，用--save-baseline保存" % name)
+
+    if args.save_baseline:
+        with open(baseline_file, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print("\n基准已保存到【%s】" % baseline_file)
+    if problems:
+        print("\n发现问题：\n%s" % "\n".join(problems))
+        return 1
+    print("\n全部通过")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
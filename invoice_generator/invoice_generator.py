@@ -9,6 +9,7 @@
 
 业务规则：
     0. 过滤条件：客户名称="海南普利制药股份有限公司" and 状态="已审核"
+       (分客户开票模式下不按客户过滤，按客户名称分区后每个客户单独开票，金额和备注长度上限可以按客户配置)
     1. 单张印刷清单的总金额<=9w（90000元）
     2. 备注字符长度<=176字符
     3. 一个合同编号内的内容，只能出现在一个印刷清单中（新规则）
@@ -20,6 +21,7 @@
 
 思路（已更新）：
     1. 从送货明细表提取出合同编号维度的明细，一个合同编号一个分组，按合同金额从大到小排序
+       共用送货单的合同合并成一个分组(并查集)，保证一张送货单只出现在一张发票里
     2. 取第0位为主key, 再遍历1以后的合同，0+1+2+3...直到不满足规则的时候停止循环，取上一组排列，并把刚刚取到的结果从合同表剔除
     3. 以此类推，新表从0位开始取，一直往后加
     4. 不满足规则的条件
@@ -28,30 +30,49 @@
 """
 
 from __future__ import unicode_literals
+import argparse
 import pandas as pd
 import time
 import os
 import sys
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(dir)
+sys.path.append(os.path.dirname(dir))
 
+from common.excel_cache import read_excel_cached
+from common.excel_reader import to_category
+from common.excel_stream import read_excel_filtered
+from common.job_service import JobService
+from common.stage_profiler import StageProfiler
+from common.table_writer import OUTPUT_FORMATS, open_workbook, output_path, write_row, write_table_file
+from invoice_ledger import InvoiceLedger, fill_ledger_invoices
+from invoice_records import NUMBER_FIELDS, ContractGroup, DeliveryRow, RemarkNumbers, TokenTable
+from invoice_packer import DEFAULT_TIME_BUDGET, MAX_COMMENT_LENGTH, MAX_INVOICE_AMOUNT, comment_length, lower_bound, \
+    pack_greedy, pack_optimized
 
-def data_filter(data_frame):
+# 单客户开票时默认开票的客户
+DEFAULT_CUSTOMER = "海南普利制药股份有限公司"
+
+
+def data_filter(data_frame, verbose=True, customer=DEFAULT_CUSTOMER):
     '''过滤规则
-    1. 客户名称="海南普利制药股份有限公司"
+    1. 客户名称=customer(默认"海南普利制药股份有限公司")，customer为None时不按客户过滤(分客户开票)
     2. 状态="已审核"
     3. 备注中包含合同编号
+    verbose=False时不打印过滤掉的条数(流式读取时由调用方汇总后统一打印)
     '''
     try:
         len_old =len(data_frame)
-        data_frame = data_frame[(data_frame["审核"] == "是")
-                              & (data_frame["客户名称"] == "海南普利制药股份有限公司")
-                              & (data_frame['工单备注'].str.contains(r"合同编号"))
-                              & (data_frame['工单备注'].str.contains(r"单据号|计划单号"))
-                    ]
-        if len_old-len(data_frame) > 0:
+        valid = (data_frame["审核"] == "是") \
+            & (data_frame['工单备注'].str.contains(r"合同编号")) \
+            & (data_frame['工单备注'].str.contains(r"单据号|计划单号"))
+        if customer is not None:
+            valid &= data_frame["客户名称"] == customer
+        data_frame = data_frame[valid]
+        if verbose and len_old-len(data_frame) > 0:
             print("有%s条记录不符合规则(未审核/客户名称不匹配/工单备注缺少合同编号或单据号)，已被过滤" % (len_old-len(data_frame)))
     except:
         pass
@@ -75,115 +96,191 @@ def get_pure_number_list(raw_str_list):
     return list(set(pure_number_list))
 
 
-def get_delivery_info(data_file):
-    # 默认读第一个sheet, header=0代表从第1行开始读, 读取指定列; 为空时指定字段用0填充，其他字段为空用""填充；最后转成key:value list
-    delivery_info_raw = pd.read_excel(data_file,
-                                      header=1,
-                                      usecols=["审核", "工程号", "送货单号", "客户名称", "产品名称", "产品规格", "数量", "单位", "单价",
-                                               "金额", "工单备注"],
-                                      dtype={"数量": float, "单价": float, "金额": float}
-                                      ).dropna(subset=["送货单号"])\
-        .fillna({"数量": 0, "单价": 0, "金额": 0}) \
-        .fillna("")
+# 工单备注里要提取的单号：四种单号合成一个正则，每种单号一个命名分组(组名就是单号名称)，在模块加载时预编译
+# 单据号在备注里可能叫计划号，这里的(?:计划号|单据号)代表二选一匹配两个完整的词，但是最后选出的是后面括号中的数字；?:用来忽略本身的括号，以避免和后面真正要匹配的字符混淆
+# 每个分支都放在零宽的(?=...)里，每个关键词的位置单独匹配：前一种单号的.+?跨过了后面单号的关键词时，后面的单号照样能匹配上；
+# 最前面先确认是关键词的位置，不是关键词的位置不用逐个分支去试
+COMMENT_NUMBER_PATTERN = re.compile("(?=合同编号|计划号|单据号|计划单号|OA单号|SAP订单号)(?:%s)" % "|".join(
+    "(?=%s)" % pattern for pattern in [
+        r'合同编号.+?(?P<合同编号>[0-9、，, -]{5,50})',
+        r'(?:计划号|单据号|计划单号).+?(?P<单据号>[0-9、，, -]{5,100})',
+        r'OA单号.+?(?P<OA单号>[0-9、，, -]{5,50})',
+        r'SAP订单号.+?(?P<SAP订单号>[0-9、，, -]{5,50})',
+    ]))
 
-    # # 重命名列名
-    # delivery_info_raw.rename(columns={'审核': '状态'}, inplace=True)
 
-    # 过滤无效数据：客户名称!=普利的，状态!=已审核的，以及工单备注里不包含合同编号的
-    delivery_info_list = data_filter(delivery_info_raw).to_dict(orient="records")
+def parse_comment_numbers(comment):
+    """提取一条工单备注里的单号，返回dict：{"合同编号": [...], "单据号": [...], "OA单号": [...], "SAP订单号": [...]}
+    合并的正则扫描一遍；每种单号只取上一个同种单号匹配结束之后的匹配，和每种单号各自findall(匹配不重叠)的结果一致
+    """
+    raw_numbers = dict((field, []) for field in NUMBER_FIELDS)
+    ends = dict.fromkeys(NUMBER_FIELDS, 0)
+    for match in COMMENT_NUMBER_PATTERN.finditer(comment):
+        field = match.lastgroup
+        if match.start() >= ends[field]:
+            raw_numbers[field].append(match.group(field))
+            ends[field] = match.end(field)
+    return dict((field, get_pure_number_list(numbers)) for field, numbers in raw_numbers.items())
+
+
+def extract_comment_numbers(comments):
+    """提取一批工单备注里的单号，返回dict：备注 -> parse_comment_numbers的结果
+    同一个合同/送货单的明细工单备注大多一模一样，相同的备注只提取一次
+    """
+    return dict((comment, parse_comment_numbers(comment)) for comment in dict.fromkeys(comments))
 
-    # 提取工单备注的：合同编号、单据号/计划号、OA单号、SAP单号，增加进data dict
-    for i in range(len(delivery_info_list)):
-        info = delivery_info_list[i]
-        comment = str(info["工单备注"])
 
-        contract_list = re.findall(r'合同编号.+?([0-9、，, -]{5,50})', comment)
-        contract_no = get_pure_number_list(contract_list)
-        delivery_info_list[i]["合同编号"] = contract_no
+DELIVERY_INFO_COLUMNS = ["审核", "工程号", "送货单号", "客户名称", "产品名称", "产品规格", "数量", "单位", "单价", "金额", "工单备注"]
+DELIVERY_INFO_DTYPE = {"数量": float, "单价": float, "金额": float}
+# 过滤后转成categorical的列，都是大量重复的文字
+DELIVERY_INFO_CATEGORY_COLUMNS = ["审核", "客户名称", "产品名称", "产品规格", "单位", "工单备注"]
 
-        # 单据号在备注里可能叫计划号，这里的(?:计划号|单据号)代表二选一匹配两个完整的词，但是最后选出的是后面括号中的数字；?:用来忽略本身的括号，以避免和后面真正要匹配的字符混淆
-        bill_list = re.findall(r'(?:计划号|单据号|计划单号).+?([0-9、，, -]{5,100})', comment)
-        bill_no = get_pure_number_list(bill_list)
-        delivery_info_list[i]["单据号"] = bill_no
 
-        OA_list = re.findall(r'OA单号.+?([0-9、，, -]{5,50})', comment)
-        OA_no = get_pure_number_list(OA_list)
-        delivery_info_list[i]["OA单号"] = OA_no
+def _clean_delivery_info(data_frame):
+    # 送货单号为空的明细丢掉，数量/单价/金额为空时用0填充，其他字段为空用""填充
+    return data_frame.dropna(subset=["送货单号"]) \
+        .fillna({"数量": 0, "单价": 0, "金额": 0}) \
+        .fillna("")
+
 
-        SAP_list = re.findall(r'SAP订单号.+?([0-9、，, -]{5,50})', comment)
-        SAP_no = get_pure_number_list(SAP_list)
-        delivery_info_list[i]["SAP订单号"] = SAP_no
+def read_delivery_info(data_file, use_cache=True, streaming=False, customer=DEFAULT_CUSTOMER):
+    '''读销售对账明细并过滤无效数据：客户名称!=customer的(customer为None时保留所有客户)，状态!=已审核的，以及工单备注里不包含合同编号的
+    streaming=True时分块流式读取，每块读出来就过滤，只保留有效明细；流式读取不使用解析缓存
+    两种读法过滤后的文字列(DELIVERY_INFO_CATEGORY_COLUMNS)都转成categorical
+    '''
+    # 默认读第一个sheet, header=1代表从第2行开始读, 读取指定列
+    if not streaming:
+        delivery_info_raw = _clean_delivery_info(read_excel_cached(data_file, use_cache=use_cache, header=1,
+                                                                   usecols=DELIVERY_INFO_COLUMNS,
+                                                                   dtype=DELIVERY_INFO_DTYPE))
+        # 文字列先按原样过滤(工单备注里可能混着数字)，过滤后再转成categorical，和流式读取一致
+        return to_category(data_filter(delivery_info_raw, customer=customer), DELIVERY_INFO_CATEGORY_COLUMNS)
+
+    filtered_count = [0]
+
+    def valid_only(chunk):
+        chunk = _clean_delivery_info(chunk)
+        valid = data_filter(chunk, verbose=False, customer=customer)
+        filtered_count[0] += len(chunk) - len(valid)
+        return valid
+
+    delivery_info = read_excel_filtered(data_file, chunk_filter=valid_only,
+                                        category_columns=DELIVERY_INFO_CATEGORY_COLUMNS, header=1,
+                                        usecols=DELIVERY_INFO_COLUMNS, dtype=DELIVERY_INFO_DTYPE)
+    if filtered_count[0] > 0:
+        print("有%s条记录不符合规则(未审核/客户名称不匹配/工单备注缺少合同编号或单据号)，已被过滤" % filtered_count[0])
+    return delivery_info
+
+
+def get_delivery_info(data_file, use_cache=True, streaming=False, profiler=None, customer=DEFAULT_CUSTOMER):
+    '''读取对账明细、提取备注单号并按合同分组，返回(明细DeliveryRow list, 合同分组ContractGroup list, 单号TokenTable)'''
+    profiler = profiler or StageProfiler("invoice_generator")
+    with profiler.stage("读取对账明细") as stage:
+        delivery_info = read_delivery_info(data_file, use_cache=use_cache, streaming=streaming, customer=customer)
+        stage["rows"] = len(delivery_info)
+    return group_delivery_info(delivery_info, profiler=profiler)
+
+
+def to_delivery_rows(delivery_info, token_table):
+    '''对账明细DataFrame转成DeliveryRow list，工单备注相同的明细共用一份提取出来的单号'''
+    comments = [str(comment) for comment in delivery_info["工单备注"].tolist()]
+    # 提取工单备注的：合同编号、单据号/计划号、OA单号、SAP单号，单号登记成整数id
+    remark_numbers = dict((comment, RemarkNumbers(tuple(token_table.intern_all(numbers[field])
+                                                        for field in NUMBER_FIELDS)))
+                          for comment, numbers in extract_comment_numbers(comments).items())
+    details = zip(*[delivery_info[column].tolist() for column in ["工程号", "产品名称", "产品规格", "数量", "单位", "单价",
+                                                                   "金额"]])
+    return [DeliveryRow(deliver_no, detail[6], remark_numbers[comment], detail)
+            for deliver_no, comment, detail in zip(delivery_info["送货单号"].tolist(), comments, details)]
+
+
+def group_delivery_info(delivery_info, profiler=None):
+    '''提取备注单号并按合同分组，返回(明细DeliveryRow list, 合同分组ContractGroup list, 单号TokenTable)'''
+    profiler = profiler or StageProfiler("invoice_generator")
+    token_table = TokenTable()
+    with profiler.stage("提取备注单号", rows=len(delivery_info)):
+        delivery_rows = to_delivery_rows(delivery_info, token_table)
 
     # 按合同编号分组（新需求：一个合同编号在一张发票里）
-    info_groupby_contract_no = get_contract_groups(delivery_info_list)
+    with profiler.stage("合同分组") as stage:
+        contract_groups = get_contract_groups(delivery_rows, token_table)
+        stage["rows"] = len(contract_groups)
 
-    return delivery_info_list, info_groupby_contract_no
+    return delivery_rows, contract_groups, token_table
 
 
-def get_contract_groups(delivery_info_list):
+def get_contract_groups(delivery_rows, token_table):
     """
     按合同编号分组
     新需求：一个合同编号的所有内容必须在同一张发票中
+
+    合同:送货单 = n:n，一张送货单里有多个合同时，这几个合同如果分到不同的发票，这张送货单的明细会在两张发票里各出现一次。
+    这里用并查集把通过送货单连在一起的合同合成一组，整组作为开票的最小单位(ContractGroup)，
+    保证每个合同、每张送货单都只出现在一张发票里；金额按明细累加，一条明细只算一次
+    合同编号、单号都用token_table里的整数id
     """
-    # 聚合一个以合同编号为key的dict
-    info_groupby_contract_dic = {}
-    
-    for info in delivery_info_list:
-        contract_numbers = info.get("合同编号", [])
-        
+    # 并查集：合同编号id -> 上级合同编号id，根节点的上级是自己
+    parent = {}
+
+    def find(contract_no):
+        while parent[contract_no] != contract_no:
+            parent[contract_no] = parent[parent[contract_no]]
+            contract_no = parent[contract_no]
+        return contract_no
+
+    def union(contract_a, contract_b):
+        root_a, root_b = find(contract_a), find(contract_b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    # 每张送货单记一个合同，同一张送货单上的其他合同都和它合并
+    slip_contract = {}
+    valid_rows = []
+    for row in delivery_rows:
+        contract_ids = row.numbers.contract_ids
+
         # 如果没有合同编号，跳过（这种情况应该在过滤阶段就被排除了）
-        if not contract_numbers:
-            print("警告：送货单 %s 没有合同编号，已跳过" % info['送货单号'])
+        if not contract_ids:
+            print("警告：送货单 %s 没有合同编号，已跳过" % row.deliver_no)
             continue
-            
+        valid_rows.append(row)
+
         # 一个记录可能有多个合同编号，但通常只有一个
-        for contract_no in contract_numbers:
-            if contract_no not in info_groupby_contract_dic:
-                info_groupby_contract_dic[contract_no] = {
-                    "金额": 0, 
-                    "单据号": [],
-                    "送货单号": [],
-                    "明细数": 0
-                }
-            
-            # 累加金额
-            info_groupby_contract_dic[contract_no]["金额"] += info["金额"]
-            
-            # 收集所有单据号
-            info_groupby_contract_dic[contract_no]["单据号"] += info.get("合同编号", [])
-            info_groupby_contract_dic[contract_no]["单据号"] += info.get("单据号", [])
-            info_groupby_contract_dic[contract_no]["单据号"] += info.get("OA单号", [])
-            info_groupby_contract_dic[contract_no]["单据号"] += info.get("SAP订单号", [])
-            
-            # 收集送货单号
-            if info["送货单号"] not in info_groupby_contract_dic[contract_no]["送货单号"]:
-                info_groupby_contract_dic[contract_no]["送货单号"].append(info["送货单号"])
-            
-            # 记录明细条数
-            info_groupby_contract_dic[contract_no]["明细数"] += 1
-
-    # 转成有序的列表，并按金额从大到小排序
-    info_groupby_contract_no = [
-        {
-            "合同编号": k, 
-            "金额": v["金额"], 
-            "单据号": v["单据号"],
-            "送货单号": v["送货单号"],
-            "明细数": v["明细数"]
-        } 
-        for k, v in info_groupby_contract_dic.items()
-    ]
-    
+        for contract_id in contract_ids:
+            parent.setdefault(contract_id, contract_id)
+            union(contract_ids[0], contract_id)
+        union(slip_contract.setdefault(row.deliver_no, contract_ids[0]), contract_ids[0])
+
+    # 按合同组(并查集的根)聚合：[合同id, 金额, 单号id, 送货单号, 明细数]，合同、单号、送货单号用dict去重并保持出现顺序
+    groups = {}
+    for row in valid_rows:
+        root = find(row.numbers.contract_ids[0])
+        group = groups.get(root)
+        if group is None:
+            group = groups[root] = [{}, 0, {}, {}, 0]
+        group[1] += row.amount
+        group[0].update(dict.fromkeys(row.numbers.contract_ids))
+        group[2].update(dict.fromkeys(row.numbers.all_ids))
+        group[3][row.deliver_no] = None
+        group[4] += 1
+
     # 按金额从大到小排序
-    info_groupby_contract_no = sorted(info_groupby_contract_no, key=lambda d: d['金额'], reverse=True)
-    
-    print("按合同编号分组完成，共 %s 个合同" % len(info_groupby_contract_no))
-    
-    return info_groupby_contract_no
+    contract_groups = sorted((ContractGroup(tuple(token_table.strings(contract_ids)), amount, tuple(token_ids),
+                                            tuple(deliver_nos), row_count)
+                              for contract_ids, amount, token_ids, deliver_nos, row_count in groups.values()),
+                             key=lambda group: group.amount, reverse=True)
+
+    print("按合同编号分组完成，共 %s 个合同" % len(parent))
+    merged_count = sum(1 for group in contract_groups if len(group.contract_nos) > 1)
+    if merged_count:
+        print("其中有共用送货单的合同已合并，合并后共 %s 组(%s 组包含多个合同)" % (len(contract_groups), merged_count))
 
+    return contract_groups
 
-def validate_invoice(info_group):
-    """ 校验发票是否成立
+
+def validate_invoice(info_group, token_costs, max_amount=MAX_INVOICE_AMOUNT, max_comment_length=MAX_COMMENT_LENGTH):
+    """ 校验发票是否成立，info_group为ContractGroup的list，token_costs[单号id]为单号在备注里占的字符数
+    max_amount/max_comment_length为客户的金额和备注长度上限(默认90000/176)
     返回True或者False
 
     规则1: 单张印刷清单的总金额<=9w
@@ -196,25 +293,22 @@ def validate_invoice(info_group):
     否则返回false
     """
     invoice_total_gmv = 0
-    invoice_total_bill_no = []
+    invoice_total_bill_no = set()
     for i in info_group:
-        invoice_total_gmv += float(i["金额"])
-        invoice_total_bill_no += list(i["单据号"])
-
-    comment_length = 0
-    for i in set(invoice_total_bill_no):
-        comment_length += len(i)+1
+        invoice_total_gmv += float(i.amount)
+        invoice_total_bill_no.update(i.tokens)
 
     # if invoice_total_gmv > 90000 or len(set(invoice_total_bill_no)) > 15:
     # if invoice_total_gmv > 90000:
     # 新增需求：备注不得超过200字符。comment有固定24个字符+4个换行符，这里判断单据号总长度不超过200-24=176字符即可。如果某个单据号为空则可能会出现1字符(换行符)的偏差
-    if invoice_total_gmv>90000 or comment_length>176:
+    if invoice_total_gmv>max_amount or comment_length(invoice_total_bill_no, token_costs)>max_comment_length:
         return False
     else:
         return True
 
 
-def get_valid_group(info_groupby_contract_no):
+def get_valid_group(info_groupby_contract_no, token_costs, optimize=False, time_budget=DEFAULT_TIME_BUDGET,
+                    max_amount=MAX_INVOICE_AMOUNT, max_comment_length=MAX_COMMENT_LENGTH):
     """
     按合同编号分组生成发票（新需求）
     1. 从送货明细表提取出合同编号维度的明细，一个合同编号一个分组，按合同金额从大到小排序
@@ -223,157 +317,496 @@ def get_valid_group(info_groupby_contract_no):
     4. 不满足规则的条件
         1. 总金额<=90000元
         2. 备注字符长度<=176字符
+    具体分组由invoice_packer.pack_greedy完成，金额和备注长度增量计算，分组结果和逐个合同调用validate_invoice校验一致
+
+    optimize=True时改用invoice_packer.pack_optimized，在time_budget秒内尽量减少发票张数(不会比上面的贪心多)，
+    并打印发票张数的下界和差距
+    info_groupby_contract_no为ContractGroup的list，token_costs[单号id]为单号在备注里占的字符数
+    max_amount/max_comment_length为客户的金额和备注长度上限，默认90000/176
     """
     invoice_groups = []
     over_limit_count = 0  # 统计超限发票数量
-    # print("开始分组，共 %s 个合同需要处理" % len(info_groupby_contract_no))
 
-    while info_groupby_contract_no:
-        # 先把第0位取出来，同时在原列表中把该元素删掉
-        base_contract = info_groupby_contract_no[0]
-        info_groupby_contract_no.remove(base_contract)
-        
+    packed_groups = greedy_groups = pack_greedy(info_groupby_contract_no, token_costs, max_amount, max_comment_length)
+    if optimize:
+        # 贪心分组和下界只算一次，优化分组和最后的对比报告共用
+        bound = lower_bound(info_groupby_contract_no, token_costs, max_amount, max_comment_length)
+        packed_groups = pack_optimized(info_groupby_contract_no, token_costs, time_budget=time_budget,
+                                       max_amount=max_amount, max_comment_length=max_comment_length,
+                                       greedy=greedy_groups, bound=bound)
+    for group in packed_groups:
+        base_contract = group[0]
+
         # 检查单个合同是否超过限制
-        is_over_limit = not validate_invoice([base_contract])
+        is_over_limit = not validate_invoice([base_contract], token_costs, max_amount, max_comment_length)
         if is_over_limit:
             over_limit_count += 1
-            print("⚠️  警告：合同编号 %s 金额 %s 超过单张发票限制(90000元)，但仍将单独开票" % (base_contract['合同编号'], base_contract['金额']))
-        
-        group = [base_contract]
-        # print("新发票基础：合同编号 %s，金额 %s" % (group[0]['合同编号'], group[0]['金额']))
-        
-        # 遍历删掉0位后的列表，满足条件的元素也从里面删掉
-        for i in info_groupby_contract_no[:]:
-            if validate_invoice(group + [i]):
-                # print("  ✅ 加入合同编号 %s，金额 %s" % (i['合同编号'], i['金额']))
-                group += [i]
-                info_groupby_contract_no.remove(i)
-            else:
-                # print("  ❌ 跳过合同编号 %s，金额 %s (超出限制)" % (i['合同编号'], i['金额']))
-                pass
-        
+            print("⚠️  警告：合同编号 %s 金额 %s 超过单张发票限制(%s元)，但仍将单独开票"
+                  % (base_contract.contract_no, base_contract.amount, max_amount))
+
         invoice_groups.append(group)
         
         # 计算当前发票总金额
-        total_amount = sum(contract["金额"] for contract in group)
+        total_amount = sum(contract.amount for contract in group)
         contract_count = len(group)
         print("完成发票 %s：包含 %s 个合同，总金额 %s" % (len(invoice_groups), contract_count, total_amount))
         print("-" * 50)
     
     print("分组完成！共生成 %s 张发票" % len(invoice_groups))
+    if optimize:
+        print("优化分组：原贪心分组%s张，优化后%s张，下界%s张，和下界相差%s张(%.1f%%)"
+              % (len(greedy_groups), len(invoice_groups), bound, len(invoice_groups) - bound,
+                 100.0 * (len(invoice_groups) - bound) / max(bound, 1)))
     
     # 显示超限统计
     if over_limit_count > 0:
-        print("⚠️  注意：有 %s 张发票超过90000元限制" % over_limit_count)
+        print("⚠️  注意：有 %s 张发票超过%s元限制" % (over_limit_count, max_amount))
         print("   这些发票对应的是单个大额合同，无法进一步拆分")
         print("   请检查业务流程或考虑调整发票限额")
     else:
-        print("✅ 所有发票都符合90000元限制")
+        print("✅ 所有发票都符合%s元限制" % max_amount)
     
     return invoice_groups
 
 
-def main(data_file, result_file):
-    delivery_info_list, info_groupby_contract_no = get_delivery_info(data_file)
-
-    invoice_groups = get_valid_group(info_groupby_contract_no)
-    invoice_dataframe_list = []
-    # 每个元素是一张发票，每张发票中包含多个合同编号
-    for invoice in invoice_groups:
-        final_result_list = []
-        contract_no = []
-        bill_no = []
-        OA_no = []
-        SAP_no = []
-        
-        # 收集当前发票中所有合同编号涉及的送货单
-        all_delivery_nos = []
-        for each in invoice:
-            all_delivery_nos.extend(each["送货单号"])
-        
-        # 根据送货单号从原送货明细表中取明细，写进final result中
-        for deliver_no in set(all_delivery_nos):  # 去重
-            for info in delivery_info_list:
-                if info["送货单号"] == deliver_no:
-                    tmp = {"工程号": info["工程号"],
-                           "品名": info["产品名称"],
-                           "规格": info["产品规格"],
-                           "数量": info["数量"],
-                           "单位": info["单位"],
-                           "单价(元)": info["单价"],
-                           "金额(元)": info["金额"],
-                           "备注": ""
-                           }
-                    final_result_list.append(tmp)
-                    contract_no += info["合同编号"]
-                    bill_no += info["单据号"]
-                    OA_no += info["OA单号"]
-                    SAP_no += info["SAP订单号"]
-        
-        # 生成备注
-        comment = """合同编号：
+def index_delivery_slips(delivery_rows):
+    """按送货单号索引明细，每张送货单只整理一次
+    返回(送货单号 -> 发票明细行list(按原明细顺序，每行是INVOICE_COLUMNS里除备注外各列的值),
+         送货单号 -> 按NUMBER_FIELDS顺序的四个单号id set)
+    """
+    slip_rows = {}
+    slip_numbers = {}
+    for row in delivery_rows:
+        deliver_no = row.deliver_no
+        if deliver_no not in slip_rows:
+            slip_rows[deliver_no] = []
+            slip_numbers[deliver_no] = tuple(set() for _ in NUMBER_FIELDS)
+        slip_rows[deliver_no].append(row.detail)
+        for numbers, field_ids in zip(slip_numbers[deliver_no], row.numbers.by_field):
+            numbers.update(field_ids)
+    return slip_rows, slip_numbers
+
+
+def assemble_invoice(delivery_nos, slip_rows, slip_numbers, token_table):
+    '''按送货单号从索引中取明细，生成一张发票的(明细行list, 备注)；一条明细都没有时返回None'''
+    final_result_list = []
+    contract_no = set()
+    bill_no = set()
+    OA_no = set()
+    SAP_no = set()
+
+    # 根据送货单号从索引中取明细，写进final result中
+    for deliver_no in set(delivery_nos):  # 去重
+        if deliver_no not in slip_rows:
+            continue
+        final_result_list += slip_rows[deliver_no]
+        numbers = slip_numbers[deliver_no]
+        contract_no |= numbers[0]
+        bill_no |= numbers[1]
+        OA_no |= numbers[2]
+        SAP_no |= numbers[3]
+
+    # 生成备注
+    comment = """合同编号：
 %s
 单据号：
 %s
 OA单号：
 %s
 SAP订单号：
-%s""" % ("\n".join(str(i) for i in set(contract_no)),
-         "\n".join(str(i) for i in set(bill_no)),
-         "\n".join(str(i) for i in set(OA_no)),
-         "\n".join(str(i) for i in set(SAP_no)),
+%s""" % ("\n".join(token_table.strings(contract_no)),
+         "\n".join(token_table.strings(bill_no)),
+         "\n".join(token_table.strings(OA_no)),
+         "\n".join(token_table.strings(SAP_no)),
          )
-        
-        if final_result_list:  # 确保有数据才设置备注
-            final_result_list[0]["备注"] = comment
-            invoice_dataframe_list.append(pd.DataFrame(final_result_list))
-
-    with pd.ExcelWriter(result_file) as writer:
-        workbook = writer.book
-        # format详细文档见 https://xlsxwriter.readthedocs.io/format.html
-        merge_format = workbook.add_format({
-            'border': 1,
-            'align': 'center',
-            'valign': 'top',
-            'text_wrap': True  # 启用文本换行，让换行符生效
-        })
-        # 遍历不同的发票sheet
-        for idx in range(len(invoice_dataframe_list)):
-            df = invoice_dataframe_list[idx]
-            sheet_name = '发票_%s' % idx
-            worksheet = workbook.add_worksheet(sheet_name)
-            writer.sheets[sheet_name] = worksheet
-            # 写数据进对应的sheet
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-            # 合并备注列，第二个参数是合并后取哪个单元格的内容
-            worksheet.merge_range('H2:H20', df.loc[0, '备注'], merge_format)
-            
-            # 设置列宽
-            worksheet.set_column('B:B', 40)  # 品名
-            worksheet.set_column('H:H', 25)  # 备注列稍微宽一些
-            
-            # 设置合适的行高以显示备注内容
-            # 计算备注行数和所需高度
-            comment_text = df.loc[0, '备注']
-            comment_lines = comment_text.count('\n') + 1  # 计算备注行数
-            
-            # 为所有数据行设置统一的行高，确保备注完整显示
-            # 备注合并单元格H2:H20会占用多行，每行都需要适当高度
-            standard_row_height = max(20, 120 // min(len(df), 19))  # 根据数据行数调整行高
-            
-            # 为数据行设置行高（从第2行开始，因为第1行是表头）
-            data_rows = len(df)
-            for row_num in range(1, min(data_rows + 1, 20)):  # 最多到第20行
-                worksheet.set_row(row_num, standard_row_height)
+
+    if final_result_list:  # 确保有数据才生成发票，备注写在第一行
+        return final_result_list, comment
+    return None
+
+
+# 发票sheet的列，备注在第8列(H列)，从第2行合并到第20行
+INVOICE_COLUMNS = ["工程号", "品名", "规格", "数量", "单位", "单价(元)", "金额(元)", "备注"]
+COMMENT_COL = 7
+COMMENT_LAST_ROW = 19
+
+
+def write_invoice_sheet(workbook, sheet_name, rows, comment, merge_format):
+    '''一张发票一个sheet：表头+明细行，备注写在合并单元格H2:H20(工作簿不能是constant_memory模式)'''
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.set_column('B:B', 40)  # 品名
+    worksheet.set_column('H:H', 25)  # 备注列稍微宽一些
+
+    # 备注合并单元格H2:H20会占用多行，为数据行(最多到第20行)设置统一的行高，确保备注完整显示
+    standard_row_height = max(20, 120 // min(len(rows), 19))  # 根据数据行数调整行高
+    write_row(worksheet, 0, INVOICE_COLUMNS)
+    for row_num, row in enumerate(rows, 1):
+        if row_num <= COMMENT_LAST_ROW:
+            worksheet.set_row(row_num, standard_row_height)
+        write_row(worksheet, row_num, row)
+    # 合并备注列，第二个参数是合并后取哪个单元格的内容
+    worksheet.merge_range(1, COMMENT_COL, COMMENT_LAST_ROW, COMMENT_COL, comment, merge_format)
+
+
+def _write_invoice_workbook(file_path, invoice_list, invoice_ids):
+    '''invoice_list里的发票写进一个工作簿，sheet名为 发票_<发票号>'''
+    # 每个sheet只有几十行，不用constant_memory，才能用merge_range合并备注列
+    workbook = open_workbook(file_path, constant_memory=False)
+    # format详细文档见 https://xlsxwriter.readthedocs.io/format.html
+    merge_format = workbook.add_format({
+        'border': 1,
+        'align': 'center',
+        'valign': 'top',
+        'text_wrap': True  # 启用文本换行，让换行符生效
+    })
+    for idx, (rows, comment) in zip(invoice_ids, invoice_list):
+        write_invoice_sheet(workbook, '发票_%s' % idx, rows, comment, merge_format)
+    workbook.close()
+    return file_path
+
+
+def invoice_frame(invoice_list, invoice_ids):
+    '''所有发票拼成一张表，第一列为发票序号(和sheet名的序号一致)，备注只写在每张发票的第一行'''
+    records = []
+    for idx, (rows, comment) in zip(invoice_ids, invoice_list):
+        for row_num, row in enumerate(rows):
+            records.append((idx,) + tuple(row) + (comment if row_num == 0 else "",))
+    return pd.DataFrame.from_records(records, columns=["发票序号"] + INVOICE_COLUMNS)
+
+
+def write_invoices(result_file, invoice_list, output_format="xlsx", shards=1, invoice_ids=None):
+    '''写出发票，invoice_list每个元素为(明细行list, 备注)，返回写出的文件路径list
+    invoice_ids为每张发票的发票号(sheet名里的序号)，默认从0开始按顺序编号
+    xlsx时一张发票一个sheet；shards>1时按顺序把发票平均分成shards份，多进程同时写
+    开票明细清单_xxx_1.xlsx、开票明细清单_xxx_2.xlsx...，sheet名仍按全部发票的序号编号
+    csv/parquet时所有发票写成一张表
+    '''
+    if invoice_ids is None:
+        invoice_ids = list(range(len(invoice_list)))
+    if output_format != "xlsx":
+        file_path = output_path(result_file, output_format)
+        write_table_file(file_path, invoice_frame(invoice_list, invoice_ids), output_format)
+        return [file_path]
+
+    shards = max(1, min(shards, len(invoice_list)))
+    if shards == 1:
+        return [_write_invoice_workbook(output_path(result_file), invoice_list, invoice_ids)]
+    size = -(-len(invoice_list) // shards)
+    with ProcessPoolExecutor(max_workers=shards) as executor:
+        futures = [executor.submit(_write_invoice_workbook, output_path(result_file, suffix=str(shard + 1)),
+                                   invoice_list[start:start + size], invoice_ids[start:start + size])
+                   for shard, start in enumerate(range(0, len(invoice_list), size))]
+        return [future.result() for future in futures]
+
+
+def main(data_file, result_file, use_cache=True, streaming=False, profiler=None, optimize=False,
+         time_budget=DEFAULT_TIME_BUDGET, output_format="xlsx", shards=1):
+    '''profiler不为空时记录每个阶段的耗时、内存和行数；optimize=True时用优化分组，在time_budget秒内尽量减少发票张数
+    output_format/shards见write_invoices，返回写出的文件路径list
+    '''
+    profiler = profiler or StageProfiler("invoice_generator")
+    delivery_rows, contract_groups, token_table = get_delivery_info(data_file, use_cache=use_cache,
+                                                                    streaming=streaming, profiler=profiler)
+    return generate_invoices(delivery_rows, contract_groups, token_table, result_file, profiler=profiler,
+                             optimize=optimize, time_budget=time_budget, output_format=output_format, shards=shards)
+
+
+def generate_invoices(delivery_rows, contract_groups, token_table, result_file, profiler=None, optimize=False,
+                      time_budget=DEFAULT_TIME_BUDGET, output_format="xlsx", shards=1,
+                      max_amount=MAX_INVOICE_AMOUNT, max_comment_length=MAX_COMMENT_LENGTH):
+    '''合同分组 -> 发票分组 -> 组装发票明细 -> 写出，返回写出的文件路径list'''
+    profiler = profiler or StageProfiler("invoice_generator")
+    with profiler.stage("发票分组") as stage:
+        invoice_groups = get_valid_group(contract_groups, token_table.costs, optimize=optimize,
+                                         time_budget=time_budget, max_amount=max_amount,
+                                         max_comment_length=max_comment_length)
+        stage["rows"] = len(invoice_groups)
+
+    with profiler.stage("组装发票明细") as stage:
+        slip_rows, slip_numbers = index_delivery_slips(delivery_rows)
+        invoice_list = []
+        # 每个元素是一张发票，每张发票中包含多个合同编号
+        for invoice in invoice_groups:
+            # 收集当前发票中所有合同编号涉及的送货单
+            all_delivery_nos = []
+            for each in invoice:
+                all_delivery_nos.extend(each.deliver_nos)
+            assembled = assemble_invoice(all_delivery_nos, slip_rows, slip_numbers, token_table)
+            if assembled:
+                invoice_list.append(assembled)
+        stage["rows"] = sum(len(rows) for rows, _ in invoice_list)
+
+    with profiler.stage("写出发票", rows=len(invoice_list)):
+        return write_invoices(result_file, invoice_list, output_format=output_format, shards=shards)
+
+
+def _ledger_slip(deliver_no, slip_rows, slip_numbers, token_table):
+    '''账本里存的送货单：明细行、单号(单号id转回文字)'''
+    numbers = dict((field, sorted(token_table.strings(token_ids)))
+                   for field, token_ids in zip(NUMBER_FIELDS, slip_numbers[deliver_no]))
+    return [list(row) for row in slip_rows[deliver_no]], numbers
+
+
+def run_with_ledger(data_file, result_file, ledger_file, fill_open=False, close_invoices=False, use_cache=True,
+                    streaming=False, profiler=None, optimize=False, time_budget=DEFAULT_TIME_BUDGET,
+                    output_format="xlsx", shards=1):
+    '''增量开票(见invoice_ledger)：账本里已经开过票的送货单跳过，只对新明细提取单号、分组
+    以前开过票的合同放回原发票，fill_open=True时新合同先补进未关闭的发票，剩下的正常分组新开发票；
+    只输出本次新开和补充过的发票(补充过的发票输出完整内容)，sheet名用账本里的发票号
+    close_invoices=True时本次开票后关闭账本里所有未关闭的发票
+    返回写出的文件路径list
+    '''
+    profiler = profiler or StageProfiler("invoice_generator")
+    ledger = InvoiceLedger(ledger_file)
+    try:
+        with profiler.stage("读取对账明细") as stage:
+            delivery_info = read_delivery_info(data_file, use_cache=use_cache, streaming=streaming)
+            stage["rows"] = len(delivery_info)
+
+        with profiler.stage("跳过已开票送货单") as stage:
+            # 账本里送货单号按文字存
+            deliver_nos = delivery_info["送货单号"].astype(str)
+            invoiced = ledger.invoiced_slips(deliver_nos.unique())
+            new_info = delivery_info.assign(送货单号=deliver_nos)[~deliver_nos.isin(invoiced).to_numpy()]
+            stage["rows"] = len(new_info)
+        print("增量开票：共%s条明细，跳过已开过票的送货单%s张，本次新增明细%s条"
+              % (len(delivery_info), len(invoiced), len(new_info)))
+
+        result_files = []
+        if len(new_info):
+            delivery_rows, contract_groups, token_table = group_delivery_info(new_info, profiler=profiler)
+            with profiler.stage("补充已开发票") as stage:
+                filled, ledger_invoices, rest = fill_ledger_invoices(contract_groups, ledger, token_table,
+                                                                     fill_open=fill_open)
+                stage["rows"] = sum(len(units) for units in filled.values())
+
+            with profiler.stage("发票分组") as stage:
+                invoice_groups = get_valid_group(rest, token_table.costs, optimize=optimize, time_budget=time_budget) \
+                    if rest else []
+                stage["rows"] = len(invoice_groups)
+
+            with profiler.stage("组装发票明细") as stage:
+                slip_rows, slip_numbers = index_delivery_slips(delivery_rows)
+                old_slips = ledger.invoice_slips(sorted(filled))
+                next_id = ledger.next_invoice_id()
+                touched = [(invoice_id, filled[invoice_id], old_slips[invoice_id]) for invoice_id in sorted(filled)] \
+                    + [(next_id + idx, group, []) for idx, group in enumerate(invoice_groups)]
+                invoice_ids, invoice_list = [], []
+                for invoice_id, group, old in touched:
+                    for deliver_no, rows, numbers in old:
+                        slip_rows[deliver_no] = rows
+                        slip_numbers[deliver_no] = tuple(set(token_table.intern_all(numbers[field]))
+                                                         for field in NUMBER_FIELDS)
+                    delivery_nos = [slip[0] for slip in old] + [deliver_no for unit in group
+                                                                for deliver_no in unit.deliver_nos]
+                    invoice_ids.append(invoice_id)
+                    invoice_list.append(assemble_invoice(delivery_nos, slip_rows, slip_numbers, token_table))
+                stage["rows"] = sum(len(rows) for rows, _ in invoice_list)
+
+            with profiler.stage("写出发票", rows=len(invoice_list)):
+                result_files = write_invoices(result_file, invoice_list, output_format=output_format, shards=shards,
+                                              invoice_ids=invoice_ids)
+
+            with profiler.stage("更新账本", rows=len(touched)):
+                invoices = [ledger_invoices[invoice_id] for invoice_id in sorted(filled)]
+                for invoice_id, group, _ in touched[len(filled):]:
+                    tokens = token_table.strings(dict.fromkeys(token for unit in group for token in unit.tokens))
+                    invoices.append({"invoice_id": invoice_id, "total": sum(unit.amount for unit in group),
+                                     "tokens": tokens, "max_amount": MAX_INVOICE_AMOUNT,
+                                     "max_comment_length": MAX_COMMENT_LENGTH})
+                contracts = [(contract_no, invoice_id) for invoice_id, group, _ in touched for unit in group
+                             for contract_no in unit.contract_nos]
+                slips = [(deliver_no, invoice_id) + tuple(_ledger_slip(deliver_no, slip_rows, slip_numbers, token_table))
+                         for invoice_id, group, _ in touched for unit in group for deliver_no in unit.deliver_nos]
+                run_id = ledger.save(data_file, result_files[0] if result_files else "", invoices, contracts, slips)
+            print("增量开票完成：补充已有发票%s张，新开发票%s张" % (len(filled), len(invoice_groups)))
+            splits = ledger.contract_splits(run_id)
+            if splits:
+                print("⚠️  注意：有%s个合同以前开过票，这次的新送货单放不回原发票，拆到了新发票(账本里原发票的记录保留)：\n%s"
+                      % (len(splits), "\n".join("   合同编号 %s：原发票 %s，本次发票 %s" % split for split in splits)))
+        else:
+            print("没有新的明细需要开票")
+
+        if close_invoices:
+            print("已关闭账本里未关闭的发票%s张" % ledger.close_open_invoices())
+    finally:
+        ledger.close()
+    return result_files
+
+
+# 客户开票限额表的列，留空的用默认上限
+CUSTOMER_LIMIT_COLUMNS = ["客户名称", "金额上限", "备注长度上限"]
+
+
+def load_customer_limits(limits_file, use_cache=True):
+    '''读客户开票限额表，返回 客户名称 -> (金额上限, 备注长度上限)
+    备注长度上限和MAX_COMMENT_LENGTH一样只算单号部分(不含备注里固定的字和换行)；没有限额表或表里没有的客户用90000/176
+    '''
+    customer_limits = {}
+    if not limits_file:
+        return customer_limits
+    limits = read_excel_cached(limits_file, use_cache=use_cache, usecols=CUSTOMER_LIMIT_COLUMNS)
+    for row in limits.to_dict(orient="records"):
+        max_amount = MAX_INVOICE_AMOUNT if pd.isna(row["金额上限"]) else float(row["金额上限"])
+        max_comment_length = MAX_COMMENT_LENGTH if pd.isna(row["备注长度上限"]) else int(row["备注长度上限"])
+        customer_limits[str(row["客户名称"]).strip()] = (max_amount, max_comment_length)
+    return customer_limits
+
+
+def customer_result_file(result_file, customer):
+    '''开票明细清单_<时间>.xlsx -> 开票明细清单_<时间>_<客户名称>.xlsx，去掉文件名里不能用的字符'''
+    return output_path(result_file, "xlsx", suffix=re.sub(r'[\\/:*?"<>|\s]+', "_", customer))
+
+
+def _invoice_customer(customer, delivery_info, result_file, max_amount, max_comment_length, optimize, time_budget,
+                      output_format, report, trace_memory):
+    print("开始开票【%s】" % customer)
+    profiler = StageProfiler(customer, trace_memory=trace_memory)
+    delivery_rows, contract_groups, token_table = group_delivery_info(delivery_info, profiler=profiler)
+    result_files = generate_invoices(delivery_rows, contract_groups, token_table, result_file, profiler=profiler,
+                                     optimize=optimize, time_budget=time_budget, output_format=output_format,
+                                     max_amount=max_amount, max_comment_length=max_comment_length)
+    if report:
+        profiler.write_report(os.path.splitext(result_file)[0] + "_运行报告")
+    return result_files
+
+
+def run_all_customers(data_file, result_file, limits_file=None, workers=None, use_cache=True, streaming=False,
+                      profiler=None, optimize=False, time_budget=DEFAULT_TIME_BUDGET, output_format="xlsx",
+                      report=False, trace_memory=False):
+    '''分客户开票：对账明细只读取、过滤一次，按客户名称分区，每个客户的单号提取、合同分组、发票分组和写出交给进程池并行
+    每个客户按限额表里的上限分组(见load_customer_limits)，输出一份 开票明细清单_<时间>_<客户名称>.xlsx
+    report=True时每个客户的结果旁边再输出一份分阶段的运行报告
+    返回 客户名称 -> 写出的文件路径list
+    '''
+    profiler = profiler or StageProfiler("invoice_generator")
+    customer_limits = load_customer_limits(limits_file, use_cache=use_cache)
+    with profiler.stage("读取对账明细") as stage:
+        delivery_info = read_delivery_info(data_file, use_cache=use_cache, streaming=streaming, customer=None)
+        stage["rows"] = len(delivery_info)
+
+    result_files = {}
+    with profiler.stage("分客户开票", rows=len(delivery_info)) as stage, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for customer, customer_info in delivery_info.groupby("客户名称", sort=False, observed=True):
+            customer = str(customer)
+            max_amount, max_comment_length = customer_limits.get(customer.strip(),
+                                                                 (MAX_INVOICE_AMOUNT, MAX_COMMENT_LENGTH))
+            futures.append((customer, executor.submit(_invoice_customer, customer, customer_info,
+                                                      customer_result_file(result_file, customer), max_amount,
+                                                      max_comment_length, optimize, time_budget, output_format,
+                                                      report, trace_memory)))
+
+        for customer, future in futures:
+            try:
+                result_files[customer] = future.result()
+            except Exception as e:
+                print("开票失败【%s】：%s" % (customer, e))
+                continue
+            print("开票完成【%s】，结果见文件【%s】" % (customer, "】【".join(result_files[customer])))
+        stage["rows"] = len(futures)
+    return result_files
+
+
+def _service_job(data_file, result_file, options):
+    '''常驻服务的一个任务，options可以有optimize/time_budget/output_format/shards，没有的用启动服务时的参数'''
+    return main(data_file, result_file, use_cache=options.get("use_cache", True),
+                streaming=options.get("streaming", False), optimize=options.get("optimize", False),
+                time_budget=options.get("time_budget", DEFAULT_TIME_BUDGET),
+                output_format=options.get("output_format", "xlsx"), shards=options.get("shards", 1))
+
+
+def service_result_name(data_file):
+    stem = os.path.splitext(os.path.basename(data_file))[0]
+    return "开票明细清单_%s_%s.xlsx" % (stem, time.strftime('%Y%m%d_%H_%M_%S', time.localtime(int(time.time()))))
+
+
+def serve(output_dir, watch_dir=None, port=None, workers=None, use_cache=True, streaming=False, optimize=False,
+          time_budget=DEFAULT_TIME_BUDGET, output_format="xlsx", shards=1):
+    '''常驻服务模式(见common/job_service.py)：workers个子进程启动后一直等待新的销售对账明细，
+    监视目录watch_dir里放进的文件、或者提交到本机HTTP接口port的文件，开票结果写到output_dir，Ctrl+C停止
+    开票账本不支持多个进程同时写，服务模式下不按账本增量开票
+    '''
+    service = JobService("开票明细清单", _service_job, service_result_name, output_dir,
+                         workers=workers or os.cpu_count() or 1, watch_dir=watch_dir, port=port,
+                         default_options={"use_cache": use_cache, "streaming": streaming, "optimize": optimize,
+                                          "time_budget": time_budget, "output_format": output_format,
+                                          "shards": shards})
+    service.run_forever()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="按送货单生成开票明细清单；计算同目录下的销售对账明细_XSDZ25090001.xlsx")
+    parser.add_argument("--no-cache", action="store_true", help="不使用Excel解析缓存")
+    parser.add_argument("--stream", action="store_true", help="流式读取销售对账明细")
+    parser.add_argument("--report", action="store_true", help="输出分阶段的运行报告(json和csv各一份)")
+    parser.add_argument("--trace-memory", action="store_true", help="运行报告里额外记录python分配内存的峰值，会变慢")
+    parser.add_argument("--cprofile", action="store_true", help="用cProfile采样整个计算过程，输出.prof文件")
+    parser.add_argument("--optimize", action="store_true", help="用优化分组尽量减少发票张数")
+    parser.add_argument("--time-budget", type=float, default=DEFAULT_TIME_BUDGET,
+                        help="优化分组的时间预算(秒)，默认%s秒" % DEFAULT_TIME_BUDGET)
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default="xlsx",
+                        help="结果格式，csv/parquet时输出一张包含所有发票明细的表")
+    parser.add_argument("--shards", type=int, default=1, help="把发票分成N个xlsx文件并行写出")
+    parser.add_argument("--all-customers", action="store_true",
+                        help="给对账明细里的所有客户分别开票(每个客户一个文件)")
+    parser.add_argument("--workers", type=int, default=None, help="所有客户模式/服务模式的并行进程数，默认等于CPU核数")
+    parser.add_argument("--customer-limits", default=None,
+                        help="客户开票限额表(列：客户名称/金额上限/备注长度上限)")
+    parser.add_argument("--ledger", action="store_true", help="按开票账本增量开票，只给新的送货单开票")
+    parser.add_argument("--fill-open", action="store_true", help="新合同先补进账本里未关闭、额度还够的发票")
+    parser.add_argument("--close-invoices", action="store_true",
+                        help="本次开票后关闭账本里所有未关闭的发票(发票已经开出去，之后不再补充)")
+    parser.add_argument("--no-wait", action="store_true", help="计算完成后直接退出，不等待1分钟(用于定时任务)")
+    parser.add_argument("--serve", action="store_true",
+                        help="常驻服务模式：一直等待监视目录或HTTP接口提交的对账明细，Ctrl+C停止")
+    parser.add_argument("--watch-dir", default=dir + r'/待计算', help="服务模式的监视目录，设为空时不监视目录")
+    parser.add_argument("--port", type=int, default=8766, help="服务模式的本机HTTP接口端口，设为0时不开HTTP接口")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
+    args = parse_args()
     now = time.strftime('%Y%m%d_%H_%M_%S', time.localtime(int(time.time())))
 
     data_file = dir + r'/销售对账明细_XSDZ25090001.xlsx'
     # result_file = dir + r'/印刷清单_%s.xlsx' % now
     result_file = dir + r'/开票明细清单_%s.xlsx' % now
 
-    main(data_file, result_file)
-    print("\n计算完成，结果见文件【%s】\n弹窗1分钟后自动关闭，也可手动关闭~" % result_file)
-    time.sleep(60)
\ No newline at end of file
+    report_prefix = os.path.splitext(result_file)[0] + "_运行报告"
+    profiler = StageProfiler("invoice_generator", trace_memory=args.trace_memory,
+                             cprofile_file=report_prefix + ".prof" if args.cprofile else None)
+    if args.serve:
+        serve(dir, watch_dir=args.watch_dir or None, port=args.port or None, workers=args.workers,
+              use_cache=not args.no_cache, streaming=args.stream, optimize=args.optimize,
+              time_budget=args.time_budget, output_format=args.output_format, shards=args.shards)
+        sys.exit(0)
+    if args.ledger:
+        result_files = run_with_ledger(data_file, result_file, dir + r'/.invoice_ledger.sqlite',
+                                       fill_open=args.fill_open, close_invoices=args.close_invoices,
+                                       use_cache=not args.no_cache, streaming=args.stream, profiler=profiler,
+                                       optimize=args.optimize, time_budget=args.time_budget,
+                                       output_format=args.output_format, shards=args.shards)
+    elif args.all_customers:
+        customer_files = run_all_customers(data_file, result_file, limits_file=args.customer_limits,
+                                           workers=args.workers, use_cache=not args.no_cache, streaming=args.stream,
+                                           profiler=profiler, optimize=args.optimize, time_budget=args.time_budget,
+                                           output_format=args.output_format, report=args.report,
+                                           trace_memory=args.trace_memory)
+        result_files = [file_path for files in customer_files.values() for file_path in files]
+    else:
+        result_files = main(data_file, result_file, use_cache=not args.no_cache, streaming=args.stream,
+                            profiler=profiler, optimize=args.optimize, time_budget=args.time_budget,
+                            output_format=args.output_format, shards=args.shards)
+    if args.report or args.cprofile:
+        profiler.stop()
+        profiler.print_summary()
+    if args.report:
+        print("运行报告见文件【%s】" % "】【".join(profiler.write_report(report_prefix)))
+
+    if args.no_wait:
+        print("\n计算完成，结果见文件【%s】" % "】【".join(result_files))
+    else:
+        print("\n计算完成，结果见文件【%s】\n弹窗1分钟后自动关闭，也可手动关闭~" % "】【".join(result_files))
+        time.sleep(60)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+开票账本(sqlite)，按月增量开票
+
+每次全量开票都要把以前开过票的合同重新分组，金额没用满的发票也不会再补。账本记录：
+    1. 每张发票的总金额、备注单号、金额/备注长度上限，剩余额度 = 上限 - 已用
+    2. 每个合同编号、每张送货单开在哪张发票里；送货单同时存下它的发票明细行和备注单号，补充发票时重新输出整张发票
+增量开票时：
+    1. 已经开过票的送货单直接跳过，不再提取备注单号、不参与分组，耗时只和新增明细有关
+    2. 新明细里的合同以前开过票(同一个合同又来了新送货单)时，只能放回原来那张发票，放不下时单独开票并提示；
+       这种拆票记在contract_splits里，contracts里原来的发票不覆盖，开票结束时列出本次拆票的合同
+    3. fill_open=True时新合同先按先到先放(first-fit)补进还没关闭、额度够的发票，放不下的再正常分组新开发票
+发票开出去以后用close_open_invoices关闭，关闭的发票不再补充。
+"""
+
+from __future__ import unicode_literals
+import json
+import sqlite3
+import time
+
+from invoice_packer import AMOUNT_MARGIN, comment_length
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    data_file TEXT NOT NULL,
+    result_file TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invoices (
+    invoice_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL,
+    total REAL NOT NULL,
+    tokens TEXT NOT NULL,
+    comment_length INTEGER NOT NULL,
+    max_amount REAL NOT NULL,
+    max_comment_length INTEGER NOT NULL,
+    is_open INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS contracts (
+    合同编号 TEXT PRIMARY KEY,
+    invoice_id INTEGER NOT NULL
+);
+-- 合同拆到多张发票时，除contracts里第一次开的发票以外的发票
+CREATE TABLE IF NOT EXISTS contract_splits (
+    合同编号 TEXT NOT NULL,
+    invoice_id INTEGER NOT NULL,
+    run_id INTEGER NOT NULL,
+    PRIMARY KEY (合同编号, invoice_id)
+);
+CREATE TABLE IF NOT EXISTS slips (
+    送货单号 TEXT PRIMARY KEY,
+    invoice_id INTEGER NOT NULL,
+    rows TEXT NOT NULL,
+    numbers TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS slips_invoice ON slips (invoice_id);
+"""
+
+# sqlite单条语句的参数个数有上限，IN查询分批
+QUERY_BATCH = 500
+
+
+class InvoiceLedger(object):
+    """开票账本，ledger_file为sqlite文件路径，不存在时自动创建"""
+
+    def __init__(self, ledger_file):
+        self.conn = sqlite3.connect(ledger_file, timeout=600)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _query_in(self, sql, keys):
+        rows = []
+        keys = list(keys)
+        for start in range(0, len(keys), QUERY_BATCH):
+            batch = keys[start:start + QUERY_BATCH]
+            rows += self.conn.execute(sql % ",".join("?" * len(batch)), batch).fetchall()
+        return rows
+
+    def invoiced_slips(self, deliver_nos):
+        """deliver_nos里已经开过票的送货单号set"""
+        return set(row[0] for row in self._query_in("SELECT 送货单号 FROM slips WHERE 送货单号 IN (%s)",
+                                                    set(deliver_nos)))
+
+    def contract_invoices(self, contract_nos):
+        """合同编号 -> 开在哪张发票(拆过票的取最后开的一张)，只返回开过票的合同"""
+        contract_nos = set(contract_nos)
+        invoices = dict(self._query_in("SELECT 合同编号, invoice_id FROM contracts WHERE 合同编号 IN (%s)",
+                                       contract_nos))
+        for contract_no, invoice_id in self._query_in(
+                "SELECT 合同编号, MAX(invoice_id) FROM contract_splits WHERE 合同编号 IN (%s) GROUP BY 合同编号",
+                contract_nos):
+            invoices[contract_no] = max(invoices.get(contract_no, invoice_id), invoice_id)
+        return invoices
+
+    def contract_splits(self, run_id):
+        """run_id这次开票拆出去的合同：[(合同编号, 原发票号, 新发票号)]"""
+        return self.conn.execute(
+            "SELECT s.合同编号, c.invoice_id, s.invoice_id FROM contract_splits s "
+            "JOIN contracts c ON c.合同编号 = s.合同编号 WHERE s.run_id = ? ORDER BY s.合同编号, s.invoice_id",
+            (run_id,)).fetchall()
+
+    def invoices(self, invoice_ids=None, open_only=False):
+        """发票记录list，每张发票：invoice_id/total/tokens/max_amount/max_comment_length/is_open/剩余金额/剩余备注长度
+        invoice_ids为None时取全部(open_only=True时只取未关闭的)，按发票号排序
+        """
+        sql = "SELECT invoice_id, total, tokens, max_amount, max_comment_length, is_open, comment_length FROM invoices"
+        if invoice_ids is not None:
+            rows = self._query_in(sql + " WHERE invoice_id IN (%s)", set(invoice_ids))
+        else:
+            rows = self.conn.execute(sql + (" WHERE is_open = 1" if open_only else "")).fetchall()
+        return [{"invoice_id": invoice_id, "total": total, "tokens": json.loads(tokens), "max_amount": max_amount,
+                 "max_comment_length": max_comment_length, "is_open": bool(is_open),
+                 "剩余金额": max_amount - total, "剩余备注长度": max_comment_length - length}
+                for invoice_id, total, tokens, max_amount, max_comment_length, is_open, length in sorted(rows)]
+
+    def invoice_slips(self, invoice_ids):
+        """发票 -> [(送货单号, 发票明细行list, {"合同编号"/"单据号"/"OA单号"/"SAP订单号": 单号list})]，按记账顺序"""
+        slips = dict((invoice_id, []) for invoice_id in invoice_ids)
+        rows = self._query_in("SELECT rowid, invoice_id, 送货单号, rows, numbers FROM slips WHERE invoice_id IN (%s)",
+                              slips)
+        for _, invoice_id, deliver_no, detail_rows, numbers in sorted(rows):
+            slips[invoice_id].append((deliver_no, [tuple(row) for row in json.loads(detail_rows)],
+                                      json.loads(numbers)))
+        return slips
+
+    def next_invoice_id(self):
+        row = self.conn.execute("SELECT MAX(invoice_id) FROM invoices").fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def save(self, data_file, result_file, invoices, contracts, slips):
+        """记录本次开票
+        invoices: 新开或补充过的发票，invoice_id/total/tokens/max_amount/max_comment_length
+        contracts: [(合同编号, invoice_id)]；slips: [(送货单号, invoice_id, 发票明细行list, 备注单号dict)]
+        以前开过票的合同开到了别的发票时不覆盖原来的记录，记进contract_splits(用contract_splits(run_id)查询)
+        返回本次的run_id
+        """
+        with self.conn:
+            run_id = self.conn.execute("INSERT INTO runs (created_at, data_file, result_file) VALUES (?, ?, ?)",
+                                       (time.strftime("%Y-%m-%d %H:%M:%S"), data_file, result_file)).lastrowid
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO invoices (invoice_id, run_id, total, tokens, comment_length, max_amount, "
+                "max_comment_length, is_open) VALUES (?, ?, ?, ?, ?, ?, ?, "
+                "COALESCE((SELECT is_open FROM invoices WHERE invoice_id = ?), 1))",
+                [(invoice["invoice_id"], run_id, invoice["total"], json.dumps(invoice["tokens"], ensure_ascii=False),
+                  comment_length(invoice["tokens"]), invoice["max_amount"], invoice["max_comment_length"],
+                  invoice["invoice_id"]) for invoice in invoices])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO contract_splits (合同编号, invoice_id, run_id) SELECT ?, ?, ? "
+                "WHERE EXISTS (SELECT 1 FROM contracts WHERE 合同编号 = ? AND invoice_id != ?)",
+                [(contract_no, invoice_id, run_id, contract_no, invoice_id) for contract_no, invoice_id in contracts])
+            self.conn.executemany("INSERT OR IGNORE INTO contracts (合同编号, invoice_id) VALUES (?, ?)", contracts)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO slips (送货单号, invoice_id, rows, numbers) VALUES (?, ?, ?, ?)",
+                [(deliver_no, invoice_id, json.dumps(detail_rows, ensure_ascii=False),
+                  json.dumps(numbers, ensure_ascii=False)) for deliver_no, invoice_id, detail_rows, numbers in slips])
+        return run_id
+
+    def close_open_invoices(self):
+        """发票开出去以后关闭，之后不再往里补充合同，返回关闭的张数"""
+        with self.conn:
+            return self.conn.execute("UPDATE invoices SET is_open = 0 WHERE is_open = 1").rowcount
+
+
+def _fits(invoice, unit, tokens, token_costs):
+    return invoice["total"] + unit.amount <= invoice["max_amount"] + AMOUNT_MARGIN \
+        and comment_length(invoice["token_set"] | tokens, token_costs) <= invoice["max_comment_length"]
+
+
+def fill_ledger_invoices(units, ledger, token_table, fill_open=False):
+    """把新的合同组放进账本里已有的发票
+    units为合同分组结果(ContractGroup，按金额从大到小)，单号id在token_table里；账本发票的单号也登记进token_table
+    以前开过票的合同只能放回原发票，fill_open=True时其余合同先补进未关闭的发票
+    返回(发票号 -> 补进去的合同组list, 账本里涉及到的发票记录dict, 需要新开发票的合同组list)
+    """
+    known = ledger.contract_invoices(contract_no for unit in units for contract_no in unit.contract_nos)
+    pinned = [set(known[contract_no] for contract_no in unit.contract_nos if contract_no in known) for unit in units]
+    invoice_ids = set(invoice_id for invoice_ids in pinned for invoice_id in invoice_ids)
+    candidates = dict((invoice["invoice_id"], invoice) for invoice in ledger.invoices(open_only=True)) \
+        if fill_open else {}
+    for invoice in ledger.invoices(invoice_ids - set(candidates)):
+        candidates[invoice["invoice_id"]] = invoice
+    for invoice in candidates.values():
+        invoice["token_set"] = set(token_table.intern_all(invoice["tokens"]))
+
+    filled = {}
+    rest = []
+    for unit, invoice_ids in zip(units, pinned):
+        tokens = set(unit.tokens)
+        if invoice_ids:
+            invoice = candidates[min(invoice_ids)]
+            if len(invoice_ids) > 1 or not invoice["is_open"] or not _fits(invoice, unit, tokens, token_table.costs):
+                print("⚠️  警告：合同编号 %s 以前开在发票 %s 里，发票已关闭或剩余额度不够，本次单独开票"
+                      % (unit.contract_no, "、".join(str(invoice_id) for invoice_id in sorted(invoice_ids))))
+                rest.append(unit)
+                continue
+        elif fill_open:
+            invoice = next((invoice for invoice in candidates.values()
+                            if invoice["is_open"] and _fits(invoice, unit, tokens, token_table.costs)), None)
+            if invoice is None:
+                rest.append(unit)
+                continue
+        else:
+            rest.append(unit)
+            continue
+        invoice["total"] += unit.amount
+        invoice["tokens"] += token_table.strings(token_id for token_id in unit.tokens
+                                                 if token_id not in invoice["token_set"])
+        invoice["token_set"] |= tokens
+        filled.setdefault(invoice["invoice_id"], []).append(unit)
+    return filled, candidates, rest
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+发票分组(装箱)
+
+原来的get_valid_group每尝试加入一个合同，都要把整张发票的总金额、单据号集合从头算一遍，循环里还要list.remove，
+合同数上千时要跑好几分钟。pack_greedy按完全相同的贪心顺序分组，分出来的发票和原来逐个校验的结果一模一样，只是：
+    1. 当前发票的总金额、备注单号集合、备注长度都是增量维护的，校验一个合同只需要看它新带进来的单号
+    2. 合同已按金额从大到小排序，金额超出剩余额度的一段合同用二分直接跳过
+    3. 和当前发票没有共用单号的合同，备注长度增量就是它自己全部单号的长度；线段树按位置存这个长度，
+       直接找到下一个放得下的合同，中间放不下的整段跳过
+    4. 和当前发票有共用单号的合同通过 单号->合同 的倒排索引找出来，逐个精确校验；
+       每个单号只在堆里放它下一个还没分组的合同，很多合同共用同一个单号时也不会反复把它们全部放进堆里
+
+pack_optimized是可选的优化分组：贪心按金额排序逐个塞，不管合同之间共用的单号(共用的单号在备注里只写一次)，
+经常多开发票。优化分组先按重叠感知的best-fit decreasing分组，再在时间预算内做局部搜索，
+发票张数不会比贪心多；lower_bound给出发票张数的下界，用来判断离最优还差多少。
+"""
+
+from __future__ import unicode_literals
+import bisect
+import heapq
+import time
+
+# 单张发票总金额上限；备注总长度200字符，去掉固定的24个字符和4个换行符后，单号部分最多176字符
+MAX_INVOICE_AMOUNT = 90000
+MAX_COMMENT_LENGTH = 176
+# 按金额二分跳过时留的余量，避免浮点误差跳过了恰好等于上限的合同
+AMOUNT_MARGIN = 1e-6
+INF = float("inf")
+
+
+def comment_length(tokens, token_costs=None):
+    '''备注里的单号每个占 长度+1(换行符) 个字符；token_costs不为空时tokens是单号id，token_costs[id]为这个单号占的字符数'''
+    if token_costs is None:
+        return sum(len(token) + 1 for token in tokens)
+    return sum(token_costs[token] for token in tokens)
+
+
+class MinTree(object):
+    '''按位置存数值的线段树：支持删除某个位置，以及查找某个位置之后第一个数值<=limit的位置'''
+
+    def __init__(self, values):
+        size = 1
+        while size < len(values):
+            size *= 2
+        self.size = size
+        self.tree = [INF] * (2 * size)
+        self.tree[size:size + len(values)] = values
+        for node in range(size - 1, 0, -1):
+            self.tree[node] = min(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def remove(self, pos):
+        node = pos + self.size
+        self.tree[node] = INF
+        node //= 2
+        while node:
+            self.tree[node] = min(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+    def first(self, start, limit):
+        '''>=start的第一个数值<=limit的位置，没有时返回None'''
+        return self._first(1, 0, self.size, start, limit)
+
+    def _first(self, node, low, high, start, limit):
+        if high <= start or not self.tree[node] <= limit:
+            return None
+        if high - low == 1:
+            return low
+        mid = (low + high) // 2
+        pos = self._first(2 * node, low, mid, start, limit)
+        if pos is None:
+            pos = self._first(2 * node + 1, mid, high, start, limit)
+        return pos
+
+
+def _next_alive(positions, after, alive):
+    '''有序位置列表positions中>after的第一个还没分组的位置，没有时返回None；途中遇到的已分组位置顺手删掉'''
+    start = bisect.bisect_right(positions, after)
+    end = start
+    while end < len(positions) and not alive[positions[end]]:
+        end += 1
+    if end > start:
+        del positions[start:end]
+    return positions[start] if start < len(positions) else None
+
+
+def _push_shared(shared, token_index, token, after, alive):
+    pos = _next_alive(token_index[token], after, alive)
+    if pos is not None:
+        heapq.heappush(shared, (pos, token))
+
+
+def pack_greedy(contracts, token_costs, max_amount=MAX_INVOICE_AMOUNT, max_comment_length=MAX_COMMENT_LENGTH):
+    '''按原来的贪心规则分组：剩下的第一个合同作为一张新发票，再按顺序把加进去仍然满足限制的合同都加进去，直到分完
+    contracts为invoice_records.ContractGroup的list(用到amount/tokens)，token_costs[单号id]为单号在备注里占的字符数
+    返回发票list，每张发票是ContractGroup的list
+    '''
+    count = len(contracts)
+    amounts = [float(contract.amount) for contract in contracts]
+    tokens = [set(contract.tokens) for contract in contracts]
+    # 合同金额从大到小排好序时才能按金额二分跳过
+    sorted_desc = all(amounts[pos] >= amounts[pos + 1] for pos in range(count - 1))
+    negative_amounts = [-amount for amount in amounts]
+
+    token_index = {}
+    for pos, contract_tokens in enumerate(tokens):
+        for token in contract_tokens:
+            token_index.setdefault(token, []).append(pos)
+
+    alive = [True] * count
+    cost_tree = MinTree([comment_length(contract_tokens, token_costs) for contract_tokens in tokens])
+    invoices = []
+    base = 0
+    while True:
+        while base < count and not alive[base]:
+            base += 1
+        if base >= count:
+            break
+
+        group = [base]
+        total = amounts[base]
+        group_tokens = set(tokens[base])
+        length = comment_length(group_tokens, token_costs)
+        alive[base] = False
+        cost_tree.remove(base)
+        # 堆里是(位置, 单号)：当前发票的每个单号下一个还没检查过的合同位置
+        shared = []
+        for token in group_tokens:
+            _push_shared(shared, token_index, token, base, alive)
+
+        checked = base
+        while True:
+            start = checked + 1
+            if sorted_desc and total == total:
+                start = max(start, bisect.bisect_left(negative_amounts, total - max_amount - AMOUNT_MARGIN))
+            independent = cost_tree.first(start, max_comment_length - length) if start < count else None
+            while shared and shared[0][0] <= checked:
+                _push_shared(shared, token_index, heapq.heappop(shared)[1], checked, alive)
+            if shared and (independent is None or shared[0][0] < independent):
+                pos = shared[0][0]
+            elif independent is not None:
+                pos = independent
+            else:
+                break
+            checked = pos
+
+            new_tokens = tokens[pos] - group_tokens
+            new_length = length + comment_length(new_tokens, token_costs)
+            if total + amounts[pos] > max_amount or new_length > max_comment_length:
+                continue
+            group.append(pos)
+            total += amounts[pos]
+            length = new_length
+            group_tokens |= new_tokens
+            alive[pos] = False
+            cost_tree.remove(pos)
+            for token in new_tokens:
+                _push_shared(shared, token_index, token, pos, alive)
+
+        invoices.append([contracts[pos] for pos in group])
+    return invoices
+
+
+# 优化分组的默认时间预算(秒)
+DEFAULT_TIME_BUDGET = 10
+# 优化分组时，除了和合同有共用单号的发票，再看最近打开的多少张发票
+OPEN_WINDOW = 256
+
+
+def is_valid_group(amounts, tokens, positions, token_costs, max_amount=MAX_INVOICE_AMOUNT,
+                   max_comment_length=MAX_COMMENT_LENGTH):
+    '''和validate_invoice同样的校验：按positions的顺序累加金额，单号去重后算备注长度'''
+    total = 0
+    for pos in positions:
+        total += amounts[pos]
+    group_tokens = set()
+    for pos in positions:
+        group_tokens |= tokens[pos]
+    return not (total > max_amount or comment_length(group_tokens, token_costs) > max_comment_length)
+
+
+def lower_bound(contracts, token_costs, max_amount=MAX_INVOICE_AMOUNT, max_comment_length=MAX_COMMENT_LENGTH):
+    '''发票张数的下界
+    单独就超限的合同只能单独开票(有负金额时，金额超限的合同可能和负金额合同凑在一起，不计入)，
+    其余合同至少要开的张数取以下几项的最大值：
+    1. 总金额 / 单张金额上限
+    2. 去重后的单号总长度 / 备注长度上限(共用的单号最好情况下只写一次)
+    3. 没有负金额时，金额超过上限一半的合同两两不能放在一起，每个至少一张
+    '''
+    amounts = [float(contract.amount) for contract in contracts]
+    tokens = [set(contract.tokens) for contract in contracts]
+    has_negative = any(amount < 0 for amount in amounts)
+    alone = 0
+    rest = []
+    for pos in range(len(contracts)):
+        if is_valid_group(amounts, tokens, [pos], token_costs, max_amount, max_comment_length):
+            rest.append(pos)
+        elif comment_length(tokens[pos], token_costs) > max_comment_length or not has_negative:
+            alone += 1
+    if not rest:
+        return alone
+
+    all_tokens = set()
+    for pos in rest:
+        all_tokens |= tokens[pos]
+    bound = max(int(-(-sum(amounts[pos] for pos in rest) // max_amount)),
+                int(-(-comment_length(all_tokens, token_costs) // max_comment_length)), 1)
+    if not has_negative:
+        bound = max(bound, sum(1 for pos in rest if amounts[pos] > max_amount / 2.0))
+    return alone + bound
+
+
+class _Invoice(object):
+    '''优化分组过程中的一张发票：创建顺序、合同位置、总金额、每个单号被几个合同用到、备注长度'''
+
+    def __init__(self, seq, token_costs):
+        self.seq = seq
+        self.token_costs = token_costs
+        self.members = []
+        self.total = 0.0
+        self.token_count = {}
+        self.length = 0
+
+    def add(self, pos, amount, contract_tokens):
+        self.members.append(pos)
+        self.total += amount
+        for token in contract_tokens:
+            if token in self.token_count:
+                self.token_count[token] += 1
+            else:
+                self.token_count[token] = 1
+                self.length += self.token_costs[token]
+
+    def remove(self, pos, amount, contract_tokens):
+        self.members.remove(pos)
+        self.total -= amount
+        for token in contract_tokens:
+            self.token_count[token] -= 1
+            if not self.token_count[token]:
+                del self.token_count[token]
+                self.length -= self.token_costs[token]
+
+    def fill(self, max_amount, max_comment_length):
+        return max(self.total / max_amount, 0) + float(self.length) / max_comment_length
+
+
+class _OptimizedPacker(object):
+    '''按重叠感知的best-fit decreasing分组，再在时间预算内反复尝试把最空的发票里的合同全部挪进其他发票'''
+
+    def __init__(self, contracts, token_costs, max_amount, max_comment_length):
+        self.contracts = contracts
+        self.token_costs = token_costs
+        self.max_amount = max_amount
+        self.max_comment_length = max_comment_length
+        self.amounts = [float(contract.amount) for contract in contracts]
+        self.tokens = [set(contract.tokens) for contract in contracts]
+        self.own_lengths = [comment_length(contract_tokens, token_costs) for contract_tokens in self.tokens]
+        self.invoices = []
+        # 单号 -> 包含这个单号的发票
+        self.token_invoices = {}
+        self.created = 0
+
+    def fits(self, invoice, pos):
+        '''合同pos放进invoice后是否仍然满足限制；金额接近上限时按最终输出的合同顺序精确累加，保证和validate_invoice一致'''
+        total = invoice.total + self.amounts[pos]
+        if total > self.max_amount + AMOUNT_MARGIN:
+            return False
+        # 单号全部算新增都放得下时不用逐个比对
+        if invoice.length + self.own_lengths[pos] > self.max_comment_length \
+                and self.new_length(invoice, pos) > self.max_comment_length:
+            return False
+        if total <= self.max_amount - AMOUNT_MARGIN:
+            return True
+        return is_valid_group(self.amounts, self.tokens, sorted(invoice.members + [pos]), self.token_costs,
+                              self.max_amount, self.max_comment_length)
+
+    def new_length(self, invoice, pos):
+        return invoice.length + comment_length((token for token in self.tokens[pos] if token not in invoice.token_count),
+                                               self.token_costs)
+
+    def place(self, invoice, pos):
+        invoice.add(pos, self.amounts[pos], self.tokens[pos])
+        for token in self.tokens[pos]:
+            self.token_invoices.setdefault(token, set()).add(invoice)
+
+    def unplace(self, invoice, pos):
+        invoice.remove(pos, self.amounts[pos], self.tokens[pos])
+        for token in self.tokens[pos]:
+            if token not in invoice.token_count:
+                self.token_invoices[token].discard(invoice)
+
+    def new_invoice(self, pos):
+        self.created += 1
+        invoice = _Invoice(self.created, self.token_costs)
+        self.place(invoice, pos)
+        self.invoices.append(invoice)
+        return invoice
+
+    def sharing_invoices(self, pos):
+        invoices = set()
+        for token in self.tokens[pos]:
+            invoices |= self.token_invoices.get(token, set())
+        return invoices
+
+    def best_fit(self, pos, candidates, sharing):
+        '''candidates里放得下合同pos、且放进去之后剩余空间(金额、备注长度按上限归一化后相加)最小的发票
+        sharing为和合同有共用单号的发票，其余发票的备注长度增量就是合同自己全部单号的长度
+        '''
+        best, best_residual = None, None
+        amount, own_length = self.amounts[pos], self.own_lengths[pos]
+        for invoice in candidates:
+            total = invoice.total + amount
+            if invoice in sharing:
+                if not self.fits(invoice, pos):
+                    continue
+                length = self.new_length(invoice, pos)
+            else:
+                length = invoice.length + own_length
+                if length > self.max_comment_length or total > self.max_amount + AMOUNT_MARGIN:
+                    continue
+                if total > self.max_amount - AMOUNT_MARGIN and not self.fits(invoice, pos):
+                    continue
+            residual = (self.max_amount - total) / self.max_amount \
+                + float(self.max_comment_length - length) / self.max_comment_length
+            if best is None or residual < best_residual:
+                best, best_residual = invoice, residual
+        return best
+
+    def build(self, positions, deadline):
+        '''best-fit decreasing：合同按 max(金额占比, 单号长度占比) 从大到小，放进放得下且剩余空间最小的发票
+        候选发票为和合同有共用单号的发票，以及最近打开的、还放得下最小合同的发票；超过deadline时放弃，返回False
+        '''
+        def size(pos):
+            return max(self.amounts[pos] / self.max_amount, float(self.own_lengths[pos]) / self.max_comment_length)
+
+        positions = list(positions)
+        min_amount = min(self.amounts[pos] for pos in positions) if positions else 0
+        min_length = min(self.own_lengths[pos] for pos in positions) if positions else 0
+        open_invoices = []
+        for count, pos in enumerate(sorted(positions, key=lambda pos: (-size(pos), pos))):
+            if count % 1000 == 0 and time.time() >= deadline:
+                return False
+            sharing = self.sharing_invoices(pos)
+            # 先看有共用单号的发票，再按创建顺序看最近打开的发票；剩余空间相同时取先看到的，结果可复现
+            candidates = sorted(sharing, key=lambda invoice: invoice.seq) \
+                + [invoice for invoice in open_invoices[-OPEN_WINDOW:] if invoice not in sharing]
+            invoice = self.best_fit(pos, candidates, sharing)
+            if invoice is None:
+                invoice = self.new_invoice(pos)
+                open_invoices.append(invoice)
+            else:
+                self.place(invoice, pos)
+            # 放不下任何一个完整合同的发票只可能再放进有共用单号的合同，不再作为候选
+            if invoice.length + min_length > self.max_comment_length \
+                    or invoice.total + min_amount > self.max_amount + AMOUNT_MARGIN:
+                if invoice in open_invoices:
+                    open_invoices.remove(invoice)
+        return True
+
+    def load(self, groups):
+        for group in groups:
+            invoice = self.new_invoice(group[0])
+            for pos in group[1:]:
+                self.place(invoice, pos)
+
+    def try_eliminate(self, invoice):
+        '''把invoice里的合同全部挪进其他发票(优先有共用单号的)，挪不完时全部撤回'''
+        moved = []
+        others = [other for other in self.invoices if other is not invoice]
+        for pos in sorted(invoice.members, key=lambda pos: -self.amounts[pos]):
+            sharing = self.sharing_invoices(pos)
+            sharing.discard(invoice)
+            target = self.best_fit(pos, sorted(sharing, key=lambda other: other.seq), sharing) \
+                or self.best_fit(pos, others, sharing)
+            if target is None:
+                for moved_pos, moved_target in moved:
+                    self.unplace(moved_target, moved_pos)
+                return False
+            self.place(target, pos)
+            moved.append((pos, target))
+
+        for pos, _ in moved:
+            self.unplace(invoice, pos)
+        self.invoices.remove(invoice)
+        return True
+
+    def improve(self, deadline, bound):
+        '''局部搜索：按填充程度从空到满尝试清空发票，清空一张就重新开始，一轮都清不掉或者到达时间预算/下界时停止'''
+        improved = True
+        while improved and len(self.invoices) > bound and time.time() < deadline:
+            improved = False
+            for invoice in sorted(self.invoices, key=lambda invoice: invoice.fill(self.max_amount,
+                                                                                  self.max_comment_length)):
+                if time.time() >= deadline:
+                    break
+                if self.try_eliminate(invoice):
+                    improved = True
+                    break
+
+    def groups(self):
+        '''发票内合同按原顺序排列，发票按第一个合同的位置排列'''
+        return sorted([sorted(invoice.members) for invoice in self.invoices])
+
+
+def pack_optimized(contracts, token_costs, time_budget=DEFAULT_TIME_BUDGET, max_amount=MAX_INVOICE_AMOUNT,
+                   max_comment_length=MAX_COMMENT_LENGTH, greedy=None, bound=None):
+    '''尽量少开发票的分组：
+    1. 按重叠感知的best-fit decreasing分组(共用单号的合同放在一起备注更短)，和原贪心的结果取发票少的一个
+    2. 在time_budget秒内反复尝试把最空的发票里的合同全部挪进其他发票，减少发票张数，达到下界时提前结束
+    单独就超限的合同和原来一样单独开票；结果不会比pack_greedy多，返回值和pack_greedy一样
+    greedy/bound为调用方已经算好的pack_greedy结果和lower_bound，不传时在这里计算
+    '''
+    deadline = time.time() + time_budget
+    if greedy is None:
+        greedy = pack_greedy(contracts, token_costs, max_amount, max_comment_length)
+    if bound is None:
+        bound = lower_bound(contracts, token_costs, max_amount, max_comment_length)
+    if len(greedy) <= bound:
+        return greedy
+
+    packer = _OptimizedPacker(contracts, token_costs, max_amount, max_comment_length)
+    # 构造阶段最多用一半的时间预算，剩下的留给局部搜索
+    built = packer.build(range(len(contracts)), time.time() + time_budget / 2.0)
+    if not built or len(packer.invoices) >= len(greedy):
+        # best-fit不如原贪心时从原贪心的结果开始改进
+        positions = dict((id(contract), pos) for pos, contract in enumerate(contracts))
+        packer = _OptimizedPacker(contracts, token_costs, max_amount, max_comment_length)
+        packer.load([[positions[id(contract)] for contract in group] for group in greedy])
+    packer.improve(deadline, bound)
+
+    groups = packer.groups()
+    # 超限的合同只能单独一张，其余发票都要满足限制
+    if len(groups) >= len(greedy) \
+            or not all(len(group) == 1 or is_valid_group(packer.amounts, packer.tokens, group, token_costs, max_amount,
+                                                         max_comment_length) for group in groups):
+        return greedy
+    return [[contracts[pos] for pos in group] for group in groups]
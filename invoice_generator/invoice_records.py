@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+开票过程中的紧凑记录类型
+
+原来明细、合同分组都是中文key的dict，单号是字符串list，分组时反复拼接、转set，大对账单上内存和hash开销都很大。这里：
+    1. 备注里的单号(合同编号/单据号/OA单号/SAP订单号)统一登记到TokenTable，换成从0开始的整数id，
+       同一个单号只存一份字符串；分组时单号集合的并集、备注长度都按整数算，备注长度按id查表累加
+    2. 明细、合同分组用__slots__的类，不带每个对象一份的__dict__；工单备注一样的明细共用同一个RemarkNumbers
+"""
+
+from __future__ import unicode_literals
+
+# 备注里四种单号，顺序和备注模板一致
+NUMBER_FIELDS = ["合同编号", "单据号", "OA单号", "SAP订单号"]
+
+
+class TokenTable(object):
+    """单号 <-> 整数id；costs[id]为这个单号在备注里占的字符数(长度+1个换行符)"""
+    __slots__ = ("ids", "tokens", "costs")
+
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+        self.costs = []
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def intern(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+            self.costs.append(len(token) + 1)
+        return token_id
+
+    def intern_all(self, tokens):
+        return tuple(self.intern(token) for token in tokens)
+
+    def strings(self, token_ids):
+        return [self.tokens[token_id] for token_id in token_ids]
+
+
+class RemarkNumbers(object):
+    """一条工单备注里提取出来的单号id，每种单号一个tuple，顺序同NUMBER_FIELDS"""
+    __slots__ = ("by_field", "all_ids")
+
+    def __init__(self, by_field):
+        self.by_field = by_field
+        # 四种单号合在一起去重，备注长度按这个算
+        self.all_ids = tuple(dict.fromkeys(token_id for field_ids in by_field for token_id in field_ids))
+
+    @property
+    def contract_ids(self):
+        return self.by_field[0]
+
+
+class DeliveryRow(object):
+    """一条对账明细：送货单号、金额、备注单号，以及发票上要印的明细(工程号/品名/规格/数量/单位/单价/金额)"""
+    __slots__ = ("deliver_no", "amount", "numbers", "detail")
+
+    def __init__(self, deliver_no, amount, numbers, detail):
+        self.deliver_no = deliver_no
+        self.amount = amount
+        self.numbers = numbers
+        self.detail = detail
+
+
+class ContractGroup(object):
+    """开票的最小单位：一个合同，或者共用送货单的几个合同
+    contract_nos为合同编号字符串tuple，tokens为组内所有备注单号的id(去重，保持出现顺序)
+    """
+    __slots__ = ("contract_nos", "amount", "tokens", "deliver_nos", "row_count")
+
+    def __init__(self, contract_nos, amount, tokens, deliver_nos, row_count):
+        self.contract_nos = contract_nos
+        self.amount = amount
+        self.tokens = tokens
+        self.deliver_nos = deliver_nos
+        self.row_count = row_count
+
+    @property
+    def contract_no(self):
+        """打印、记账用的合同编号，多个合同用、连接"""
+        return "、".join(self.contract_nos)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+销售对账明细的模拟数据，不用真实客户的对账单也能评估合同分组、发票分组的效果和耗时(见bench_packing.py)
+
+生成的工作簿和真实的销售对账明细结构一致：第1行标题，第2行表头，之后每行一条明细。数据特点：
+    1. 工单备注格式不统一：单号之间用、，, 分隔，冒号有全角半角，单据号有时写成计划号/计划单号，字段之间有空格、逗号、换行
+    2. 合同:送货单 = n:n：一个合同分在几张送货单里，部分送货单同时装了相邻合同的货，少数备注里写了两个合同编号
+    3. 合同:单据号 = 1:1~3，少数合同单据号特别多(备注超长)；少数合同金额超过单张发票上限(只能单独开票)
+    4. 混有未审核、其他客户、备注里没有合同编号、送货单号为空的明细，开票时会被过滤掉
+"""
+
+from __future__ import unicode_literals
+import os
+import random
+import sys
+
+dir = os.path.abspath(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(dir))
+
+from common.table_writer import open_workbook, write_row
+
+STATEMENT_COLUMNS = ["送货日期", "审核", "工程号", "送货单号", "客户名称", "产品名称", "产品规格", "数量", "单位", "单价",
+                     "金额", "工单备注"]
+DEFAULT_CUSTOMER = "海南普利制药股份有限公司"
+OTHER_CUSTOMERS = ["广州白云山(制药)", "上海某某药业", "海南葫芦娃药业集团股份有限公司"]
+PRODUCTS = [("地氯雷他定干混悬剂纸盒", "90*75*35", "个"), ("说明书", "A4", "张"), ("标签", "50*30", "张"),
+            ("空白纸盒", "125*52*60mm", "个"), ("外箱", "300*200*150", "个")]
+# 工单备注模板：(单据号字段名, 单号分隔符, 字段分隔符, 冒号)
+# 只写了"计划号"的备注开票时按缺少单据号过滤掉(data_filter只认单据号/计划单号)，所以出现得比较少
+REMARK_STYLES = [
+    ("单据号", "、", " ", "："),
+    ("计划单号", ", ", "; ", ":"),
+    ("单据号", ",", "\n", "："),
+    ("单据号", "、", "  ", ":"),
+    ("计划单号", "，", "，", "："),
+    ("计划号", "，", "，", "："),
+]
+REMARK_STYLE_WEIGHTS = [6, 3, 3, 2, 2, 1]
+
+
+def make_remark(contract_nos, bill_nos, oa_no, sap_no, style):
+    '''按模板拼一条工单备注'''
+    bill_field, number_sep, field_sep, colon = style
+    return field_sep.join(["合同编号%s%s" % (colon, "、".join(contract_nos)),
+                           "%s%s%s" % (bill_field, colon, number_sep.join(bill_nos)),
+                           "OA单号%s%s" % (colon, oa_no),
+                           "SAP订单号%s%s" % (colon, sap_no)])
+
+
+def make_statement(row_count, seed=0, share_rate=0.1, oversize_rate=0.01, long_remark_rate=0.01, noise_rate=0.05):
+    '''生成约row_count条对账明细，返回list，每个元素是按STATEMENT_COLUMNS顺序的一行
+    share_rate: 送货单同时装了上一个合同的货的比例；oversize_rate: 金额超过9万的合同比例；
+    long_remark_rate: 单据号多到备注超长的合同比例；noise_rate: 开票时会被过滤掉的明细比例
+    '''
+    rng = random.Random(seed)
+    rows = []
+    slip_seq = [0]
+    contract_seq = 0
+    last_contract = None
+
+    def new_slip():
+        slip_seq[0] += 1
+        return "SH%08d" % slip_seq[0]
+
+    while len(rows) < row_count:
+        contract_seq += 1
+        contract_no = "2024%06d" % contract_seq
+        bill_count = rng.randint(12, 20) if rng.random() < long_remark_rate else rng.randint(1, 3)
+        bill_nos = ["22400%05d" % rng.randrange(100000) for _ in range(bill_count)]
+        style = rng.choices(REMARK_STYLES, REMARK_STYLE_WEIGHTS)[0]
+        remark = make_remark([contract_no], bill_nos, "7%05d" % (contract_seq % 100000),
+                             "45%08d" % contract_seq, style)
+        slips = [new_slip() for _ in range(rng.randint(1, 3))]
+        # 送货单同时装了上一个合同的货：这张送货单上的明细有两个合同
+        if last_contract is not None and rng.random() < share_rate:
+            slips.append(rng.choice(last_contract["slips"]))
+        oversize = rng.random() < oversize_rate
+        line_count = rng.randint(1, 12)
+        # 合同金额：大多几千到几万，超大合同十几万
+        contract_amount = rng.uniform(100000, 300000) if oversize else rng.lognormvariate(9.3, 0.9)
+        date = "2024-%02d-%02d" % (contract_seq % 12 + 1, contract_seq % 28 + 1)
+
+        for line in range(line_count):
+            product, spec, unit = rng.choice(PRODUCTS)
+            quantity = float(rng.randint(1, 500) * 100)
+            amount = round(contract_amount / line_count * rng.uniform(0.5, 1.5), 2)
+            line_remark = remark
+            # 少数明细备注里写了两个合同编号(和上一个合同共用)
+            if last_contract is not None and rng.random() < share_rate / 5:
+                line_remark = make_remark([contract_no, last_contract["contract_no"]], bill_nos,
+                                          "7%05d" % (contract_seq % 100000), "45%08d" % contract_seq, style)
+            audit, customer, slip = "是", DEFAULT_CUSTOMER, rng.choice(slips)
+            noise = rng.random()
+            if noise < noise_rate * 0.4:
+                audit = "否"
+            elif noise < noise_rate * 0.8:
+                customer = rng.choice(OTHER_CUSTOMERS)
+            elif noise < noise_rate * 0.9:
+                line_remark = "加急，%s" % rng.choice(["客户自提", "补发", "样品"])
+            elif noise < noise_rate:
+                slip = None
+            rows.append([date, audit, "GC%08d" % len(rows), slip, customer, product, spec, quantity, unit,
+                         round(amount / quantity, 4), amount, line_remark])
+        last_contract = {"contract_no": contract_no, "slips": slips}
+
+    # 真实对账单按送货单号排列
+    rows = rows[:row_count]
+    rows.sort(key=lambda row: row[3] or "")
+    return rows
+
+
+def write_statement_file(file_path, rows, title="销售对账明细"):
+    '''第1行标题，第2行表头，逐行写出(constant_memory)'''
+    workbook = open_workbook(file_path)
+    worksheet = workbook.add_worksheet("Sheet1")
+    write_row(worksheet, 0, [title])
+    write_row(worksheet, 1, STATEMENT_COLUMNS)
+    for row_num, row in enumerate(rows, 2):
+        write_row(worksheet, row_num, row)
+    workbook.close()
+    return file_path
+
+
+if __name__ == "__main__":
+    # 用法: python synthetic_statements.py <明细行数> <输出文件>
+    row_count, output_file = int(sys.argv[1]), sys.argv[2]
+    write_statement_file(output_file, make_statement(row_count))
+    print("生成完成：【%s】" % output_file)